@@ -0,0 +1,57 @@
+"""STT upload format benchmark.
+
+Har bir format (ogg / flac / wav) uchun: yuklanadigan bayt soni,
+transcode vaqti va umumiy (transcode + STT) kechikish.
+
+    python bench_stt.py voice1.ogg voice2.ogg [--repeat 3] [--formats ogg,flac,wav]
+
+GROQ_BASE env orqali lokal stand-in serverga yo‘naltirish mumkin.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import main
+
+
+async def bench_file(path: str, formats, repeat: int):
+    with open(path, "rb") as f:
+        ogg = f.read()
+    rows = []
+    for fmt in formats:
+        sizes, encode_ms, total_ms, texts = [], [], [], []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            audio = await main.encode_for_stt(ogg, fmt)
+            t1 = time.perf_counter()
+            text = await main.groq_stt_whisper(audio, fmt)
+            t2 = time.perf_counter()
+            sizes.append(len(audio))
+            encode_ms.append((t1 - t0) * 1000)
+            total_ms.append((t2 - t0) * 1000)
+            texts.append(text)
+        rows.append((fmt, sizes[0], statistics.median(encode_ms), statistics.median(total_ms), texts[-1]))
+    return len(ogg), rows
+
+
+async def run(args):
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    try:
+        for path in args.files:
+            src_size, rows = await bench_file(path, formats, args.repeat)
+            print(f"\n{path} (ogg source: {src_size} bytes)")
+            print(f"{'format':<6} {'upload bytes':>12} {'x ogg':>6} {'encode ms':>10} {'total ms':>10}  transcript")
+            for fmt, size, enc, total, text in rows:
+                ratio = size / src_size if src_size else 0
+                print(f"{fmt:<6} {size:>12} {ratio:>6.1f} {enc:>10.1f} {total:>10.1f}  {text[:40]!r}")
+    finally:
+        await main.close_http()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("files", nargs="+")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--formats", default=",".join(main.STT_FORMAT_ORDER))
+    asyncio.run(run(ap.parse_args()))
@@ -0,0 +1,401 @@
+"""Offline load test: main.py ni lokal stand-in serverlar bilan yuklash.
+
+Bot API (getChatMember, getFile, fayl yuklash, sendMessage, ...), Groq
+(/audio/transcriptions, /chat/completions), dictionary va translate o‘rniga
+bitta lokal aiohttp server ishlaydi. Simulyatsiya qilingan userlar speaking,
+dictionary va writing oqimlaridan o‘tadi (dp.feed_update orqali).
+
+    python loadtest.py --users 200 --rounds 3 --flows speaking,dictionary,writing \\
+        --latency chat=1500 --latency stt=600 --error-rate chat=0.05
+
+Natija: msgs/sec, har handler uchun p50/p95/p99, baholash e2e va event loop lag.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+FAKE_TOKEN = "123456:loadtest"
+SERVICES = ("telegram", "file", "stt", "chat", "dict", "translate", "media")
+
+WORDS = ["hobby", "routine", "travel", "weather", "family", "friend", "school", "music",
+         "future", "holiday", "market", "river", "garden", "library", "energy"]
+SENTENCES = [
+    "I usually spend my free time reading books and walking in the park with my friends.",
+    "In my opinion technology makes our life easier but it also creates some problems.",
+    "Last summer I visited my grandparents in the village and helped them in the garden.",
+    "My favourite subject is history because it explains how people lived in the past.",
+    "Public transport in my city is cheap, although buses are often crowded in the morning.",
+]
+
+
+class Profile:
+    # bitta soxta servis: kechikish (ms, ±jitter) va xato ehtimoli
+    def __init__(self, latency_ms: float = 0, jitter: float = 0.3, error_rate: float = 0, error_status: int = 503):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = 0
+        self.errors = 0
+
+    async def apply(self) -> bool:
+        # False -> xato qaytarish kerak
+        self.calls += 1
+        if self.latency_ms:
+            spread = self.latency_ms * self.jitter
+            await asyncio.sleep(max(0.0, random.uniform(self.latency_ms - spread, self.latency_ms + spread)) / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return False
+        return True
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+# ======================
+# STAND-IN SERVER
+# ======================
+class FakeUpstreams:
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.stt_texts = itertools.count(1)
+        self.on_message = None  # (chat_id, text) -> None
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.bot_file)
+        app.router.add_post("/groq/audio/transcriptions", self.stt)
+        app.router.add_post("/groq/chat/completions", self.chat)
+        app.router.add_get("/dict/{word}", self.dictionary)
+        app.router.add_get("/translate", self.translate)
+        app.router.add_get("/media/{name}", self.media)
+        return app
+
+    def _message(self, chat_id, text=None, **extra):
+        msg = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "bot"},
+        }
+        if text is not None:
+            msg["text"] = text
+        msg.update(extra)
+        return msg
+
+    async def bot_api(self, request: web.Request) -> web.Response:
+        if not await self.profiles["telegram"].apply():
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        chat_id = form.get("chat_id", 0)
+        text = form.get("text")
+
+        if method == "getchatmember":
+            result = {"status": "member", "user": {"id": int(form.get("user_id", 0)), "is_bot": False,
+                                                    "first_name": "u"}}
+        elif method == "getfile":
+            result = {"file_id": form.get("file_id"), "file_unique_id": "u", "file_size": 4096,
+                      "file_path": f"voice/{form.get('file_id')}.ogg"}
+        elif method in ("sendmessage", "editmessagetext"):
+            if self.on_message is not None and text:
+                self.on_message(int(chat_id), text)
+            result = self._message(chat_id, text)
+        elif method == "sendvoice":
+            fid = f"voice{next(self.file_ids)}"
+            result = self._message(chat_id, voice={"file_id": fid, "file_unique_id": fid, "duration": 1})
+        elif method == "sendaudio":
+            fid = f"audio{next(self.file_ids)}"
+            result = self._message(chat_id, audio={"file_id": fid, "file_unique_id": fid, "duration": 1})
+        elif method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "bot", "username": "loadtest_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def bot_file(self, request: web.Request) -> web.Response:
+        if not await self.profiles["file"].apply():
+            return web.Response(status=self.profiles["file"].error_status)
+        return web.Response(body=b"OggS" + os.urandom(8 * 1024), content_type="audio/ogg")
+
+    async def stt(self, request: web.Request) -> web.Response:
+        await request.read()
+        if not await self.profiles["stt"].apply():
+            return web.json_response({"error": {"message": "overloaded"}}, status=self.profiles["stt"].error_status)
+        # har javob har xil: baholash keshi natijani buzmasin
+        n = next(self.stt_texts)
+        return web.json_response({"text": f"{random.choice(SENTENCES)} Answer number {n}."})
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        profile = self.profiles["chat"]
+        if not await profile.apply():
+            return web.json_response({"error": {"message": "rate limited"}}, status=profile.error_status)
+        content = json.dumps({
+            "off_topic": False,
+            "per_question": [{"relevance_to_question": 4, "comment": "ok"} for _ in range(3)],
+            "score_20_75": random.randint(30, 60),
+            "feedback_uz": "Yaxshi, lekin grammatikaga e'tibor bering.",
+            "corrections": [{"from": "I ", "to": "I really "}, {"from": "the", "to": "a"}],
+        })
+        usage = {"prompt_tokens": len(json.dumps(body["messages"])) // 4, "completion_tokens": len(content) // 4}
+        if not body.get("stream"):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}],
+                                      "usage": usage})
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        step = max(1, len(content) // 8)
+        for i in range(0, len(content), step):
+            chunk = {"choices": [{"delta": {"content": content[i:i + step]}}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0)
+        last = {"choices": [{"delta": {}, "finish_reason": "stop"}], "x_groq": {"usage": usage}}
+        await resp.write(f"data: {json.dumps(last)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def dictionary(self, request: web.Request) -> web.Response:
+        if not await self.profiles["dict"].apply():
+            return web.Response(status=self.profiles["dict"].error_status)
+        word = request.match_info["word"]
+        base = f"{request.scheme}://{request.host}"
+        return web.json_response([{
+            "word": word,
+            "phonetics": [{"text": f"/{word}/", "audio": f"{base}/media/{word}.mp3"}],
+            "meanings": [{"definitions": [{"definition": f"A test definition of {word}."}]}],
+        }])
+
+    async def translate(self, request: web.Request) -> web.Response:
+        if not await self.profiles["translate"].apply():
+            return web.Response(status=self.profiles["translate"].error_status)
+        return web.json_response([[[f"{request.query.get('q', '')} (uz)", request.query.get("q", "")]]])
+
+    async def media(self, request: web.Request) -> web.Response:
+        if not await self.profiles["media"].apply():
+            return web.Response(status=self.profiles["media"].error_status)
+        return web.Response(body=b"ID3" + os.urandom(4 * 1024), content_type="audio/mpeg")
+
+
+# ======================
+# SIMULYATSIYA
+# ======================
+class Recorder:
+    def __init__(self):
+        self.latency = {}       # handler -> [sekund]
+        self.failures = {}
+        self.updates = 0
+        self.eval_started = {}  # chat_id -> [t0, ...]
+        self.eval_e2e = []
+
+    def observe(self, handler, seconds, ok=True):
+        self.updates += 1
+        self.latency.setdefault(handler, []).append(seconds)
+        if not ok:
+            self.failures[handler] = self.failures.get(handler, 0) + 1
+
+    def on_message(self, chat_id, text):
+        # worker natijani yuborganda baholash tugagan hisoblanadi
+        if "To‘g‘rilangan eng yaxshi variant" in text and self.eval_started.get(chat_id):
+            self.eval_e2e.append(time.perf_counter() - self.eval_started[chat_id].pop(0))
+
+
+class SimUser:
+    def __init__(self, main, rec: Recorder, user_id: int, update_ids, think: float):
+        self.main = main
+        self.rec = rec
+        self.user_id = user_id
+        self.update_ids = update_ids
+        self.think = think
+        self.msg_ids = itertools.count(1)
+
+    async def send(self, handler: str, text: str = None, voice_id: str = None):
+        from aiogram.types import Chat, Message, Update, User, Voice
+
+        msg = Message(
+            message_id=next(self.msg_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=self.user_id, type="private"),
+            from_user=User(id=self.user_id, is_bot=False, first_name="sim"),
+            text=text,
+            voice=Voice(file_id=voice_id, file_unique_id=voice_id, duration=5) if voice_id else None,
+        )
+        update = Update(update_id=next(self.update_ids), message=msg)
+        t0 = time.perf_counter()
+        ok = True
+        try:
+            await self.main.dp.feed_update(self.main.bot, update)
+        except Exception as e:
+            ok = False
+            print(f"{handler} ERROR:", repr(e))
+        self.rec.observe(handler, time.perf_counter() - t0, ok)
+        if self.think:
+            await asyncio.sleep(random.uniform(0, 2 * self.think))
+
+    async def speaking(self):
+        await self.send("speaking.start", text="🗣 Speaking")
+        for i in range(3):
+            if i == 2:
+                self.rec.eval_started.setdefault(self.user_id, []).append(time.perf_counter())
+            await self.send(f"speaking.voice{i + 1}", voice_id=f"v{self.user_id}_{random.getrandbits(32)}")
+
+    async def dictionary(self):
+        await self.send("dictionary.start", text="📚 Dictionary")
+        for word in random.sample(WORDS, 3):
+            await self.send("dictionary.word", text=word)
+        await self.send("back", text="⬅️ Orqaga")
+
+    async def writing(self):
+        await self.send("writing.start", text="✍️ Writing")
+        parts = [" ".join(random.choice(SENTENCES) for _ in range(n)) for n in (4, 8, 12)]
+        text = "\n".join(f"{i + 1}) {p} (user {self.user_id})" for i, p in enumerate(parts))
+        self.rec.eval_started.setdefault(self.user_id, []).append(time.perf_counter())
+        await self.send("writing.submit", text=text)
+
+    async def run(self, flows, rounds: int):
+        for _ in range(rounds):
+            for flow in flows:
+                await getattr(self, flow)()
+
+
+async def measure_loop_lag(samples, interval: float = 0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - t0 - interval))
+
+
+def parse_kv(items, cast):
+    out = {}
+    for item in items or []:
+        key, _, value = item.partition("=")
+        if key not in SERVICES:
+            raise SystemExit(f"noma'lum servis: {key} ({', '.join(SERVICES)})")
+        out[key] = cast(value)
+    return out
+
+
+def report(rec: Recorder, elapsed: float, lag, profiles, drain: float):
+    print(f"\nUpdates: {rec.updates} in {elapsed:.2f}s -> {rec.updates / elapsed:.1f} msgs/sec")
+    print(f"\n{'handler':<20} {'n':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for handler in sorted(rec.latency):
+        v = rec.latency[handler]
+        print(f"{handler:<20} {len(v):>6} {rec.failures.get(handler, 0):>5} {pct(v, 50) * 1000:>9.1f} "
+              f"{pct(v, 95) * 1000:>9.1f} {pct(v, 99) * 1000:>9.1f} {max(v) * 1000:>9.1f}")
+    if rec.eval_e2e:
+        v = rec.eval_e2e
+        print(f"{'evaluation e2e':<20} {len(v):>6} {'':>5} {pct(v, 50) * 1000:>9.1f} "
+              f"{pct(v, 95) * 1000:>9.1f} {pct(v, 99) * 1000:>9.1f} {max(v) * 1000:>9.1f}")
+    print(f"\nQueue drain after last update: {drain:.2f}s")
+    if lag:
+        print(f"Event loop lag: p50={pct(lag, 50) * 1000:.1f}ms p99={pct(lag, 99) * 1000:.1f}ms "
+              f"max={max(lag) * 1000:.1f}ms mean={statistics.mean(lag) * 1000:.1f}ms")
+    print("\nUpstream calls: " + ", ".join(f"{k}={p.calls} (err {p.errors})" for k, p in profiles.items()))
+
+
+async def run(args):
+    profiles = {name: Profile() for name in SERVICES}
+    for name, ms in parse_kv(args.latency, float).items():
+        profiles[name].latency_ms = ms
+    for name, rate in parse_kv(args.error_rate, float).items():
+        profiles[name].error_rate = rate
+    fake = FakeUpstreams(profiles)
+
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base = f"http://127.0.0.1:{port}"
+
+    # main import qilinishidan oldin: hamma tashqi manzil lokal serverga
+    tmp = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update({
+        "BOT_TOKEN": FAKE_TOKEN,
+        "TELEGRAM_API_BASE": base,
+        "GROQ_BASE": f"{base}/groq",
+        "GROQ_API_KEY": "loadtest",
+        "DICT_API_BASE": f"{base}/dict",
+        "TRANSLATE_URL": f"{base}/translate",
+        "DATA_DB": os.path.join(tmp, "bot_data.db"),
+        "EVENTS_DIR": os.path.join(tmp, "events"),
+        "FSM_STORAGE": os.environ.get("FSM_STORAGE", "memory"),
+        "STT_UPLOAD_FORMAT": os.environ.get("STT_UPLOAD_FORMAT", "ogg"),  # ffmpeg siz ham ishlaydi
+        "VAD_ENABLED": os.environ.get("VAD_ENABLED", "0"),  # soxta media PCM ga aylanmaydi
+        "RATE_LIMIT_RATE": os.environ.get("RATE_LIMIT_RATE", "1000"),
+        "RATE_LIMIT_BURST": os.environ.get("RATE_LIMIT_BURST", "1000"),
+        "HEAVY_QUEUE_MAX": os.environ.get("HEAVY_QUEUE_MAX", "100000"),
+        "JOB_QUEUE_MAX": os.environ.get("JOB_QUEUE_MAX", "100000"),
+    })
+    import main
+
+    rec = Recorder()
+    fake.on_message = rec.on_message
+    lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag))
+    flusher = asyncio.create_task(main.stats_flusher())
+    event_writer = asyncio.create_task(main.event_log.run())
+    workers = main.start_eval_workers()
+
+    flows = [f.strip() for f in args.flows.split(",") if f.strip()]
+    update_ids = itertools.count(1)
+    users = [SimUser(main, rec, 10_000_000 + i, update_ids, args.think / 1000) for i in range(args.users)]
+    print(f"{args.users} users x {args.rounds} rounds, flows={','.join(flows)}, stand-ins at {base}")
+    try:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(u.run(flows, args.rounds) for u in users))
+        elapsed = time.perf_counter() - t0
+
+        # navbatdagi baholashlar tugashini kutamiz
+        t1 = time.perf_counter()
+        while time.perf_counter() - t1 < args.drain_timeout:
+            counts = await main.db_run(main._job_counts)
+            if not counts.get("pending") and not counts.get("running"):
+                break
+            await asyncio.sleep(0.2)
+        drain = time.perf_counter() - t1
+        report(rec, elapsed, lag, profiles, drain)
+    finally:
+        for task in [lag_task, flusher, event_writer, *workers]:
+            task.cancel()
+        await asyncio.gather(lag_task, flusher, event_writer, *workers, return_exceptions=True)
+        main.flush_stats_sync()
+        main.event_log.close_sync()
+        await main.dp.storage.close()
+        await main.bot.session.close()
+        await main.close_http()
+        main.close_db()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50, help="bir vaqtdagi simulyatsiya userlari")
+    ap.add_argument("--rounds", type=int, default=2, help="har user oqimlarni necha marta takrorlaydi")
+    ap.add_argument("--flows", default="speaking,dictionary,writing")
+    ap.add_argument("--think", type=float, default=0, help="xabarlar orasidagi o‘rtacha pauza, ms")
+    ap.add_argument("--latency", action="append", metavar="SERVICE=MS",
+                    help=f"servis kechikishi ({', '.join(SERVICES)}); bir necha marta berish mumkin")
+    ap.add_argument("--error-rate", action="append", metavar="SERVICE=P", help="xato ehtimoli, 0..1")
+    ap.add_argument("--drain-timeout", type=float, default=120)
+    asyncio.run(run(ap.parse_args()))
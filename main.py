@@ -2,25 +2,53 @@ import os
 import re
 import json
 import asyncio
-import tempfile
 import random
-from typing import List, Dict, Tuple, Optional
-from threading import Thread
-
-import requests
-from flask import Flask
-from pydub import AudioSegment
-
-from aiogram import Bot, Dispatcher, F
+import time
+import hashlib
+import bisect
+import csv
+import io
+import zipfile
+import signal
+import sqlite3
+import threading
+import math
+import operator
+import sys
+import wave
+import warnings
+from array import array
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, List, Dict, Tuple, Optional
+
+import aiohttp
+from aiohttp import web
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
     Message, CallbackQuery,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
-    FSInputFile
+    BufferedInputFile
 )
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop  # Python 3.13 da yo‘q -> sof Python RMS
+    except ImportError:
+        audioop = None
 
 
 # ======================
@@ -34,7 +62,30 @@ CHANNEL_URL = "https://t.me/speakingzoneway"
 
 PORT = int(os.getenv("PORT", "10000"))
 
-GROQ_BASE = "https://api.groq.com/openai/v1"
+# Webhook: WEBHOOK_URL berilsa polling o‘rniga webhook ishlaydi
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+# Bir vaqtda ishlanadigan update lar soni (polling va webhook uchun)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+GROQ_BASE = os.getenv("GROQ_BASE", "https://api.groq.com/openai/v1").rstrip("/")
+DICT_API_BASE = os.getenv("DICT_API_BASE", "https://api.dictionaryapi.dev/api/v2/entries/en").rstrip("/")
+TRANSLATE_URL = os.getenv("TRANSLATE_URL", "https://translate.googleapis.com/translate_a/single")
+# lokal Bot API server yoki load test stand-in uchun (bo‘sh = api.telegram.org)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "").rstrip("/")
+
+# HTTP: umumiy pool + har bir upstream uchun parallel limit va timeout
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "20"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))
+UPSTREAMS = {
+    # nom: (parallel limit, timeout sekund)
+    "groq": (int(os.getenv("GROQ_CONCURRENCY", "8")), float(os.getenv("GROQ_TIMEOUT", "60"))),
+    "dict": (int(os.getenv("DICT_CONCURRENCY", "16")), float(os.getenv("DICT_TIMEOUT", "15"))),
+    "translate": (int(os.getenv("TRANSLATE_CONCURRENCY", "16")), float(os.getenv("TRANSLATE_TIMEOUT", "15"))),
+    "media": (int(os.getenv("MEDIA_CONCURRENCY", "8")), float(os.getenv("MEDIA_TIMEOUT", "30"))),
+}
 
 # Model fallback (decommission bo‘lsa keyingisiga o‘tadi)
 GROQ_CHAT_MODELS = [
@@ -44,36 +95,863 @@ GROQ_CHAT_MODELS = [
     "llama3-8b-8192",
 ]
 
+# ffmpeg: alohida jarayonlar, pipe orqali (disk ishlatilmaydi)
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 2)))
+TRANSCODE_QUEUE_MAX = int(os.getenv("TRANSCODE_QUEUE_MAX", "32"))
+TRANSCODE_TIMEOUT = float(os.getenv("TRANSCODE_TIMEOUT", "30"))
+
+# STT ga yuboriladigan format: auto | ogg | flac | wav
+# auto = endpoint qabul qiladigan eng arzon format (ogg -> flac -> wav)
+STT_UPLOAD_FORMAT = os.getenv("STT_UPLOAD_FORMAT", "auto").strip().lower()
+
+# VAD: STT dan oldin jimlikni kesish (energiya bo‘yicha, faqat CPU)
+VAD_ENABLED = os.getenv("VAD_ENABLED", "1") == "1"
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "30"))
+VAD_MARGIN_DB = float(os.getenv("VAD_MARGIN_DB", "10"))    # shovqin sathidan yuqori
+VAD_MIN_DB = float(os.getenv("VAD_MIN_DB", "-50"))         # cho‘qqi bundan past = nutq yo‘q (dBFS)
+VAD_MIN_RANGE_DB = float(os.getenv("VAD_MIN_RANGE_DB", "6"))  # shovqin-cho‘qqi farqi kamroq = kesilmaydi
+VAD_HANGOVER_MS = int(os.getenv("VAD_HANGOVER_MS", "200"))
+VAD_MAX_PAUSE = float(os.getenv("VAD_MAX_PAUSE", "1.0"))   # bundan uzun pauza qisqartiriladi
+VAD_KEEP_PAUSE = float(os.getenv("VAD_KEEP_PAUSE", "0.4"))  # ... shu uzunlikkacha
+VAD_MIN_SPEECH = float(os.getenv("VAD_MIN_SPEECH", "0.5"))  # bundan kam topilsa ishonchsiz: kesilmaydi
+# Speaking javobi: kesilgandan keyingi nutq va xom voice (yuklab olishdan oldin) chegarasi
+SPEAKING_MAX_SECONDS = float(os.getenv("SPEAKING_MAX_SECONDS", "120"))
+SPEAKING_MAX_VOICE_SECONDS = int(os.getenv("SPEAKING_MAX_VOICE_SECONDS", "300"))
+
+# Obuna holati keshi (sekund); salbiy natija qisqaroq saqlanadi
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", "300"))
+SUB_CACHE_NEG_TTL = float(os.getenv("SUB_CACHE_NEG_TTL", "20"))
+SUB_CACHE_MAX = int(os.getenv("SUB_CACHE_MAX", "50000"))
+
+# Model router: breaker va hedged so‘rovlar
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.3"))
+ROUTER_BREAKER_FAILS = int(os.getenv("ROUTER_BREAKER_FAILS", "3"))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", "30"))
+ROUTER_DEAD_MODEL_COOLDOWN = float(os.getenv("ROUTER_DEAD_MODEL_COOLDOWN", "3600"))
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "0") == "1"
+ROUTER_HEDGE_FACTOR = float(os.getenv("ROUTER_HEDGE_FACTOR", "2.0"))
+ROUTER_HEDGE_MIN_DELAY = float(os.getenv("ROUTER_HEDGE_MIN_DELAY", "8"))
+
+# Admission: har user uchun token bucket + og‘ir ishlar (STT/baholash/dictionary) uchun umumiy limit
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "1.0"))    # token/sekund
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "8"))
+HEAVY_CONCURRENCY = int(os.getenv("HEAVY_CONCURRENCY", "16"))
+HEAVY_QUEUE_MAX = int(os.getenv("HEAVY_QUEUE_MAX", "200"))     # bundan chuqur navbat bo‘lsa rad etiladi
+
 ADMIN_IDS = {858726164, 1593591147}
 
-STATS_FILE = "stats.json"
+# SQLite: keshlar va boshqa doimiy ma'lumotlar (users.db yonida)
+DATA_DB = os.getenv("DATA_DB", "bot_data.db")
+DICT_CACHE_TTL = float(os.getenv("DICT_CACHE_TTL_DAYS", "30")) * 86400
+DICT_CACHE_MAX = int(os.getenv("DICT_CACHE_MAX", "20000"))
+# FSM storage: sqlite (default) | memory | redis://host:port/db
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").strip()
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))  # tashlab ketilgan imtihonlar o‘chadi
+
+# Baholashni stream qilib, natijani maydonlar tayyor bo‘lishi bilan ko‘rsatish
+EVAL_STREAM = os.getenv("EVAL_STREAM", "1") == "1"
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "1.0"))
+
+# API ning JSON response_format rejimi (stream qilinmagan chaqiruvlarda) + sxema tekshiruvi
+EVAL_JSON_MODE = os.getenv("EVAL_JSON_MODE", "1") == "1"
+
+# Baholash navbati (SQLite): ROLE = all | bot | worker
+ROLE = os.getenv("ROLE", "all").strip().lower()
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_LEASE = float(os.getenv("JOB_LEASE", "120"))        # worker yiqilsa shu vaqtdan keyin ish qayta olinadi
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "1000"))
+# tugagan (done/failed) ishlar payload i bilan shuncha saqlanadi, keyin o‘chiriladi
+JOB_RETENTION = float(os.getenv("JOB_RETENTION_HOURS", "72")) * 3600
+JOB_PURGE_INTERVAL = float(os.getenv("JOB_PURGE_INTERVAL", "3600"))
+
+# Baholash natijalari keshi (bir xil topshiriq qayta kelsa LLM chaqirilmaydi)
+EVAL_CACHE_TTL = float(os.getenv("EVAL_CACHE_TTL", str(6 * 3600)))
+EVAL_CACHE_MAX = int(os.getenv("EVAL_CACHE_MAX", "2000"))
+EVAL_CACHE_PERSIST = os.getenv("EVAL_CACHE_PERSIST", "1") == "1"
+
+# Token budjeti: taxminiy hisob, katta matnlarni qisqartirish, to‘liq rewrite o‘rniga tuzatishlar, kvotalar
+EVAL_MAX_INPUT_TOKENS = int(os.getenv("EVAL_MAX_INPUT_TOKENS", "3000"))  # foydalanuvchi matnlari uchun jami
+EVAL_CORRECTION = os.getenv("EVAL_CORRECTION", "edits").strip().lower()  # edits | full
+EVAL_MAX_EDITS = int(os.getenv("EVAL_MAX_EDITS", "15"))
+TOKEN_QUOTA_USER_DAILY = int(os.getenv("TOKEN_QUOTA_USER_DAILY", "0"))    # 0 = cheklanmagan
+TOKEN_QUOTA_MODEL_DAILY = int(os.getenv("TOKEN_QUOTA_MODEL_DAILY", "0"))  # masalan free tier kunlik limiti
+
+# Batch writing (o‘qituvchilar): butun sinf insholari bitta faylda yoki xabarlar ketma-ketligida
+TEACHER_IDS = {int(x) for x in re.findall(r"\d+", os.getenv("TEACHER_IDS", ""))}
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))  # jarayon bo‘yicha bir vaqtda baholanadigan batch ishlari
+BATCH_QUEUE_MAX = int(os.getenv("BATCH_QUEUE_MAX", "5000"))     # navbatdagi batch ishlari (oddiy navbatdan alohida)
+BATCH_RESERVE = int(os.getenv("BATCH_RESERVE", "4"))  # og‘ir slotlardan shunchasi doim oddiy userlar uchun
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_MB", "15")) * 1024 * 1024
+BATCH_PROGRESS_TTL = float(os.getenv("BATCH_PROGRESS_TTL", "600"))  # jim turgan progress xabari xotiradan chiqadi
+
+# Lokal pre-scoring: bo‘sh / juda qisqa / mavzudan tashqari javoblar LLM siz baholanadi
+PRESCORE_SKIP = os.getenv("PRESCORE_SKIP", "1") == "1"
+PRESCORE_MIN_RATIO = float(os.getenv("PRESCORE_MIN_RATIO", "0.3"))  # talab qilingan so‘zlarning ulushi
+SPEAKING_MIN_WORDS = 30  # bitta speaking javobi uchun kutilgan so‘z soni
+SPEAKING_FLOOR_WORDS = 4  # shundan qisqa speaking javobi (o‘rtacha) LLM siz "too_short"; A1/A2 javoblari qisqa bo‘ladi
+
+# Dictionary javobi uchun umumiy muddat: shundan keyin bor natija yuboriladi
+DICT_DEADLINE = float(os.getenv("DICT_DEADLINE", "8"))
+
+STATS_FILE = "stats.json"  # eski format, bir marta SQLite ga ko‘chiriladi
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+STATS_FLUSH_THRESHOLD = int(os.getenv("STATS_FLUSH_THRESHOLD", "200"))
 stats = {"exams_completed": {}, "dict_lookups": {}, "writings_completed": {}}
 
+# Admin analytics
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "40"))
+ANALYTICS_TZ_HOURS = float(os.getenv("ANALYTICS_TZ_HOURS", "5"))  # Toshkent
+ANALYTICS_TOP_K = 10
+
+# Hodisalar jurnali (JSONL segmentlar): har imtihon/lookup/writing alohida yoziladi
+EVENTS_DIR = os.getenv("EVENTS_DIR", "events")
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "1"))
+EVENTS_FLUSH_BATCH = int(os.getenv("EVENTS_FLUSH_BATCH", "500"))
+EVENTS_SEGMENT_BYTES = int(os.getenv("EVENTS_SEGMENT_MB", "8")) * 1024 * 1024
+EVENTS_FSYNC = os.getenv("EVENTS_FSYNC", "1") == "1"
+EVENTS_COMPACT_INTERVAL = float(os.getenv("EVENTS_COMPACT_INTERVAL", "600"))
+EVENTS_COMPACT_GRACE = float(os.getenv("EVENTS_COMPACT_GRACE", "3600"))  # yarim tundan keyin kech kelganlar uchun
+
+# /metrics (Prometheus text format); token berilsa "Authorization: Bearer <token>" talab qilinadi
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+
+
+# ======================
+# SQLITE (bitta ulanish, so‘rovlar alohida threadda)
+# ======================
+_db_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.Lock()
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dict_cache (
+    word TEXT PRIMARY KEY,
+    ipa TEXT,
+    definition TEXT,
+    audio_url TEXT,
+    uz TEXT,
+    created_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dict_cache_used ON dict_cache(used_at);
+
+CREATE TABLE IF NOT EXISTS stats (
+    section TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (section, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_expires ON fsm(expires_at);
+
+CREATE TABLE IF NOT EXISTS eval_cache (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS eval_cache_created ON eval_cache(created_at);
+
+CREATE TABLE IF NOT EXISTS eval_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    dedupe_key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_run_at REAL NOT NULL,
+    locked_by TEXT,
+    locked_until REAL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS eval_jobs_active
+    ON eval_jobs(dedupe_key) WHERE status IN ('pending', 'running');
+CREATE INDEX IF NOT EXISTS eval_jobs_next ON eval_jobs(status, next_run_at);
+CREATE INDEX IF NOT EXISTS eval_jobs_updated ON eval_jobs(status, updated_at);
+
+-- batch: har ishi eval_jobs da kind='batch_item' (dedupe_key = batch:<id>:<idx>)
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    progress_message_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS batches_user ON batches(user_id, status);
+
+CREATE TABLE IF NOT EXISTS batch_results (
+    batch_id INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    item_id TEXT NOT NULL,
+    result TEXT,
+    PRIMARY KEY (batch_id, idx)
+);
+
+CREATE TABLE IF NOT EXISTS activity (
+    day TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (day, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    until REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS event_rollups (
+    day TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (day, kind)
+);
+
+CREATE TABLE IF NOT EXISTS token_usage (
+    day TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    calls INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, user_id, model)
+);
+
+CREATE TABLE IF NOT EXISTS media_files (
+    url_hash TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+def db_conn() -> sqlite3.Connection:
+    global _db_conn
+    if _db_conn is None:
+        conn = sqlite3.connect(DATA_DB, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(DB_SCHEMA)
+        _db_conn = conn
+    return _db_conn
+
+def _db_call(fn, *args):
+    with _db_lock:
+        return fn(db_conn(), *args)
+
+async def db_run(fn, *args):
+    # fn(conn, *args) event loopdan tashqarida bajariladi
+    return await asyncio.to_thread(_db_call, fn, *args)
+
+def close_db():
+    global _db_conn
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+
+
+# ======================
+# STATS (xotirada yig‘iladi, SQLite ga batch bilan yoziladi)
+# ======================
+_stats_pending: Dict[Tuple[str, str], int] = {}
+_stats_flush_event: Optional[asyncio.Event] = None
+
+def _stats_load(conn) -> Dict[str, Dict[str, int]]:
+    out: Dict[str, Dict[str, int]] = {}
+    for section, uid, count in conn.execute("SELECT section, user_id, count FROM stats"):
+        out.setdefault(section, {})[uid] = count
+    return out
+
+def _stats_write(conn, deltas: List[Tuple[str, str, int]], activity=()):
+    # bitta tranzaksiya: yarim yozilgan holat qolmaydi
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(
+            "INSERT INTO stats (section, user_id, count) VALUES (?, ?, ?) "
+            "ON CONFLICT(section, user_id) DO UPDATE SET count = count + excluded.count",
+            deltas,
+        )
+        conn.executemany("INSERT OR IGNORE INTO activity (day, user_id) VALUES (?, ?)", activity)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
 
 def load_stats():
     global stats
     try:
-        if os.path.exists(STATS_FILE):
+        loaded = _db_call(_stats_load)
+        if not loaded and os.path.exists(STATS_FILE):
             with open(STATS_FILE, "r", encoding="utf-8") as f:
-                stats = json.load(f)
-    except Exception:
-        pass
+                old = json.load(f)
+            deltas = [(sec, uid, int(n)) for sec, users in old.items() for uid, n in users.items()]
+            _db_call(_stats_write, deltas)
+            os.replace(STATS_FILE, STATS_FILE + ".migrated")
+            loaded = _db_call(_stats_load)
+        for section, users in loaded.items():
+            stats.setdefault(section, {}).update(users)
+        analytics.rebuild(stats, _db_call(_activity_load, analytics.days_back(7)))
+    except Exception as e:
+        print("STATS LOAD ERROR:", repr(e))
 
+def _stats_snapshot(conn, since_day: str):
+    return _stats_load(conn), _activity_load(conn, since_day)
 
-def save_stats():
+async def refresh_stats():
+    # ROLE=bot + ROLE=worker: tugallanishlarni boshqa jarayon yozadi, xotiradagi yig‘indi eskiradi
+    await flush_stats()
     try:
-        with open(STATS_FILE, "w", encoding="utf-8") as f:
-            json.dump(stats, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
-
+        loaded, activity = await db_run(_stats_snapshot, analytics.days_back(7))
+    except Exception as e:
+        print("STATS REFRESH ERROR:", repr(e))
+        return
+    # flush dan keyin kelgan (hali yozilmagan) o‘sishlar ustiga qo‘shiladi
+    for (section, uid), n in _stats_pending.items():
+        users = loaded.setdefault(section, {})
+        users[uid] = users.get(uid, 0) + n
+    for section in list(stats):
+        stats[section] = loaded.pop(section, {})
+    stats.update(loaded)
+    analytics.rebuild(stats, activity)
 
 def inc_stat(section: str, user_id: int, amount: int = 1):
+    # O(1): faqat xotira; diskka flush_stats yozadi
     uid = str(user_id)
     if section not in stats:
         stats[section] = {}
     stats[section][uid] = int(stats[section].get(uid, 0)) + amount
-    save_stats()
+    key = (section, uid)
+    _stats_pending[key] = _stats_pending.get(key, 0) + amount
+    analytics.on_increment(section, uid, amount)
+    if len(_stats_pending) >= STATS_FLUSH_THRESHOLD and _stats_flush_event is not None:
+        _stats_flush_event.set()
+
+def _take_pending() -> Tuple[List[Tuple[str, str, int]], List[Tuple[str, str]]]:
+    deltas = [(sec, uid, n) for (sec, uid), n in _stats_pending.items()]
+    _stats_pending.clear()
+    return deltas, analytics.take_activity()
+
+def _restore_pending(deltas: List[Tuple[str, str, int]], activity: List[Tuple[str, str]]):
+    for sec, uid, n in deltas:
+        _stats_pending[(sec, uid)] = _stats_pending.get((sec, uid), 0) + n
+    analytics.pending_activity.update(activity)
+
+async def flush_stats():
+    deltas, activity = _take_pending()
+    if deltas or activity:
+        try:
+            await db_run(_stats_write, deltas, activity)
+        except Exception as e:
+            print("STATS FLUSH ERROR:", repr(e))
+            _restore_pending(deltas, activity)
+    await token_ledger.flush()
+
+def flush_stats_sync():
+    deltas, activity = _take_pending()
+    if deltas or activity:
+        try:
+            _db_call(_stats_write, deltas, activity)
+        except Exception as e:
+            print("STATS FLUSH ERROR:", repr(e))
+    token_ledger.flush_sync()
+
+async def stats_flusher():
+    global _stats_flush_event
+    _stats_flush_event = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(_stats_flush_event.wait(), STATS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _stats_flush_event.clear()
+        await flush_stats()
+        sweep_speaking_sessions()
+
+
+# ======================
+# ANALYTICS (hodisa bo‘yicha yangilanadigan yig‘indilar)
+# ======================
+# jadval ustunlari: (stats bo‘limi, sarlavha)
+ADMIN_COLUMNS = [
+    ("exams_completed", "Speaking"),
+    ("dict_lookups", "Dictionary"),
+    ("writings_completed", "Writing"),
+]
+# funnel: boshlangan -> tugagan
+FUNNELS = [
+    ("Speaking", "speaking_started", "exams_completed"),
+    ("Writing", "writing_started", "writings_completed"),
+]
+
+def _activity_load(conn, since_day: str) -> List[Tuple[str, str]]:
+    return conn.execute("SELECT day, user_id FROM activity WHERE day>=?", (since_day,)).fetchall()
+
+
+class Analytics:
+    # Hammasi inc_stat orqali O(1)/O(K) da yangilanadi; /admin faqat tayyorini o‘qiydi.
+    def __init__(self, top_k: int):
+        self.top_k = top_k
+        self.totals: Dict[str, int] = {}
+        self.user_totals: Dict[str, int] = {}
+        self.sorted_uids: List[int] = []
+        self.top: Dict[str, int] = {}
+        self.active_days: Dict[str, set] = {}
+        self.pending_activity: set = set()
+
+    @staticmethod
+    def day(ts: Optional[float] = None) -> str:
+        t = (ts if ts is not None else time.time()) + ANALYTICS_TZ_HOURS * 3600
+        return time.strftime("%Y-%m-%d", time.gmtime(t))
+
+    def days_back(self, n: int) -> str:
+        return self.day(time.time() - (n - 1) * 86400)
+
+    def rebuild(self, all_stats: Dict[str, Dict[str, int]], activity: List[Tuple[str, str]]):
+        # ishga tushishda va /admin da DB dan qayta quriladi (worker jarayonlari ham shu DB ga yozadi)
+        self.totals.clear()
+        self.user_totals.clear()
+        self.active_days.clear()
+        for section, users in all_stats.items():
+            self.totals[section] = sum(int(n) for n in users.values())
+            if section in dict(ADMIN_COLUMNS):
+                for uid, n in users.items():
+                    self.user_totals[uid] = self.user_totals.get(uid, 0) + int(n)
+        self.sorted_uids = sorted({int(u) for users in all_stats.values() for u in users})
+        self.top = dict(sorted(self.user_totals.items(), key=lambda kv: -kv[1])[:self.top_k])
+        for day, uid in list(activity) + list(self.pending_activity):
+            self.active_days.setdefault(day, set()).add(uid)
+
+    def on_increment(self, section: str, uid: str, amount: int):
+        self.totals[section] = self.totals.get(section, 0) + amount
+
+        iuid = int(uid)
+        i = bisect.bisect_left(self.sorted_uids, iuid)
+        if i == len(self.sorted_uids) or self.sorted_uids[i] != iuid:
+            self.sorted_uids.insert(i, iuid)
+
+        today = self.day()
+        day_set = self.active_days.setdefault(today, set())
+        if uid not in day_set:
+            day_set.add(uid)
+            self.pending_activity.add((today, uid))
+            if len(self.active_days) > 8:
+                for old in sorted(self.active_days)[:-8]:
+                    del self.active_days[old]
+
+        if section not in dict(ADMIN_COLUMNS):
+            return
+        total = self.user_totals.get(uid, 0) + amount
+        self.user_totals[uid] = total
+        if uid in self.top or len(self.top) < self.top_k:
+            self.top[uid] = total
+        else:
+            low = min(self.top, key=self.top.get)
+            if total > self.top[low]:
+                del self.top[low]
+                self.top[uid] = total
+
+    def take_activity(self) -> List[Tuple[str, str]]:
+        out = list(self.pending_activity)
+        self.pending_activity.clear()
+        return out
+
+    def dau(self) -> int:
+        return len(self.active_days.get(self.day(), ()))
+
+    def wau(self) -> int:
+        since = self.days_back(7)
+        users = set()
+        for day, ids in self.active_days.items():
+            if day >= since:
+                users |= ids
+        return len(users)
+
+    def top_users(self) -> List[Tuple[str, int]]:
+        return sorted(self.top.items(), key=lambda kv: -kv[1])
+
+
+analytics = Analytics(ANALYTICS_TOP_K)
+
+
+# ======================
+# EVENT LOG (append-only JSONL segmentlar + kunlik rollup)
+# ======================
+# segment: <kun>.<host-pid>.<tartib>.jsonl — har jarayon o‘z fayliga yozadi
+_SEGMENT_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})\.([\w-]+)\.(\d+)\.jsonl$")
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    i = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[i]
+
+def rollup_events(events: List[Dict]) -> Dict[str, Dict]:
+    # kind -> {count, users, score, cefr, model, latency}
+    groups: Dict[str, List[Dict]] = {}
+    for ev in events:
+        groups.setdefault(ev.get("kind", "?"), []).append(ev)
+
+    out: Dict[str, Dict] = {}
+    for kind, evs in groups.items():
+        r: Dict[str, Any] = {"count": len(evs), "users": len({ev.get("user") for ev in evs})}
+        scores = sorted(ev["score"] for ev in evs if isinstance(ev.get("score"), (int, float)))
+        if scores:
+            r["score_avg"] = round(sum(scores) / len(scores), 1)
+            r["score_p50"] = percentile(scores, 50)
+        for field in ("cefr", "model"):
+            counts: Dict[str, int] = {}
+            for ev in evs:
+                if ev.get(field):
+                    counts[ev[field]] = counts.get(ev[field], 0) + 1
+            if counts:
+                r[field] = counts
+        latency: Dict[str, Dict[str, float]] = {}
+        for name in sorted({k for ev in evs for k in ev if k.endswith("_s")}):
+            vals = sorted(float(ev[name]) for ev in evs if isinstance(ev.get(name), (int, float)))
+            if vals:
+                latency[name] = {"p50": round(percentile(vals, 50), 3), "p95": round(percentile(vals, 95), 3),
+                                 "max": round(vals[-1], 3)}
+        if latency:
+            r["latency"] = latency
+        out[kind] = r
+    return out
+
+def _rollup_put(conn, day: str, rollup: Dict[str, Dict]):
+    conn.executemany(
+        "INSERT OR REPLACE INTO event_rollups (day, kind, data) VALUES (?, ?, ?)",
+        [(day, kind, json.dumps(r, ensure_ascii=False)) for kind, r in rollup.items()],
+    )
+
+def _lease_acquire(conn, name: str, holder: str, ttl: float) -> bool:
+    # bitta statement: bo‘sh yoki muddati o‘tgan lease ni oladi, o‘ziniki bo‘lsa uzaytiradi
+    now = time.time()
+    conn.execute(
+        "INSERT INTO leases (name, holder, until) VALUES (?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, until=excluded.until "
+        "WHERE leases.until<? OR leases.holder=excluded.holder",
+        (name, holder, now + ttl, now),
+    )
+    row = conn.execute("SELECT holder FROM leases WHERE name=?", (name,)).fetchone()
+    return bool(row) and row[0] == holder
+
+def _lease_release(conn, name: str, holder: str):
+    conn.execute("UPDATE leases SET until=0 WHERE name=? AND holder=?", (name, holder))
+
+def _rollup_get(conn, day: str) -> Dict[str, Dict]:
+    rows = conn.execute("SELECT kind, data FROM event_rollups WHERE day=?", (day,)).fetchall()
+    return {kind: json.loads(data) for kind, data in rows}
+
+
+class EventLog:
+    # Hot path faqat xotiradagi ro‘yxatga qo‘shadi; yozuvchi task partiyalab
+    # (group commit) alohida threadda diskka yozadi.
+    def __init__(self, directory: str):
+        self.directory = directory
+        node = os.uname().nodename if hasattr(os, "uname") else "local"
+        self.tag = re.sub(r"[^\w-]", "-", f"{node}-{os.getpid()}")
+        self.buffer: List[Dict] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self._file = None
+        self._file_day = ""
+        self._file_seq = 0
+        self._io_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.compacted_days = 0
+
+    def append(self, kind: str, user_id: int, **fields):
+        ev = {"ts": round(time.time(), 3), "kind": kind, "user": user_id}
+        ev.update({k: v for k, v in fields.items() if v is not None})
+        self.buffer.append(ev)
+        if len(self.buffer) >= EVENTS_FLUSH_BATCH and self.wakeup is not None:
+            self.wakeup.set()
+
+    # ---- disk (thread) ----
+    def _segments(self) -> List[Tuple[str, str, int, str]]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        out = []
+        for name in names:
+            m = _SEGMENT_RE.match(name)
+            if m:
+                out.append((m.group(1), m.group(2), int(m.group(3)), os.path.join(self.directory, name)))
+        return sorted(out)
+
+    def _open(self, day: str):
+        if self._file is not None:
+            self._file.close()
+        if day != self._file_day:
+            # qayta ishga tushganda eski segmentlar ustiga yozilmaydi
+            seqs = [seq for d, tag, seq, _ in self._segments() if d == day and tag == self.tag]
+            self._file_seq = max(seqs, default=-1)
+        self._file_seq += 1
+        self._file_day = day
+        path = os.path.join(self.directory, f"{day}.{self.tag}.{self._file_seq:04d}.jsonl")
+        self._file = open(path, "ab")
+
+    def _write(self, batch: List[Dict]):
+        with self._io_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            by_day: Dict[str, List[bytes]] = {}
+            for ev in batch:
+                line = json.dumps(ev, ensure_ascii=False, separators=(",", ":")) + "\n"
+                by_day.setdefault(Analytics.day(ev["ts"]), []).append(line.encode("utf-8"))
+            for day in sorted(by_day):
+                # rotatsiya: yangi kun yoki segment to‘lgan
+                if self._file is None or day != self._file_day or self._file.tell() >= EVENTS_SEGMENT_BYTES:
+                    self._open(day)
+                self._file.write(b"".join(by_day[day]))
+                self._file.flush()
+                if EVENTS_FSYNC:
+                    os.fsync(self._file.fileno())
+
+    def _read_day(self, day: str) -> List[Dict]:
+        events = []
+        for d, _, _, path in self._segments():
+            if d != day:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    for line in f:
+                        try:
+                            events.append(json.loads(line))
+                        except ValueError:
+                            pass  # yiqilishda yarim qolgan oxirgi qator
+            except FileNotFoundError:
+                pass  # boshqa jarayon siqib bo‘lgan
+        return events
+
+    def _compact(self):
+        # tugagan kunlar segmentlari bitta rollup ga aylanadi va o‘chiriladi.
+        # ROLE=bot va ROLE=worker birga ishlaganda faqat lease egasi siqadi:
+        # aks holda biri to‘liq rollup ni boshqasining chala rollup i bilan almashtiradi.
+        cutoff = Analytics.day(time.time() - EVENTS_COMPACT_GRACE)
+        days = sorted({d for d, _, _, _ in self._segments() if d < cutoff})
+        if not days or not _db_call(_lease_acquire, "events.compact", self.tag, EVENTS_COMPACT_INTERVAL):
+            return
+        try:
+            self._compact_days(days)
+        finally:
+            _db_call(_lease_release, "events.compact", self.tag)
+
+    def _compact_days(self, days: List[str]):
+        for day in days:
+            with self._io_lock:
+                if self._file is not None and self._file_day == day:
+                    self._file.close()
+                    self._file = None
+                    self._file_day = ""
+            events = self._read_day(day)
+            if events:
+                _db_call(_rollup_put, day, rollup_events(events))
+            for d, _, _, path in self._segments():
+                if d == day:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self.compacted_days += 1
+
+    def day_report(self, day: str) -> Dict[str, Dict]:
+        # siqilgan kun -> rollup; joriy kunlar -> segmentlardan hisoblanadi
+        events = self._read_day(day)
+        if events:
+            return rollup_events(events)
+        return _db_call(_rollup_get, day)
+
+    def close_sync(self):
+        batch, self.buffer = self.buffer, []
+        try:
+            if batch:
+                self._write(batch)
+                self.written += len(batch)
+        except Exception as e:
+            print("EVENT LOG ERROR:", repr(e))
+        with self._io_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # ---- event loop ----
+    async def flush(self):
+        batch, self.buffer = self.buffer, []
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write, batch)
+            self.written += len(batch)
+        except Exception as e:
+            print("EVENT LOG ERROR:", repr(e))
+            # disk muammosi: xotira cheksiz o‘smasin
+            if len(self.buffer) + len(batch) <= EVENTS_FLUSH_BATCH * 20:
+                self.buffer[:0] = batch
+            else:
+                self.dropped += len(batch)
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        next_compact = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), EVENTS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+            if time.monotonic() >= next_compact:
+                next_compact = time.monotonic() + EVENTS_COMPACT_INTERVAL
+                try:
+                    await asyncio.to_thread(self._compact)
+                except Exception as e:
+                    print("EVENT COMPACT ERROR:", repr(e))
+
+    def stats(self) -> Dict[str, int]:
+        return {"buffered": len(self.buffer), "written": self.written,
+                "dropped": self.dropped, "compacted_days": self.compacted_days}
+
+
+event_log = EventLog(EVENTS_DIR)
+
+
+# ======================
+# METRICS (histogram + counter, /metrics uchun)
+# ======================
+# sekundlarda; oxirgisidan kattalari +Inf ga tushadi
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+def _label_str(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: Dict[Tuple, float] = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        # label lar doim str: 200 va "timeout" bir seriyada saralanadi
+        label_values = tuple(str(v) for v in label_values)
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for lv, v in sorted(self.values.items()):
+            out.append(f"{self.name}{_label_str(self.labels, lv)} {v:g}")
+        return out
+
+class Histogram:
+    # observe(): bitta bisect + ikki qo‘shish; kumulyativ qiymatlar faqat render da
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series: Dict[Tuple, List] = {}  # labels -> [bucket sonlari, sum]
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        label_values = tuple(str(v) for v in label_values)
+        s = self.series.get(label_values)
+        if s is None:
+            s = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def time(self, *label_values) -> "Span":
+        return Span(self, label_values)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for lv, (counts, total) in sorted(self.series.items()):
+            acc = 0
+            for bound, n in zip(self.buckets, counts):
+                acc += n
+                le = 'le="%g"' % bound
+                out.append(f"{self.name}_bucket{_label_str(self.labels, lv, le)} {acc}")
+            acc += counts[-1]
+            le = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_label_str(self.labels, lv, le)} {acc}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, lv)} {total:.6f}")
+            out.append(f"{self.name}_count{_label_str(self.labels, lv)} {acc}")
+        return out
+
+class Span:
+    # with stage_seconds.time("stt.convert"): ...  — xato bo‘lsa stage_errors ham oshadi
+    __slots__ = ("hist", "label_values", "t0")
+
+    def __init__(self, hist: Histogram, label_values: Tuple):
+        self.hist = hist
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.hist.observe(time.perf_counter() - self.t0, *self.label_values)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            stage_errors.inc(*self.label_values)
+        return False
+
+METRICS: List[Any] = []
+
+stage_seconds = Histogram("bot_stage_seconds", "Handler stage latency", ("stage",))
+stage_errors = Counter("bot_stage_errors_total", "Stages that raised", ("stage",))
+update_seconds = Histogram("bot_update_seconds", "Update handling latency", ("type",))
+upstream_seconds = Histogram("bot_upstream_seconds", "Upstream HTTP latency", ("upstream",))
+upstream_requests = Counter("bot_upstream_requests_total", "Upstream HTTP requests", ("upstream", "status"))
+llm_seconds = Histogram("bot_llm_seconds", "Chat completion latency per model", ("model",))
+llm_requests = Counter("bot_llm_requests_total", "Chat completions per model and status", ("model", "status"))
+llm_tokens = Counter("bot_llm_tokens_total", "Tokens per model (prompt/completion)", ("model", "kind"))
+prescore_skips = Counter("bot_prescore_skips_total", "Evaluations answered locally without the LLM", ("kind", "reason"))
+vad_seconds = Counter("bot_vad_audio_seconds_total", "Voice audio seen by VAD (input/kept/removed)", ("kind",))
+vad_notes = Counter("bot_vad_notes_total", "Voice notes by VAD outcome", ("outcome",))
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for m in METRICS:
+        lines.extend(m.render())
+
+    # holat (gauge) lar: scrape paytida mavjud hisoblagichlardan
+    gauges = [
+        ("bot_heavy_active", heavy_gate.active),
+        ("bot_heavy_waiting", heavy_gate.waiting),
+        ("bot_heavy_shed_total", heavy_gate.shed),
+        ("bot_rate_limited_total", rate_limiter.dropped),
+        ("bot_transcode_pending", transcoder.pending),
+        ("bot_event_log_buffered", len(event_log.buffer)),
+    ]
+    for name, value in gauges:
+        lines.append(f"{name} {value}")
+    for name, cache in CACHES.items():
+        for key, value in cache.stats().items():
+            if isinstance(value, (int, float)):
+                lines.append(f'bot_cache_{key}{{cache="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
 
 
 # ======================
@@ -102,23 +980,6 @@ def ielts_from_cefr(cefr: str) -> str:
     }.get(cefr, "~3.0–3.5")
 
 
-# ======================
-# FLASK keep-alive (Render + UptimeRobot)
-# ======================
-app = Flask(__name__)
-
-@app.get("/")
-def home():
-    return "OK"
-
-@app.get("/health")
-def health():
-    return "healthy", 200
-
-def run_web():
-    app.run(host="0.0.0.0", port=PORT)
-
-
 # ======================
 # STATES
 # ======================
@@ -131,6 +992,9 @@ class DictionaryStates(StatesGroup):
 class WritingStates(StatesGroup):
     writing_text = State()
 
+class BatchStates(StatesGroup):
+    collecting = State()
+
 
 # ======================
 # QUESTION BANKS
@@ -179,6 +1043,13 @@ WRITING_PROMPTS = {
     ],
 }
 
+# task tartibi: (bank nomi, prompt shabloni)
+WRITING_TASKS = [
+    ("friend_50", {"task": 1, "type": "friend_message", "min_words": 50}),
+    ("manager_120", {"task": 2, "type": "manager_email", "min_words": 120}),
+    ("essay_200", {"task": 3, "type": "essay", "min_words": 180}),
+]
+
 
 # ======================
 # KEYBOARDS
@@ -208,27 +1079,436 @@ def back_menu() -> ReplyKeyboardMarkup:
     )
 
 
+# ======================
+# FSM STORAGE (sqlite / redis, TTL bilan)
+# ======================
+def pack_fsm_data(data: Dict) -> str:
+    # Savollar va writing topiclari bankdagi indeks sifatida saqlanadi.
+    out = dict(data)
+    qs = out.get("questions")
+    if isinstance(qs, list) and qs and all(q in SPEAKING_QUESTION_BANK for q in qs):
+        out["questions"] = {"qi": [SPEAKING_QUESTION_BANK.index(q) for q in qs]}
+    wp = out.get("writing_prompts")
+    if isinstance(wp, list) and len(wp) == len(WRITING_TASKS):
+        refs = []
+        for p, (bank, tpl) in zip(wp, WRITING_TASKS):
+            if not isinstance(p, dict) or p.get("prompt") not in WRITING_PROMPTS[bank]:
+                break
+            if {**tpl, "prompt": p["prompt"]} != p:
+                break
+            refs.append(WRITING_PROMPTS[bank].index(p["prompt"]))
+        else:
+            out["writing_prompts"] = {"wi": refs}
+    return json.dumps(out, ensure_ascii=False, separators=(",", ":"))
+
+def unpack_fsm_data(raw) -> Dict:
+    if not raw:
+        return {}
+    data = json.loads(raw)
+    # bank deploy orasida o‘zgargan bo‘lsa kalit tashlanadi (handlerlar buni ko‘taradi)
+    qs = data.get("questions")
+    if isinstance(qs, dict):
+        try:
+            data["questions"] = [SPEAKING_QUESTION_BANK[i] for i in qs["qi"]]
+        except (KeyError, IndexError, TypeError):
+            data.pop("questions")
+    wp = data.get("writing_prompts")
+    if isinstance(wp, dict):
+        try:
+            data["writing_prompts"] = [
+                {**tpl, "prompt": WRITING_PROMPTS[bank][i]}
+                for (bank, tpl), i in zip(WRITING_TASKS, wp["wi"])
+            ]
+        except (KeyError, IndexError, TypeError):
+            data.pop("writing_prompts")
+    return data
+
+
+class SQLiteStorage(BaseStorage):
+    # bot_data.db dagi `fsm` jadvali (WAL); har yozuv FSM_TTL dan keyin o‘chadi
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._writes = 0
+
+    @staticmethod
+    def _get(conn, key: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        return conn.execute(
+            "SELECT state, data FROM fsm WHERE key=? AND expires_at>=?", (key, time.time())
+        ).fetchone()
+
+    @staticmethod
+    def _set(conn, key: str, column: str, value: Optional[str], ttl: int):
+        now = time.time()
+        row = conn.execute(
+            "SELECT state, data FROM fsm WHERE key=? AND expires_at>=?", (key, now)
+        ).fetchone()
+        state, data = row if row else (None, None)
+        if column == "state":
+            state = value
+        else:
+            data = value
+        if state is None and not data:
+            conn.execute("DELETE FROM fsm WHERE key=?", (key,))
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO fsm (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+            (key, state, data, now + ttl),
+        )
+
+    @staticmethod
+    def _purge(conn):
+        conn.execute("DELETE FROM fsm WHERE expires_at<?", (time.time(),))
+
+    async def _write(self, key: StorageKey, column: str, value: Optional[str]):
+        await db_run(self._set, self.key_builder.build(key), column, value, self.ttl)
+        self._writes += 1
+        if self._writes % 500 == 0:
+            await db_run(self._purge)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._write(key, "state", value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await db_run(self._get, self.key_builder.build(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, "data", pack_fsm_data(data) if data else None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await db_run(self._get, self.key_builder.build(key))
+        return unpack_fsm_data(row[1]) if row else {}
+
+    async def close(self) -> None:
+        pass
+
+
+def make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError:
+            raise SystemExit("FSM_STORAGE=redis uchun `pip install redis` kerak.")
+        return RedisStorage.from_url(
+            FSM_STORAGE,
+            state_ttl=FSM_TTL,
+            data_ttl=FSM_TTL,
+            json_dumps=pack_fsm_data,
+            json_loads=unpack_fsm_data,
+        )
+    return SQLiteStorage(FSM_TTL)
+
+
 # ======================
 # BOT
 # ======================
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    def __init__(self, limit: int):
+        self.sem = asyncio.Semaphore(max(1, limit))
+
+    async def __call__(self, handler, event, data):
+        async with self.sem:
+            with update_seconds.time(event.event_type):
+                return await handler(event, data)
+
+
+# ======================
+# ADMISSION (rate limit + og‘ir ishlar navbati)
+# ======================
+class Overloaded(Exception):
+    pass
+
+class JobGate:
+    # Bir vaqtda `limit` ta og‘ir ish. Navbat userlar bo‘yicha round-robin
+    # (bitta user 10 ta ish yuborsa ham boshqalar orqada qolmaydi).
+    # Past prioritet (batch) faqat oddiy navbat bo‘sh bo‘lganda va `reserve` ta
+    # slotni oddiy userlarga qoldirib ishlaydi.
+    def __init__(self, limit: int, max_queue: int, reserve: int = 0):
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.low_limit = max(1, self.limit - reserve)
+        self.active = 0
+        self.waiting = 0
+        self.shed = 0
+        self.served = 0
+        self._queues: "OrderedDict[int, deque]" = OrderedDict()
+        self._low: deque = deque()
+
+    def _enqueue(self, user_id: int, low: bool = False) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        if low:
+            if self.active < self.low_limit and not self.waiting and not self._low:
+                self.active += 1
+                fut.set_result(None)
+            else:
+                self._low.append(fut)
+            return fut
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            fut.set_result(None)
+            return fut
+        if self.waiting >= self.max_queue:
+            self.shed += 1
+            raise Overloaded()
+        self._queues.setdefault(user_id, deque()).append(fut)
+        self.waiting += 1
+        return fut
+
+    def position(self, fut: asyncio.Future) -> int:
+        # round-robin tartibidagi o‘rin (1 dan)
+        qs = [list(q) for q in self._queues.values()]
+        pos = 0
+        for depth in range(max((len(q) for q in qs), default=0)):
+            for q in qs:
+                if depth < len(q):
+                    pos += 1
+                    if q[depth] is fut:
+                        return pos
+        return pos
+
+    def _remove(self, fut: asyncio.Future):
+        if fut in self._low:
+            self._low.remove(fut)
+            return
+        for uid, q in list(self._queues.items()):
+            if fut in q:
+                q.remove(fut)
+                self.waiting -= 1
+                if not q:
+                    del self._queues[uid]
+                return
+
+    def _release(self):
+        while self._queues:
+            uid, q = self._queues.popitem(last=False)
+            fut = q.popleft()
+            self.waiting -= 1
+            if q:
+                self._queues[uid] = q  # navbat oxiriga
+            if not fut.done():
+                fut.set_result(None)
+                return
+        while self._low and self.active <= self.low_limit:
+            fut = self._low.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, notify: Optional[Callable[[int], Awaitable[Any]]] = None,
+                   low: bool = False):
+        fut = self._enqueue(user_id, low)
+        if not fut.done():
+            try:
+                if notify is not None:
+                    try:
+                        await notify(self.position(fut))
+                    except Exception as e:
+                        print("QUEUE NOTIFY ERROR:", repr(e))
+                await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if fut.done():
+                    self._release()  # slot berilgan edi, keyingisiga o‘tkazamiz
+                else:
+                    self._remove(fut)
+                raise
+        self.served += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": self.active, "limit": self.limit, "waiting": self.waiting,
+                "users_waiting": len(self._queues), "low_waiting": len(self._low),
+                "served": self.served, "shed": self.shed}
+
+
+heavy_gate = JobGate(HEAVY_CONCURRENCY, HEAVY_QUEUE_MAX, BATCH_RESERVE)
+
+QUEUE_TEXT = "⏳ Navbatdasiz: #{pos}. Biroz kuting..."
+
+def queue_notifier(message: Message) -> Callable[[int], Awaitable[Any]]:
+    return lambda pos: message.answer(QUEUE_TEXT.format(pos=pos))
+
+def progress_notifier(progress: "ProgressMessage") -> Callable[[int], Awaitable[Any]]:
+    # fon ishlar: navbat o‘rni alohida xabar emas, ishning progress xabarida
+    return lambda pos: progress.update(QUEUE_TEXT.format(pos=pos), force=True)
+
+OVERLOADED_TEXT = "🚦 Hozir bot juda band. 1-2 daqiqadan keyin qayta urinib ko‘ring."
+
+
+class TokenBucketMiddleware(BaseMiddleware):
+    def __init__(self, rate: float, burst: float, max_users: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.dropped = 0
+        self._buckets: "OrderedDict[int, List[float]]" = OrderedDict()  # uid -> [tokens, t, warned_at]
+
+    def allow(self, user_id: int) -> Tuple[bool, bool]:
+        # (ruxsat, ogohlantirish kerakmi)
+        now = time.monotonic()
+        b = self._buckets.get(user_id)
+        if b is None:
+            b = [self.burst, now, 0.0]
+            self._buckets[user_id] = b
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        if b[0] >= 1:
+            b[0] -= 1
+            return True, False
+        self.dropped += 1
+        warn = now - b[2] > 10
+        if warn:
+            b[2] = now
+        return False, warn
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in ADMIN_IDS or user.id in TEACHER_IDS:
+            return await handler(event, data)
+        ok, warn = self.allow(user.id)
+        if ok:
+            return await handler(event, data)
+        if warn:
+            text = "⏳ Juda tez yuboryapsiz. Bir necha soniya kuting."
+            if isinstance(event, CallbackQuery):
+                await event.answer(text)
+            elif isinstance(event, Message):
+                await event.answer(text)
+        return None
+
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE)) if TELEGRAM_API_BASE else None,
+)
+dp = Dispatcher(storage=make_fsm_storage())
+dp.update.outer_middleware(ConcurrencyLimitMiddleware(UPDATE_CONCURRENCY))
+rate_limiter = TokenBucketMiddleware(RATE_LIMIT_RATE, RATE_LIMIT_BURST)
+dp.message.outer_middleware(rate_limiter)
+dp.callback_query.outer_middleware(rate_limiter)
+
+
+# ======================
+# CACHE (TTL + LRU, bir xil kalit uchun bitta so‘rov)
+# ======================
+class TTLCache:
+    def __init__(self, name: str, max_size: int):
+        self.name = name
+        self.max_size = max(1, max_size)
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Any, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        CACHES[name] = self
+
+    def get(self, key) -> Tuple[bool, Any]:
+        item = self._data.get(key)
+        if item is None:
+            return False, None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def set(self, key, value, ttl: float):
+        if ttl <= 0:
+            return  # keshlanmaydi
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    async def get_or_load(self, key, loader: Callable[[], Awaitable[Any]],
+                          ttl: Callable[[Any], float], force: bool = False):
+        if not force:
+            found, value = self.get(key)
+            if found:
+                self.hits += 1
+                return value
+
+        # shu kalit uchun so‘rov ketayotgan bo‘lsa, o‘shani kutamiz
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await loader()
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # kutuvchi bo‘lmasa ham "never retrieved" chiqmasin
+            raise
+        else:
+            self.set(key, value, ttl(value))
+            fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate_pct": round(100 * self.hits / total) if total else 0,
+            "evictions": self.evictions,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+        }
+
+
+CACHES: Dict[str, TTLCache] = {}
 
 
 # ======================
 # SUB CHECK
 # ======================
-async def is_subscribed(bot: Bot, user_id: int) -> bool:
+sub_cache = TTLCache("subscription", SUB_CACHE_MAX)
+
+async def fetch_subscribed(bot: Bot, user_id: int) -> bool:
     try:
         member = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
         return member.status in ("creator", "administrator", "member")
     except Exception:
         return False
 
+async def is_subscribed(bot: Bot, user_id: int, force: bool = False) -> bool:
+    return await sub_cache.get_or_load(
+        user_id,
+        lambda: fetch_subscribed(bot, user_id),
+        lambda ok: SUB_CACHE_TTL if ok else SUB_CACHE_NEG_TTL,
+        force=force,
+    )
+
 async def require_sub(message: Message, state: Optional[FSMContext] = None) -> bool:
     user_id = message.from_user.id
     if not await is_subscribed(bot, user_id):
         if state:
+            drop_speaking_session(message)
             await state.clear()
         await message.answer(
             "Botdan foydalanish uchun avval kanalga obuna bo‘ling:\n"
@@ -241,11 +1521,710 @@ async def require_sub(message: Message, state: Optional[FSMContext] = None) -> b
 
 
 # ======================
-# AUDIO
+# AUDIO (ffmpeg worker pool)
+# ======================
+class TranscodeBusy(Exception):
+    pass
+
+class TranscodeError(Exception):
+    pass
+
+class Transcoder:
+    # Bir vaqtda `workers` ta ffmpeg ishlaydi, navbatda `max_queue` tadan
+    # ko‘p ish bo‘lsa darhol TranscodeBusy (backpressure).
+    def __init__(self, workers: int, max_queue: int, timeout: float):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.timeout = timeout
+        self.pending = 0
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    async def run(self, data: bytes, out_args: List[str], in_args: Optional[List[str]] = None) -> bytes:
+        if self.pending >= self.max_queue:
+            raise TranscodeBusy()
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.workers)
+        self.pending += 1
+        try:
+            async with self._sem:
+                return await self._ffmpeg(data, out_args, in_args or [])
+        finally:
+            self.pending -= 1
+
+    async def _ffmpeg(self, data: bytes, out_args: List[str], in_args: List[str]) -> bytes:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin",
+                *in_args, "-i", "pipe:0", *out_args, "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError as e:
+            raise TranscodeError("ffmpeg not found") from e
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(data), self.timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise TranscodeError("ffmpeg timeout")
+        if proc.returncode != 0 or not out:
+            raise TranscodeError(err.decode("utf-8", "replace")[:300])
+        return out
+
+
+transcoder = Transcoder(TRANSCODE_WORKERS, TRANSCODE_QUEUE_MAX, TRANSCODE_TIMEOUT)
+
+# format: (ffmpeg argumentlari yoki None = o‘zgarishsiz, fayl nomi, content-type)
+STT_FORMATS: Dict[str, Tuple[Optional[List[str]], str, str]] = {
+    "ogg": (None, "audio.ogg", "audio/ogg"),
+    "flac": (["-ac", "1", "-ar", "16000", "-c:a", "flac", "-f", "flac"], "audio.flac", "audio/flac"),
+    "wav": (["-ac", "1", "-ar", "16000", "-f", "wav"], "audio.wav", "audio/wav"),
+}
+STT_FORMAT_ORDER = ["ogg", "flac", "wav"]
+
+# endpoint rad etgan formatlar (auto rejimda qayta urinilmaydi)
+_stt_rejected_formats = set()
+
+def stt_format_candidates() -> List[str]:
+    if STT_UPLOAD_FORMAT in STT_FORMATS:
+        return [STT_UPLOAD_FORMAT]
+    return [f for f in STT_FORMAT_ORDER if f not in _stt_rejected_formats] or ["wav"]
+
+async def encode_for_stt(ogg_bytes: bytes, fmt: str) -> bytes:
+    args = STT_FORMATS[fmt][0]
+    if args is None:
+        return ogg_bytes
+    return await transcoder.run(ogg_bytes, args)
+
+
+# ======================
+# VAD (jimlikni kesish, STT dan oldin)
+# ======================
+VAD_RATE = 16000
+VAD_PCM_ARGS = ["-ac", "1", "-ar", str(VAD_RATE), "-f", "s16le"]
+PCM_IN_ARGS = ["-f", "s16le", "-ar", str(VAD_RATE), "-ac", "1"]
+
+# kesilgan PCM -> STT formati (wav ffmpeg siz quriladi)
+PCM_STT_ARGS: Dict[str, List[str]] = {
+    "ogg": ["-c:a", "libopus", "-b:a", "24k", "-f", "ogg"],
+    "flac": ["-c:a", "flac", "-f", "flac"],
+}
+
+class NoSpeech(Exception):
+    pass
+
+def frame_levels(pcm: bytes, frame_bytes: int) -> List[float]:
+    # Har bir freymning sathi (dBFS, RMS bo‘yicha); oxirgi to‘liq bo‘lmagan freym tashlanadi.
+    levels: List[float] = []
+    end = len(pcm) - len(pcm) % frame_bytes
+    for off in range(0, end, frame_bytes):
+        chunk = pcm[off:off + frame_bytes]
+        if audioop is not None:
+            rms = audioop.rms(chunk, 2)
+        else:
+            a = array("h")
+            a.frombytes(chunk)
+            if sys.byteorder == "big":
+                a.byteswap()
+            rms = math.sqrt(sum(map(operator.mul, a, a)) / len(a))
+        levels.append(20 * math.log10(rms / 32768) if rms > 0 else -100.0)
+    return levels
+
+def level_stats(levels: List[float]) -> Tuple[float, float]:
+    # (shovqin sathi = 10-persentil, cho‘qqi); eng baland 1% (klik) hisobga olinmaydi
+    if not levels:
+        return -100.0, -100.0
+    ordered = sorted(levels)
+    return ordered[len(ordered) // 10], ordered[-1 - len(ordered) // 100]
+
+def speech_segments(levels: List[float], frame_s: float, noise: float, peak: float) -> List[Tuple[int, int]]:
+    # Moslashuvchan chegara: shovqin sathi + margin, lekin shovqin va cho‘qqi
+    # orasining yarmidan oshmaydi (qisqa pauzali nutq ham o‘tadi).
+    thr = max(VAD_MIN_DB, noise + min(VAD_MARGIN_DB, (peak - noise) / 2))
+
+    raw: List[Tuple[int, int]] = []
+    start = None
+    for i, lv in enumerate(levels):
+        if lv >= thr:
+            if start is None:
+                start = i
+        elif start is not None:
+            raw.append((start, i))
+            start = None
+    if start is not None:
+        raw.append((start, len(levels)))
+
+    # 2 freymdan qisqa portlashlar tashlanadi, qolganlari hangover bilan kengayadi
+    hang = max(0, round(VAD_HANGOVER_MS / 1000 / frame_s))
+    segs: List[Tuple[int, int]] = []
+    for s, e in raw:
+        if e - s < 2:
+            continue
+        s, e = max(0, s - hang), min(len(levels), e + hang)
+        if segs and s <= segs[-1][1]:
+            segs[-1] = (segs[-1][0], e)
+        else:
+            segs.append((s, e))
+    return segs
+
+def trim_silence(pcm: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    # 16 kHz mono s16le -> (kesilgan PCM, hisobot). PCM bo‘sh faqat sath juda past bo‘lsa
+    # (VAD_MIN_DB); jimlikni nutqdan ajratib bo‘lmasa audio kesilmasdan qaytadi.
+    frame_s = VAD_FRAME_MS / 1000
+    frame_bytes = VAD_RATE * VAD_FRAME_MS // 1000 * 2
+    levels = frame_levels(pcm, frame_bytes)
+    noise, peak = level_stats(levels)
+    info: Dict[str, Any] = {
+        "audio_s": round(len(pcm) / (2 * VAD_RATE), 2),
+        "speech_s": 0.0,
+        "kept_s": 0.0,
+        "trimmed": False,
+        "truncated": False,
+    }
+    if peak < VAD_MIN_DB:
+        return b"", info
+
+    # past dinamika (pauzasiz nutq, kuchli bir tekis fon shovqini): kesadigan jimlik yo‘q
+    segs = speech_segments(levels, frame_s, noise, peak) if peak - noise >= VAD_MIN_RANGE_DB else []
+    speech = sum(e - s for s, e in segs)
+    if speech * frame_s < VAD_MIN_SPEECH:
+        segs = [(0, len(levels))]
+        speech = len(levels)
+    else:
+        info["trimmed"] = True
+    info["speech_s"] = round(speech * frame_s, 2)
+
+    # boshi/oxiridagi jimlik tashlanadi; uzun pauzaning boshi va oxiri qoladi
+    max_pause = round(VAD_MAX_PAUSE / frame_s)
+    keep = round(VAD_KEEP_PAUSE / frame_s)
+    parts: List[Tuple[int, int]] = []
+    for s, e in segs:
+        if parts:
+            prev = parts[-1][1]
+            if s - prev > max_pause:
+                parts.append((prev, prev + keep // 2))
+                parts.append((s - (keep - keep // 2), s))
+            else:
+                parts.append((prev, s))
+        parts.append((s, e))
+
+    limit = round(SPEAKING_MAX_SECONDS / frame_s)
+    out = bytearray()
+    kept = 0
+    for s, e in parts:
+        if kept + (e - s) > limit:
+            e = s + (limit - kept)
+            info["truncated"] = True
+        out += pcm[s * frame_bytes:e * frame_bytes]
+        kept += e - s
+        if info["truncated"]:
+            break
+    info["kept_s"] = round(kept * frame_s, 2)
+    return bytes(out), info
+
+def pcm_to_wav(pcm: bytes) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(VAD_RATE)
+        w.writeframes(pcm)
+    return buf.getvalue()
+
+async def encode_pcm_for_stt(pcm: bytes, fmt: str) -> bytes:
+    if fmt == "wav":
+        return pcm_to_wav(pcm)
+    return await transcoder.run(pcm, PCM_STT_ARGS[fmt], in_args=PCM_IN_ARGS)
+
+async def vad_trim(ogg_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    pcm = await transcoder.run(ogg_bytes, VAD_PCM_ARGS)
+    return await asyncio.to_thread(trim_silence, pcm)
+
+
+# ======================
+# HTTP (aiohttp, bitta umumiy session)
+# ======================
+class HttpResult:
+    __slots__ = ("status", "body", "headers")
+
+    def __init__(self, status: int, body: bytes, headers):
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+    @property
+    def text(self) -> str:
+        return self.body.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.body)
+
+
+_http_session: Optional[aiohttp.ClientSession] = None
+_upstream_sems: Dict[str, asyncio.Semaphore] = {}
+
+def http_session() -> aiohttp.ClientSession:
+    # keep-alive pool: host bo‘yicha ulanishlar qayta ishlatiladi
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+def upstream_sem(upstream: str) -> asyncio.Semaphore:
+    sem = _upstream_sems.get(upstream)
+    if sem is None:
+        sem = asyncio.Semaphore(UPSTREAMS[upstream][0])
+        _upstream_sems[upstream] = sem
+    return sem
+
+async def http_request(upstream: str, method: str, url: str,
+                       timeout: Optional[float] = None, **kwargs) -> HttpResult:
+    # Barcha tashqi so‘rovlar shu yerdan o‘tadi (limit + timeout).
+    # Xatoda exception ko‘tariladi, status tekshirish chaqiruvchida.
+    total = timeout if timeout is not None else UPSTREAMS[upstream][1]
+    async with upstream_sem(upstream):
+        t0 = time.perf_counter()
+        status = "error"
+        try:
+            async with http_session().request(
+                method, url, timeout=aiohttp.ClientTimeout(total=total), **kwargs
+            ) as r:
+                status = r.status
+                body = await r.read()
+                return HttpResult(r.status, body, r.headers)
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise
+        finally:
+            upstream_seconds.observe(time.perf_counter() - t0, upstream)
+            upstream_requests.inc(upstream, status)
+
+@asynccontextmanager
+async def http_stream(upstream: str, method: str, url: str,
+                      timeout: Optional[float] = None, **kwargs):
+    # Javob tanasini bo‘lak-bo‘lak o‘qish uchun (SSE); limit va timeout o‘sha.
+    total = timeout if timeout is not None else UPSTREAMS[upstream][1]
+    async with upstream_sem(upstream):
+        t0 = time.perf_counter()
+        status = "error"
+        try:
+            async with http_session().request(
+                method, url, timeout=aiohttp.ClientTimeout(total=total), **kwargs
+            ) as r:
+                status = r.status
+                yield r
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise
+        finally:
+            upstream_seconds.observe(time.perf_counter() - t0, upstream)
+            upstream_requests.inc(upstream, status)
+
+async def close_http():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+# ======================
+# MODEL ROUTER (health + circuit breaker)
+# ======================
+class ModelHealth:
+    def __init__(self, name: str, priority: int):
+        self.name = name
+        self.priority = priority
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+        self.last_error = ""
+
+    def is_open(self, now: float) -> bool:
+        return self.open_until > now
+
+
+class ModelRouter:
+    # Har chaqiruv muvaffaqiyat ehtimoli eng yuqori modeldan boshlanadi:
+    # ochiq breakerlar oxiriga, keyin xato darajasi, keyin config tartibi.
+    def __init__(self, models: List[str]):
+        self.models: Dict[str, ModelHealth] = {}
+        for i, m in enumerate(models):
+            if m and m not in self.models:
+                self.models[m] = ModelHealth(m, i)
+
+    def order(self) -> List[str]:
+        now = time.monotonic()
+        hs = sorted(
+            self.models.values(),
+            key=lambda h: (h.is_open(now), h.open_until if h.is_open(now) else 0,
+                           round(h.ewma_error, 1), h.priority),
+        )
+        return [h.name for h in hs]
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        h = self.models.get(model)
+        if h is None or h.ewma_latency is None:
+            return ROUTER_HEDGE_MIN_DELAY * 2
+        return max(ROUTER_HEDGE_MIN_DELAY, h.ewma_latency * ROUTER_HEDGE_FACTOR)
+
+    def record_latency(self, model: str, latency: float):
+        h = self.models[model]
+        h.ewma_latency = latency if h.ewma_latency is None else (
+            ROUTER_EWMA_ALPHA * latency + (1 - ROUTER_EWMA_ALPHA) * h.ewma_latency)
+
+    def record_success(self, model: str, latency: float):
+        h = self.models[model]
+        h.calls += 1
+        self.record_latency(model, latency)
+        h.ewma_error *= (1 - ROUTER_EWMA_ALPHA)
+        h.consecutive_failures = 0
+        h.open_until = 0.0
+
+    def record_failure(self, model: str, latency: float, status, retry_after: Optional[str] = None,
+                       body: str = ""):
+        h = self.models[model]
+        now = time.monotonic()
+        h.calls += 1
+        h.failures += 1
+        h.consecutive_failures += 1
+        h.ewma_error = ROUTER_EWMA_ALPHA + (1 - ROUTER_EWMA_ALPHA) * h.ewma_error
+        h.last_error = str(status)
+
+        cooldown = 0.0
+        if status == 429:
+            try:
+                cooldown = float(retry_after) if retry_after else ROUTER_BREAKER_COOLDOWN
+            except ValueError:
+                cooldown = ROUTER_BREAKER_COOLDOWN
+        elif status in (400, 404) and re.search(r"decommission|model_not_found|does not exist", body, re.I):
+            cooldown = ROUTER_DEAD_MODEL_COOLDOWN
+        elif h.consecutive_failures >= ROUTER_BREAKER_FAILS:
+            # har safar ochilganda cooldown ikki barobar (10 daqiqagacha)
+            cooldown = min(600.0, ROUTER_BREAKER_COOLDOWN * (2 ** h.trips))
+        if cooldown > 0:
+            h.open_until = max(h.open_until, now + cooldown)
+            h.trips += 1
+
+    def snapshot(self) -> List[Dict]:
+        now = time.monotonic()
+        out = []
+        for name in self.order():
+            h = self.models[name]
+            out.append({
+                "model": name,
+                "open": h.is_open(now),
+                "open_for_s": max(0, round(h.open_until - now)),
+                "latency_ms": round(h.ewma_latency * 1000) if h.ewma_latency is not None else None,
+                "error_rate": round(h.ewma_error, 2),
+                "calls": h.calls,
+                "failures": h.failures,
+                "last_error": h.last_error,
+            })
+        return out
+
+
+model_router = ModelRouter(GROQ_CHAT_MODELS)
+
+
+# ======================
+# STREAM JSON (yuqori darajadagi maydonlar tugashi bilan qaytadi)
+# ======================
+class JsonFieldStream:
+    # {"a": 1, "b": "..."} ni bo‘laklab beriladi; feed() shu bo‘lakda
+    # to‘liq bo‘lgan (kalit, qiymat) juftlarini qaytaradi.
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.started = False
+        self.in_str = False
+        self.esc = False
+        self.key: Optional[str] = None
+        self.key_start: Optional[int] = None
+        self.value_start: Optional[int] = None
+        self.fields: Dict[str, Any] = {}
+
+    def _finish_value(self, end: int, out: List[Tuple[str, Any]]):
+        if self.key is not None and self.value_start is not None:
+            try:
+                value = json.loads(self.buf[self.value_start:end])
+            except ValueError:
+                value = None
+            else:
+                self.fields[self.key] = value
+                out.append((self.key, value))
+        self.key = None
+        self.value_start = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self.buf += chunk
+        out: List[Tuple[str, Any]] = []
+        while self.pos < len(self.buf):
+            c = self.buf[self.pos]
+            if not self.started:
+                if c == "{":
+                    self.started = True
+                    self.depth = 1
+            elif self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif c == "\\":
+                    self.esc = True
+                elif c == '"':
+                    self.in_str = False
+                    if self.key_start is not None:
+                        self.key = json.loads(self.buf[self.key_start:self.pos + 1])
+                        self.key_start = None
+            elif self.depth == 0:
+                pass  # obyekt tugagan, qolgan matn e'tiborsiz
+            elif c == '"':
+                self.in_str = True
+                if self.depth == 1:
+                    if self.key is None:
+                        self.key_start = self.pos
+                    elif self.value_start is None:
+                        self.value_start = self.pos
+            elif c in "{[":
+                if self.depth == 1 and self.value_start is None:
+                    self.value_start = self.pos
+                self.depth += 1
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self._finish_value(self.pos, out)
+            elif c == "," and self.depth == 1:
+                self._finish_value(self.pos, out)
+            elif (self.depth == 1 and self.key is not None and self.value_start is None
+                  and c not in ": \t\r\n"):
+                self.value_start = self.pos  # son / true / false / null
+            self.pos += 1
+        return out
+
+
+# ======================
+# TOKEN BUDGET (hisob, qisqartirish, kvota)
 # ======================
-async def convert_ogg_to_wav(ogg_path: str, wav_path: str) -> None:
-    audio = AudioSegment.from_file(ogg_path)
-    audio.export(wav_path, format="wav")
+def estimate_tokens(text: str) -> int:
+    # tokenizer siz taxmin: inglizcha ~4 belgi/token, lotin bo‘lmagan matn qimmatroq
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return max(1, ascii_chars // 4 + (len(text) - ascii_chars) // 2)
+
+def estimate_request_tokens(system: str, user_json: Dict) -> int:
+    return estimate_tokens(system) + estimate_tokens(json.dumps(user_json, ensure_ascii=False)) + 8
+
+_SENT_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+EDIT_MIN_CHARS = 3  # "i" -> "I" kabi tuzatishlar qayerga tushishi noaniq
+
+def normalize_answer(text: str, max_tokens: int) -> Tuple[str, bool]:
+    # (matn, qisqartirildimi): ortiqcha bo‘shliq, "!!!!!!", takror gaplar, keyin budjet bo‘yicha kesish
+    text = re.sub(r"[ \t]+", " ", text or "")
+    text = re.sub(r"\n\s*\n+", "\n", text).strip()
+    # faqat harf va tinish belgilari ("soooo", "!!!!"); raqamlar (10000) tegilmaydi
+    text = re.sub(r"([^\W\d_]|[^\w\s])\1{3,}", r"\1\1\1", text)
+    if estimate_tokens(text) <= max_tokens:
+        return text, False
+
+    seen = set()
+    kept: List[str] = []
+    used = 0
+    truncated = False
+    for sent in _SENT_SPLIT_RE.split(text):
+        key = sent.strip().lower()
+        if key in seen:
+            continue  # copy-paste takror
+        seen.add(key)
+        cost = estimate_tokens(sent) + 1
+        if used + cost > max_tokens:
+            truncated = True
+            if not kept:
+                # tinish belgisiz (STT, run-on) matn: birinchi "gap" o‘zi budjetdan katta -> so‘z chegarasida kesish
+                for word in sent.split():
+                    used += estimate_tokens(word) + (1 if kept else 0)
+                    if used > max_tokens:
+                        break
+                    kept.append(word)
+            break
+        kept.append(sent)
+        used += cost
+    return " ".join(kept) + (" […]" if truncated else ""), True
+
+def _edit_pattern(src: str) -> "re.Pattern":
+    # normalize_answer dan o‘tgan matnga qarab yozilgan "from" asl matnda ham topilsin:
+    # bo‘shliqlar -> \s+, 3+ bir xil belgi -> c{3,}; so‘z o‘rtasida mos kelmaydi
+    parts = []
+    for word in src.split():
+        runs = re.findall(r"((.)\2*)", word)
+        parts.append("".join(re.escape(c) + "{3,}" if len(run) >= 3 else re.escape(run) for run, c in runs))
+    pattern = r"\s+".join(parts)
+    if re.match(r"\w", src.strip()):
+        pattern = r"(?<!\w)" + pattern
+    if re.search(r"\w$", src.strip()):
+        pattern += r"(?!\w)"
+    return re.compile(pattern)
+
+def apply_edits(text: str, edits: List[Dict]) -> Tuple[str, int]:
+    # [{"from": ..., "to": ...}] ni matn tartibida qo‘llaydi. Faqat butun so‘zlar, faqat oldinga;
+    # topilmagan, juda qisqa yoki qolgan matnda bir necha marta uchraydiganlari tashlab ketiladi.
+    out = text
+    pos = 0
+    applied = 0
+    for e in edits[:EVAL_MAX_EDITS * 2]:
+        src, dst = e.get("from"), e.get("to")
+        if not isinstance(src, str) or not isinstance(dst, str) or src.strip() == dst.strip():
+            continue
+        if len(src.strip()) < EDIT_MIN_CHARS:
+            continue
+        matches = _edit_pattern(src).finditer(out, pos)
+        m = next(matches, None)
+        if m is None or next(matches, None) is not None:
+            continue
+        out = out[:m.start()] + dst + out[m.end():]
+        pos = m.start() + len(dst)
+        applied += 1
+    return out, applied
+
+def correction_instruction(target: str) -> str:
+    if EVAL_CORRECTION == "full":
+        return f"corrected_best_version (English, corrected {target})"
+    return (f"corrections (list of at most {EVAL_MAX_EDITS} minimal fixes for {target}: "
+            "{\"from\": exact substring copied from the text, long enough to occur only once, "
+            "\"to\": corrected text}; "
+            "do NOT rewrite the whole text)")
+
+def output_budget(text_tokens: int, extra: int = 0) -> int:
+    # max_tokens: feedback + tuzatishlar (yoki to‘liq rewrite) + zaxira
+    body = EVAL_MAX_EDITS * 40 if EVAL_CORRECTION != "full" else int(text_tokens * 1.3)
+    return int((350 + extra + body) * 1.5)
+
+# baholash kimniki (token hisobi uchun); job runner o‘rnatadi
+eval_user: ContextVar[int] = ContextVar("eval_user", default=0)
+
+
+def _token_write(conn, rows: List[Tuple]):
+    conn.executemany(
+        "INSERT INTO token_usage (day, user_id, model, prompt_tokens, completion_tokens, calls) "
+        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(day, user_id, model) DO UPDATE SET "
+        "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+        "completion_tokens = completion_tokens + excluded.completion_tokens, "
+        "calls = calls + excluded.calls",
+        rows,
+    )
+
+def _token_user_today(conn, day: str, user_id: int) -> int:
+    row = conn.execute(
+        "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM token_usage WHERE day=? AND user_id=?",
+        (day, user_id),
+    ).fetchone()
+    return int(row[0])
+
+def _token_report(conn, day: str) -> Tuple[List[Tuple], List[Tuple]]:
+    by_model = conn.execute(
+        "SELECT model, SUM(prompt_tokens), SUM(completion_tokens), SUM(calls) FROM token_usage "
+        "WHERE day=? GROUP BY model ORDER BY SUM(prompt_tokens) + SUM(completion_tokens) DESC", (day,)).fetchall()
+    by_user = conn.execute(
+        "SELECT user_id, SUM(prompt_tokens + completion_tokens) AS t FROM token_usage "
+        "WHERE day=? GROUP BY user_id ORDER BY t DESC LIMIT 10", (day,)).fetchall()
+    return by_model, by_user
+
+
+class TokenLedger:
+    # Xotirada yig‘iladi, stats bilan birga SQLite ga flush qilinadi
+    def __init__(self):
+        self.pending: Dict[Tuple[str, int, str], List[int]] = {}
+        self.day = ""
+        self.model_today: Dict[str, int] = {}
+
+    def _roll(self, day: str):
+        if day != self.day:
+            self.day = day
+            self.model_today = {}
+
+    def load(self):
+        day = Analytics.day()
+        self._roll(day)
+        try:
+            rows = _db_call(lambda conn: conn.execute(
+                "SELECT model, SUM(prompt_tokens + completion_tokens) FROM token_usage WHERE day=? GROUP BY model",
+                (day,)).fetchall())
+            self.model_today = {m: int(t) for m, t in rows}
+        except Exception as e:
+            print("TOKEN LOAD ERROR:", repr(e))
+
+    def record(self, user_id: int, model: str, prompt: int, completion: int):
+        day = Analytics.day()
+        self._roll(day)
+        p = self.pending.setdefault((day, user_id, model), [0, 0, 0])
+        p[0] += prompt
+        p[1] += completion
+        p[2] += 1
+        self.model_today[model] = self.model_today.get(model, 0) + prompt + completion
+        llm_tokens.inc(model, "prompt", amount=prompt)
+        llm_tokens.inc(model, "completion", amount=completion)
+
+    def model_ok(self, model: str) -> bool:
+        self._roll(Analytics.day())
+        return TOKEN_QUOTA_MODEL_DAILY <= 0 or self.model_today.get(model, 0) < TOKEN_QUOTA_MODEL_DAILY
+
+    async def used_today(self, user_id: int) -> int:
+        # boshqa jarayonlar (worker) yozganlari ham SQLite orqali ko‘rinadi
+        day = Analytics.day()
+        local = sum(p[0] + p[1] for (d, uid, _), p in self.pending.items() if d == day and uid == user_id)
+        return await db_run(_token_user_today, day, user_id) + local
+
+    def _take(self) -> List[Tuple]:
+        rows = [(d, uid, m, p[0], p[1], p[2]) for (d, uid, m), p in self.pending.items()]
+        self.pending.clear()
+        return rows
+
+    async def flush(self):
+        rows = self._take()
+        if not rows:
+            return
+        try:
+            await db_run(_token_write, rows)
+        except Exception as e:
+            print("TOKEN FLUSH ERROR:", repr(e))
+            for d, uid, m, pt, ct, n in rows:
+                p = self.pending.setdefault((d, uid, m), [0, 0, 0])
+                p[0] += pt
+                p[1] += ct
+                p[2] += n
+
+    def flush_sync(self):
+        rows = self._take()
+        if rows:
+            try:
+                _db_call(_token_write, rows)
+            except Exception as e:
+                print("TOKEN FLUSH ERROR:", repr(e))
+
+
+token_ledger = TokenLedger()
+
+QUOTA_TEXT = "⛔️ Bugungi baholash limiti tugadi. Ertaga qayta urinib ko‘ring."
+
+async def quota_left(user_id: int) -> Optional[int]:
+    # None = cheklanmagan
+    if TOKEN_QUOTA_USER_DAILY <= 0 or user_id in ADMIN_IDS:
+        return None
+    try:
+        return TOKEN_QUOTA_USER_DAILY - await token_ledger.used_today(user_id)
+    except Exception as e:
+        print("TOKEN QUOTA ERROR:", repr(e))
+        return None
 
 
 # ======================
@@ -254,120 +2233,677 @@ async def convert_ogg_to_wav(ogg_path: str, wav_path: str) -> None:
 def groq_headers() -> Dict[str, str]:
     return {"Authorization": f"Bearer {GROQ_API_KEY}"}
 
-def groq_stt_whisper(wav_path: str) -> str:
+class SttFormatRejected(Exception):
+    pass
+
+async def groq_stt_whisper(audio: bytes, fmt: str = "wav") -> str:
     if not GROQ_API_KEY:
         return ""
     url = f"{GROQ_BASE}/audio/transcriptions"
+    _, filename, content_type = STT_FORMATS[fmt]
     try:
-        with open(wav_path, "rb") as f:
-            files = {"file": ("audio.wav", f, "audio/wav")}
-            data = {"model": "whisper-large-v3", "language": "en", "response_format": "json"}
-            r = requests.post(url, headers=groq_headers(), files=files, data=data, timeout=60)
-        if r.status_code != 200:
-            print("GROQ STT HTTP:", r.status_code, r.text[:400])
+        form = aiohttp.FormData()
+        form.add_field("file", audio, filename=filename, content_type=content_type)
+        form.add_field("model", "whisper-large-v3")
+        form.add_field("language", "en")
+        form.add_field("response_format", "json")
+        r = await http_request("groq", "POST", url, headers=groq_headers(), data=form)
+        if r.status in (400, 415) and re.search(r"must be one of|unsupported|invalid file", r.text, re.I):
+            raise SttFormatRejected(r.text[:200])
+        if r.status != 200:
+            print("GROQ STT HTTP:", r.status, r.text[:400])
             return ""
         js = r.json()
         return (js.get("text") or "").strip()
+    except SttFormatRejected:
+        raise
     except Exception as e:
         print("GROQ STT ERROR:", repr(e))
         return ""
 
-def groq_chat_json(system: str, user_json: Dict) -> Optional[Dict]:
+async def transcribe_voice(ogg_bytes: bytes, report: Optional[Dict[str, Any]] = None) -> str:
+    # Avval VAD: jimlik kesiladi, nutqsiz voice tarmoqqa chiqmasdan rad etiladi.
+    # Keyin eng arzon formatdan boshlaydi; endpoint rad etsa keyingisiga o‘tadi.
+    pcm: Optional[bytes] = None
+    if VAD_ENABLED:
+        try:
+            with stage_seconds.time("stt.vad"):
+                pcm, info = await vad_trim(ogg_bytes)
+        except TranscodeError as e:
+            # ffmpeg yo‘q yoki fayl buzuq: asl audio kesilmasdan yuboriladi
+            print("VAD ERROR:", repr(e))
+            vad_notes.inc("error")
+        else:
+            vad_seconds.inc("input", amount=info["audio_s"])
+            vad_seconds.inc("kept", amount=info["kept_s"])
+            vad_seconds.inc("removed", amount=max(0.0, info["audio_s"] - info["kept_s"]))
+            if report is not None:
+                report.update(info)
+            if not pcm:
+                vad_notes.inc("no_speech")
+                raise NoSpeech(f"nothing above {VAD_MIN_DB:g} dBFS in {info['audio_s']}s")
+            vad_notes.inc("truncated" if info["truncated"] else "ok" if info["trimmed"] else "untrimmed")
+
+    for fmt in stt_format_candidates():
+        with stage_seconds.time("stt.convert"):
+            if pcm is not None:
+                audio = await encode_pcm_for_stt(pcm, fmt)
+            else:
+                audio = await encode_for_stt(ogg_bytes, fmt)
+        try:
+            with stage_seconds.time("stt.upstream"):
+                return await groq_stt_whisper(audio, fmt)
+        except SttFormatRejected as e:
+            print(f"GROQ STT: {fmt} rad etildi:", e)
+            _stt_rejected_formats.add(fmt)
+    return ""
+
+FieldCallback = Callable[[str, Any], Awaitable[None]]
+
+async def _read_chat_stream(r, on_field: FieldCallback, usage: Optional[Dict] = None) -> str:
+    # OpenAI-uslubidagi SSE: "data: {...}" qatorlari, oxirida "data: [DONE]"
+    parser = JsonFieldStream()
+    parts: List[str] = []
+    async for raw in r.content:
+        line = raw.decode("utf-8", "replace").strip()
+        if not line.startswith("data:"):
+            continue
+        chunk = line[5:].strip()
+        if chunk == "[DONE]":
+            break
+        try:
+            event = json.loads(chunk)
+            # Groq oxirgi bo‘lakda x_groq.usage yuboradi
+            u = event.get("usage") or (event.get("x_groq") or {}).get("usage")
+            if u and usage is not None:
+                usage.update(u)
+            delta = event["choices"][0]["delta"].get("content") or ""
+        except (ValueError, KeyError, IndexError, AttributeError):
+            continue
+        if not delta:
+            continue
+        parts.append(delta)
+        for key, value in parser.feed(delta):
+            try:
+                await on_field(key, value)
+            except Exception as e:
+                print("STREAM CALLBACK ERROR:", repr(e))
+    return "".join(parts)
+
+def salvage_json(content: str) -> Optional[Dict]:
+    # Buzilgan javobdan to‘liq yozilgan maydonlarni ajratib oladi
+    parser = JsonFieldStream()
+    parser.feed(content)
+    return parser.fields or None
+
+async def groq_chat_once(model: str, system: str, user_json: Dict,
+                         on_field: Optional[FieldCallback] = None,
+                         json_mode: bool = False, max_tokens: Optional[int] = None) -> Tuple[bool, Any]:
+    # Bitta modelga bitta so‘rov. (True, json) yoki (False, xato); natija routerga yoziladi.
+    url = f"{GROQ_BASE}/chat/completions"
+    user_content = json.dumps(user_json, ensure_ascii=False)
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user_content},
+        ],
+        "temperature": 0.1,
+    }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
+    headers = {**groq_headers(), "Content-Type": "application/json"}
+    usage: Dict[str, Any] = {}
+    content = ""
+    t0 = time.monotonic()
+    try:
+        if on_field is not None:
+            payload["stream"] = True
+            async with http_stream("groq", "POST", url, headers=headers, json=payload) as r:
+                if r.status != 200:
+                    text = (await r.read()).decode("utf-8", "replace")
+                    model_router.record_failure(model, time.monotonic() - t0, r.status,
+                                                r.headers.get("retry-after"), text)
+                    llm_requests.inc(model, r.status)
+                    return False, (r.status, text[:500])
+                content = await _read_chat_stream(r, on_field, usage)
+        else:
+            if json_mode:
+                payload["response_format"] = {"type": "json_object"}
+            r = await http_request("groq", "POST", url, headers=headers, json=payload)
+            if r.status != 200:
+                model_router.record_failure(model, time.monotonic() - t0, r.status,
+                                            r.headers.get("retry-after"), r.text)
+                llm_requests.inc(model, r.status)
+                return False, (r.status, r.text[:500])
+            js = r.json()
+            usage.update(js.get("usage") or {})
+            content = js["choices"][0]["message"]["content"] or ""
+
+        # usage kelmasa taxminiy hisob
+        token_ledger.record(
+            eval_user.get(), model,
+            int(usage.get("prompt_tokens") or estimate_tokens(system) + estimate_tokens(user_content)),
+            int(usage.get("completion_tokens") or estimate_tokens(content)),
+        )
+        elapsed = time.monotonic() - t0
+        llm_seconds.observe(elapsed, model)
+        m = re.search(r"\{.*\}", content, re.S)
+        try:
+            data = json.loads(m.group(0)) if m else None
+        except ValueError:
+            data = None
+        if data is None:
+            # qayta generatsiya o‘rniga tayyor maydonlarni olamiz (qolgani repair da)
+            data = salvage_json(content)
+            if data is None:
+                model_router.record_failure(model, elapsed, "NO_JSON")
+                llm_requests.inc(model, "no_json")
+                return False, ("NO_JSON", content[:250])
+            eval_json_stats["salvaged"] += 1
+
+        model_router.record_success(model, elapsed)
+        llm_requests.inc(model, 200)
+        return True, data
+
+    except asyncio.CancelledError:
+        # hedge yutqazdi: kamida shuncha sekin ekanini eslab qolamiz
+        model_router.record_latency(model, time.monotonic() - t0)
+        llm_requests.inc(model, "cancelled")
+        raise
+    except Exception as e:
+        model_router.record_failure(model, time.monotonic() - t0, "EXC")
+        llm_requests.inc(model, "exception")
+        return False, ("EXC", repr(e))
+
+# javobni qaysi model bergani (hodisalar jurnali uchun); "cache"/"fallback" ham bo‘lishi mumkin
+eval_model: ContextVar[Optional[str]] = ContextVar("eval_model", default=None)
+
+async def groq_chat_json(system: str, user_json: Dict,
+                         on_field: Optional[FieldCallback] = None,
+                         json_mode: bool = False, max_tokens: Optional[int] = None) -> Optional[Dict]:
     if not GROQ_API_KEY:
+        eval_model.set("fallback")
         return None
 
-    url = f"{GROQ_BASE}/chat/completions"
+    # kunlik token limiti tugagan modellar o‘tkazib yuboriladi
+    order = [m for m in model_router.order() if token_ledger.model_ok(m)]
+    if not order:
+        print("GROQ CHAT: hamma modellarning kunlik token limiti tugadi")
+        eval_model.set("fallback")
+        return None
     last_err = None
+    running: Dict[asyncio.Task, str] = {}
+    stream_owner: List[str] = []
 
-    for model in GROQ_CHAT_MODELS:
-        if not model:
-            continue
-
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": system},
-                {"role": "user", "content": json.dumps(user_json, ensure_ascii=False)},
-            ],
-            "temperature": 0.1,
-        }
+    def field_cb(model: str) -> Optional[FieldCallback]:
+        if on_field is None:
+            return None
 
-        try:
-            r = requests.post(
-                url,
-                headers={**groq_headers(), "Content-Type": "application/json"},
-                json=payload,
-                timeout=60
-            )
-            if r.status_code != 200:
-                last_err = (r.status_code, r.text[:500])
-                continue
+        async def cb(key: str, value: Any):
+            # hedge paytida faqat birinchi gapirgan model ko‘rsatiladi;
+            # u yiqilsa keyingi model davom ettiradi
+            if not stream_owner or stream_owner[0] not in running.values():
+                stream_owner[:] = [model]
+            if stream_owner[0] == model:
+                await on_field(key, value)
+        return cb
+
+    def launch():
+        model = order.pop(0)
+        task = asyncio.create_task(
+            groq_chat_once(model, system, user_json, field_cb(model), json_mode, max_tokens))
+        running[task] = model
 
-            content = r.json()["choices"][0]["message"]["content"] or ""
-            m = re.search(r"\{.*\}", content, re.S)
-            if not m:
-                last_err = ("NO_JSON", content[:250])
+    try:
+        launch()
+        while running:
+            # hedge: asosiy model odatdagidan sekin bo‘lsa keyingisi ham parallel boshlanadi
+            timeout = None
+            if ROUTER_HEDGE and order and len(running) == 1:
+                timeout = model_router.hedge_delay(next(iter(running.values())))
+            done, _ = await asyncio.wait(running.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch()
                 continue
-
-            return json.loads(m.group(0))
-
-        except Exception as e:
-            last_err = ("EXC", repr(e))
-            continue
+            for task in done:
+                running_model = running.pop(task)
+                ok, result = task.result()
+                if ok:
+                    eval_model.set(running_model)
+                    return result
+                last_err = result
+            if not running and order:
+                launch()
+    finally:
+        for task in running:
+            task.cancel()
 
     print("GROQ CHAT FAILED:", last_err)
+    eval_model.set("fallback")
     return None
 
 
 # ======================
-# SPEAKING EVAL (off-topic cap)
+# EVAL SCHEMA (tekshiruv + faqat yetishmagan maydonlarni qayta so‘rash)
 # ======================
-def enforce_caps_from_relevance(score: int, avg_rel: float) -> int:
-    s = clamp_20_75(score)
-    if avg_rel < 2.0:
-        return min(s, 37)  # A2 max
-    if avg_rel < 3.0 and s >= 38:
-        return min(s, 37)  # B1+ chiqmasin
-    return s
+# maydon: (tur, (min, max) yoki None)
+SPEAKING_SCHEMA: Dict[str, Tuple[type, Optional[Tuple[int, int]]]] = {
+    "per_question": (list, None),
+    "score_20_75": (int, (20, 75)),
+    "feedback_uz": (str, None),
+    "corrected_best_version": (str, None),
+}
+WRITING_SCHEMA: Dict[str, Tuple[type, Optional[Tuple[int, int]]]] = {
+    "off_topic": (bool, None),
+    "score_20_75": (int, (20, 75)),
+    "feedback_uz": (str, None),
+    "corrected_best_version": (str, None),
+}
 
-async def evaluate_speaking_strict(questions: List[str], answers: List[str]) -> Dict:
-    system = (
-        "You are a STRICT IELTS Speaking examiner.\n"
-        "Return ONLY JSON keys:\n"
-        "score_20_75 (20..75), feedback_uz (Uzbek), corrected_best_version (English), per_question.\n"
-        "per_question items include relevance_to_question (0..5).\n"
-        "If off-topic, relevance must be low.\n"
+def with_edits(schema: Dict) -> Dict:
+    # to‘liq rewrite o‘rniga diff-uslubidagi tuzatishlar ro‘yxati
+    out = {k: v for k, v in schema.items() if k != "corrected_best_version"}
+    out["corrections"] = (list, None)
+    return out
+
+SPEAKING_EDITS_SCHEMA = with_edits(SPEAKING_SCHEMA)
+WRITING_EDITS_SCHEMA = with_edits(WRITING_SCHEMA)
+
+def corrected_text(data: Dict, original: str) -> str:
+    if data.get("corrected_best_version"):
+        return safe_text(data["corrected_best_version"]).strip()
+    edits = data.get("corrections")
+    if isinstance(edits, list):
+        return apply_edits(original, [e for e in edits if isinstance(e, dict)])[0].strip()
+    return ""
+
+eval_json_stats = {"ok": 0, "salvaged": 0, "repaired": 0, "repair_failed": 0}
+
+def _coerce(value, kind: type, bounds: Optional[Tuple[int, int]]):
+    # noto‘g‘ri tur -> ValueError
+    if kind is int:
+        if isinstance(value, bool):
+            raise ValueError
+        value = int(float(value))
+        if bounds:
+            value = max(bounds[0], min(bounds[1], value))
+        return value
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            return value.strip().lower() == "true"
+        raise ValueError
+    if kind is str:
+        if value is None or isinstance(value, (dict, list)):
+            raise ValueError
+        value = str(value).strip()
+        if not value:
+            raise ValueError
+        return value
+    if kind is list:
+        if not isinstance(value, list):
+            raise ValueError
+        return [it for it in value if isinstance(it, dict)]
+    return value
+
+def validate_eval_json(data: Dict, schema: Dict) -> Tuple[Dict, List[str]]:
+    clean: Dict[str, Any] = {}
+    missing: List[str] = []
+    for key, (kind, bounds) in schema.items():
+        try:
+            if key not in data:
+                raise ValueError
+            clean[key] = _coerce(data[key], kind, bounds)
+        except (ValueError, TypeError):
+            missing.append(key)
+    return clean, missing
+
+async def chat_json_validated(system: str, user_json: Dict, schema: Optional[Dict],
+                              on_field: Optional[FieldCallback] = None,
+                              max_tokens: Optional[int] = None) -> Optional[Dict]:
+    json_mode = EVAL_JSON_MODE and on_field is None
+    data = await groq_chat_json(system, user_json, on_field, json_mode=json_mode, max_tokens=max_tokens)
+    if data is None or schema is None:
+        return data
+
+    clean, missing = validate_eval_json(data, schema)
+    if not missing:
+        eval_json_stats["ok"] += 1
+        return clean
+    if len(missing) == len(schema):
+        eval_json_stats["repair_failed"] += 1
+        return None
+
+    # butun javobni qayta yaratmasdan faqat yetishmaganlarini so‘raymiz
+    repair_system = (
+        system
+        + "\nYou already returned part of the answer (see previous_answer)."
+        + "\nReturn ONLY JSON with these keys: " + ", ".join(missing) + ".\n"
     )
+    extra = await groq_chat_json(
+        repair_system, {**user_json, "previous_answer": clean}, json_mode=EVAL_JSON_MODE, max_tokens=max_tokens
+    )
+    if extra:
+        fixed, _ = validate_eval_json({**clean, **extra}, schema)
+        clean.update(fixed)
+    still = [k for k in schema if k not in clean]
+    if still:
+        # chala javob (masalan score_20_75 yo‘q) qaytarilmaydi va keshlanmaydi: lokal fallback ishlaydi
+        eval_json_stats["repair_failed"] += 1
+        return None
+    eval_json_stats["repaired"] += 1
+    return clean
 
-    data = groq_chat_json(system, {
-        "items": [{"question": q, "answer": a} for q, a in zip(questions, answers)]
-    })
 
-    if not data:
-        joined = " ".join(a.strip() for a in answers if a and a.strip())
-        score = 24 if len(joined.split()) < 12 else 35
-        score = clamp_20_75(score)
-        return {
-            "score_20_75": score,
-            "feedback_uz": "Baholash xizmati ishlamadi. Taxminiy natija.",
-            "corrected_best_version": joined or "—",
-        }
+# ======================
+# EVAL CACHE (normallashgan kontent hash -> LLM javobi)
+# ======================
+eval_cache = TTLCache("evaluation", EVAL_CACHE_MAX)
 
-    score = clamp_20_75(int(data.get("score_20_75", 20)))
-    per_q = data.get("per_question") or []
-    rels = []
-    for it in per_q:
-        try:
-            rels.append(float(it.get("relevance_to_question", 0)))
-        except Exception:
+def _normalize_for_key(x):
+    if isinstance(x, str):
+        return re.sub(r"\s+", " ", x).strip()
+    if isinstance(x, dict):
+        return {k: _normalize_for_key(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [_normalize_for_key(v) for v in x]
+    return x
+
+def eval_cache_key(system: str, user_json: Dict) -> str:
+    blob = json.dumps(
+        {"system": _normalize_for_key(system), "input": _normalize_for_key(user_json),
+         "models": [m for m in GROQ_CHAT_MODELS if m]},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"),
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def _eval_cache_get(conn, key: str, min_created: float) -> Optional[str]:
+    row = conn.execute(
+        "SELECT result FROM eval_cache WHERE key=? AND created_at>=?", (key, min_created)
+    ).fetchone()
+    return row[0] if row else None
+
+def _eval_cache_put(conn, key: str, result: str, min_created: float):
+    conn.execute(
+        "INSERT OR REPLACE INTO eval_cache (key, result, created_at) VALUES (?, ?, ?)",
+        (key, result, time.time()),
+    )
+    conn.execute("DELETE FROM eval_cache WHERE created_at<?", (min_created,))
+
+async def cached_chat_json(system: str, user_json: Dict,
+                           on_field: Optional[FieldCallback] = None,
+                           schema: Optional[Dict] = None,
+                           max_tokens: Optional[int] = None) -> Optional[Dict]:
+    # xotira (LRU) -> SQLite -> LLM; bir xil topshiriqlar bitta chaqiruvni bo‘lishadi
+    key = eval_cache_key(system, user_json)
+
+    async def load() -> Optional[Dict]:
+        min_created = time.time() - EVAL_CACHE_TTL
+        if EVAL_CACHE_PERSIST:
+            try:
+                raw = await db_run(_eval_cache_get, key, min_created)
+                if raw:
+                    return json.loads(raw)
+            except Exception as e:
+                print("EVAL CACHE ERROR:", repr(e))
+        data = await chat_json_validated(system, user_json, schema, on_field if EVAL_STREAM else None, max_tokens)
+        if data is not None and EVAL_CACHE_PERSIST:
+            try:
+                await db_run(_eval_cache_put, key, json.dumps(data, ensure_ascii=False), min_created)
+            except Exception as e:
+                print("EVAL CACHE ERROR:", repr(e))
+        return data
+
+    # LLM ishlamasa (None) keshlanmaydi
+    return await eval_cache.get_or_load(key, load, lambda d: EVAL_CACHE_TTL if d is not None else 0)
+
+
+# ======================
+# PRE-SCORING (lokal matn tahlili, LLM dan oldin)
+# ======================
+_TOKEN_RE = re.compile(r"([A-Za-z]+(?:'[A-Za-z]+)?)|([^\W\d_]+)|([.!?]+)")
+
+LINKERS = {
+    "firstly", "secondly", "thirdly", "finally", "moreover", "furthermore", "however", "therefore",
+    "although", "because", "besides", "meanwhile", "nevertheless", "consequently", "additionally",
+    "instead", "otherwise", "overall", "whereas", "unless", "also", "then", "so", "but",
+}
+# ko‘p so‘zli linkerlar: oxirgi so‘z -> to‘liq ketma-ketliklar
+MULTI_LINKERS: Dict[str, List[Tuple[str, ...]]] = {}
+for _phrase in ("for example", "for instance", "in addition", "as a result", "in conclusion",
+                "on the other hand", "to sum up", "in my opinion", "as well as", "due to", "such as",
+                "even though", "so that", "in contrast", "first of all", "in other words"):
+    _words = tuple(_phrase.split())
+    MULTI_LINKERS.setdefault(_words[-1], []).append(_words)
+
+STOPWORDS = {
+    "the", "and", "for", "you", "your", "are", "was", "were", "with", "that", "this", "have", "has",
+    "not", "but", "what", "why", "how", "who", "when", "where", "which", "from", "about", "would",
+    "could", "should", "will", "can", "they", "them", "their", "our", "his", "her", "its", "into",
+    "there", "here", "some", "any", "all", "more", "most", "very", "just", "also", "than", "then",
+    "write", "describe", "explain", "tell", "give", "think", "words", "least", "minimum", "answer",
+}
+
+def _content_key(word: str) -> Optional[str]:
+    w = word.lower()
+    if len(w) < 3 or w in STOPWORDS:
+        return None
+    return w[:-1] if w.endswith("s") and len(w) > 4 else w
+
+def prompt_keys(prompt: str) -> set:
+    keys = set()
+    for m in _TOKEN_RE.finditer(prompt or ""):
+        if m.group(1):
+            k = _content_key(m.group(1))
+            if k:
+                keys.add(k)
+    return keys
+
+def analyze_text(text: str, prompt: str = "") -> Dict[str, Any]:
+    # Bitta o‘tish: so‘zlar, xilma-xillik, gap uzunliklari, linkerlar, prompt bilan kesishma
+    keys = prompt_keys(prompt)
+    matched = set()
+    unique = set()
+    words = other = long_words = linkers = 0
+    sent_len = 0
+    sent_lens: List[int] = []
+    tail: List[str] = []
+
+    for m in _TOKEN_RE.finditer(text or ""):
+        word, foreign, stop = m.groups()
+        if stop:
+            if sent_len:
+                sent_lens.append(sent_len)
+                sent_len = 0
+            continue
+        if foreign:
+            other += 1
+            continue
+
+        w = word.lower()
+        words += 1
+        sent_len += 1
+        unique.add(w)
+        if len(w) >= 7:
+            long_words += 1
+        if w in LINKERS:
+            linkers += 1
+        for phrase in MULTI_LINKERS.get(w, ()):
+            if tuple(tail[-(len(phrase) - 1):]) == phrase[:-1]:
+                linkers += 1
+        tail.append(w)
+        if len(tail) > 3:
+            del tail[0]
+        if keys:
+            k = _content_key(w)
+            if k in keys:
+                matched.add(k)
+    if sent_len:
+        sent_lens.append(sent_len)
+
+    n_sent = len(sent_lens)
+    mean_len = words / n_sent if n_sent else 0.0
+    var = sum((x - mean_len) ** 2 for x in sent_lens) / n_sent if n_sent else 0.0
+    return {
+        "words": words,
+        "unique": len(unique),
+        "ttr": round(len(unique) / words, 3) if words else 0.0,
+        "rttr": round(len(unique) / words ** 0.5, 2) if words else 0.0,  # uzunlikka kam bog‘liq
+        "sentences": n_sent,
+        "sentence_mean": round(mean_len, 1),
+        "sentence_std": round(var ** 0.5, 1),
+        "long_ratio": round(long_words / words, 3) if words else 0.0,
+        "linkers": linkers,
+        "prompt_overlap": round(len(matched) / len(keys), 3) if keys else None,
+        "foreign": other,
+    }
+
+def local_score(f: Dict[str, Any], min_words: int) -> int:
+    # Grammatikani ko‘rmaydi, shuning uchun B2 (55) dan oshmaydi
+    if not f["words"]:
+        return 20
+    length = min(1.0, f["words"] / max(1, min_words))
+    q_lex = min(1.0, max(0.0, (f["rttr"] - 3.0) / 5.0))
+    q_link = min(1.0, f["linkers"] / max(1.0, f["words"] / 40))
+    q_sent = 1.0 - min(1.0, abs(f["sentence_mean"] - 15) / 15) if f["sentences"] else 0.0
+    q_long = min(1.0, f["long_ratio"] / 0.25)
+    quality = 0.35 * q_lex + 0.25 * q_link + 0.2 * q_sent + 0.2 * q_long
+    return clamp_20_75(20 + round(35 * length * (0.4 + 0.6 * quality)))
+
+def prescore_reason(feats: List[Dict[str, Any]], required: int, check_topic: bool = True,
+                    min_total: Optional[int] = None) -> Optional[str]:
+    # LLM ni chaqirmaslik sababi yoki None; min_total berilsa "too_short" chegarasi shu
+    total = sum(f["words"] for f in feats)
+    foreign = sum(f["foreign"] for f in feats)
+    if total == 0:
+        return "non_english" if foreign else "empty"
+    if total < foreign:
+        return "non_english"
+    if total < (PRESCORE_MIN_RATIO * required if min_total is None else min_total):
+        return "too_short"
+    # qisqa savollarda (speaking) so‘z kesishmasi ishonchli emas
+    overlaps = [f["prompt_overlap"] for f in feats if f["words"] and f["prompt_overlap"] is not None]
+    if check_topic and overlaps and max(overlaps) == 0 and total < required:
+        return "off_topic"
+    return None
+
+PRESCORE_TEXTS = {
+    "empty": "Javob bo‘sh.",
+    "non_english": "Javob ingliz tilida emas.",
+    "too_short": "Javob juda qisqa — baholash uchun yetarli matn yo‘q.",
+    "off_topic": "Javob savol(lar)ga mos emas (mavzudan tashqari).",
+}
+
+def local_score_all(feats: List[Dict[str, Any]], min_words: int) -> int:
+    return clamp_20_75(round(sum(local_score(f, min_words) for f in feats) / max(1, len(feats))))
+
+def features_line(feats: List[Dict[str, Any]]) -> str:
+    words = sum(f["words"] for f in feats)
+    linkers = sum(f["linkers"] for f in feats)
+    rttr = max((f["rttr"] for f in feats), default=0.0)
+    mean = [f["sentence_mean"] for f in feats if f["sentences"]]
+    return (f"📊 So‘zlar: {words} | Lug‘at xilma-xilligi: {rttr} | Linkerlar: {linkers} | "
+            f"O‘rtacha gap: {round(sum(mean) / len(mean), 1) if mean else 0} so‘z")
+
+
+# ======================
+# SPEAKING EVAL (off-topic cap)
+# ======================
+def enforce_caps_from_relevance(score: int, avg_rel: float) -> int:
+    s = clamp_20_75(score)
+    if avg_rel < 2.0:
+        return min(s, 37)  # A2 max
+    if avg_rel < 3.0 and s >= 38:
+        return min(s, 37)  # B1+ chiqmasin
+    return s
+
+PartialCallback = Callable[[Dict], Awaitable[None]]
+
+def avg_relevance(per_q) -> float:
+    rels = []
+    for it in per_q or []:
+        try:
+            rels.append(float(it.get("relevance_to_question", 0)))
+        except Exception:
             pass
-    avg_rel = sum(rels) / len(rels) if rels else 0.0
+    return sum(rels) / len(rels) if rels else 0.0
+
+async def evaluate_speaking_strict(questions: List[str], answers: List[str],
+                                   on_partial: Optional[PartialCallback] = None) -> Dict:
+    # Kalitlar tartibi muhim: stream paytida ball cap uchun per_question oldin keladi.
+    system = (
+        "You are a STRICT IELTS Speaking examiner.\n"
+        "Return ONLY JSON keys, in this order:\n"
+        "per_question, score_20_75 (20..75), feedback_uz (Uzbek), "
+        + correction_instruction("the answers") + ".\n"
+        "per_question items include relevance_to_question (0..5).\n"
+        "If off-topic, relevance must be low.\n"
+    )
+
+    feats = [analyze_text(a or "", q) for q, a in zip(questions, answers)]
+    joined = " ".join(a.strip() for a in answers if a and a.strip())
+    reason = prescore_reason(feats, SPEAKING_MIN_WORDS * len(feats), check_topic=False,
+                             min_total=SPEAKING_FLOOR_WORDS * len(feats)) if PRESCORE_SKIP else None
+    if reason:
+        prescore_skips.inc("speaking", reason)
+        eval_model.set("local")
+        return {
+            "score_20_75": 20 if reason in ("empty", "non_english") else min(
+                37, local_score_all(feats, SPEAKING_MIN_WORDS)),
+            "feedback_uz": PRESCORE_TEXTS[reason] + "\n" + features_line(feats),
+            "corrected_best_version": joined or "—",
+            "prescore": reason,
+        }
+
+    partial: Dict[str, Any] = {}
+
+    async def on_field(key: str, value: Any):
+        if key == "per_question":
+            partial["avg_relevance"] = avg_relevance(value)
+        elif key == "score_20_75":
+            try:
+                score = clamp_20_75(int(value))
+            except (TypeError, ValueError):
+                return
+            partial["score_20_75"] = enforce_caps_from_relevance(score, partial.get("avg_relevance", 0.0))
+        elif key in ("feedback_uz", "corrected_best_version"):
+            partial[key] = safe_text(value).strip()
+        elif key == "corrections":
+            partial["corrected_best_version"] = corrected_text({key: value}, joined)
+        else:
+            return
+        await on_partial(dict(partial))
+
+    # katta / takrorlangan javoblar budjetga sig‘diriladi (prescore asl matndan)
+    trimmed = [normalize_answer(a or "", EVAL_MAX_INPUT_TOKENS // max(1, len(answers))) for a in answers]
+    items = [{"question": q, "answer": t, **({"truncated": True} if cut else {})}
+             for q, (t, cut) in zip(questions, trimmed)]
+    text_tokens = sum(estimate_tokens(t) for t, _ in trimmed)
+    data = await cached_chat_json(
+        system, {"items": items},
+        # stream faqat jonli ko‘rsatish uchun; aks holda JSON rejimi (response_format) ishlaydi
+        on_field if on_partial else None,
+        SPEAKING_SCHEMA if EVAL_CORRECTION == "full" else SPEAKING_EDITS_SCHEMA,
+        output_budget(text_tokens, extra=60 * len(items)),
+    )
+
+    if not data:
+        return {
+            "score_20_75": local_score_all(feats, SPEAKING_MIN_WORDS),
+            "feedback_uz": "Baholash xizmati ishlamadi. Taxminiy natija (lokal tahlil).\n" + features_line(feats),
+            "corrected_best_version": joined or "—",
+        }
+
+    score = clamp_20_75(int(data.get("score_20_75", 20)))
+    avg_rel = avg_relevance(data.get("per_question"))
     score = enforce_caps_from_relevance(score, avg_rel)
 
     return {
         "score_20_75": score,
         "feedback_uz": str(data.get("feedback_uz", "")).strip(),
-        "corrected_best_version": (str(data.get("corrected_best_version", "")).strip() or "—"),
+        "corrected_best_version": corrected_text(data, joined) or "—",
         "avg_relevance": avg_rel,
     }
 
@@ -434,50 +2970,101 @@ def build_writing_advice(prompts: List[Dict], wc1: int, wc2: int, wc3: int) -> s
 
     return "\n".join(lines)
 
-async def evaluate_writing_strict(prompts: List[Dict[str, str]], full_text: str) -> Dict:
+async def evaluate_writing_strict(prompts: List[Dict[str, str]], full_text: str,
+                                  on_partial: Optional[PartialCallback] = None,
+                                  tasks: Tuple[int, ...] = (1, 2, 3)) -> Dict:
+    # tasks: baholanadigan topshiriqlar (batch da bitta insho -> masalan (3,))
     answers = split_answers(full_text)
     wc1 = word_count(answers[1])
     wc2 = word_count(answers[2])
     wc3 = word_count(answers[3])
+    wcs = {1: wc1, 2: wc2, 3: wc3}
 
-    coverage = 0
-    if wc1 >= 50: coverage += 1
-    if wc2 >= 120: coverage += 1
-    if wc3 >= 180: coverage += 1
+    all_mins = [int(p.get("min_words", m)) for p, m in zip(prompts, (50, 120, 180))]
+    coverage = sum(1 for t in tasks if wcs[t] >= (50, 120, 180)[t - 1])
+    # 3 tadan 2 tasi (yoki yagona task) bajarilmagan -> A2 cap
+    capped = coverage < max(1, len(tasks) - 1)
 
     advice = build_writing_advice(prompts, wc1, wc2, wc3)
 
+    mins = [all_mins[t - 1] for t in tasks]
+    feats = [analyze_text(answers[t], prompts[t - 1].get("prompt", "")) for t in tasks]
+    counts = {"task_coverage": coverage, "wc1": wc1, "wc2": wc2, "wc3": wc3}
+    # coverage 0 da ball baribir 37 dan oshmaydi: junk uchun LLM kutilmaydi
+    reason = prescore_reason(feats, sum(mins)) if PRESCORE_SKIP and coverage == 0 else None
+    if reason:
+        prescore_skips.inc("writing", reason)
+        eval_model.set("local")
+        score = 20 if reason in ("empty", "non_english") else min(
+            37, sum(local_score(f, m) for f, m in zip(feats, mins)) // len(tasks))
+        return {
+            "score_20_75": score,
+            "off_topic": reason != "too_short",
+            "feedback_uz": PRESCORE_TEXTS[reason] + "\n" + features_line(feats) + "\n\n" + advice,
+            "corrected_best_version": full_text or "—",
+            "prescore": reason,
+            **counts,
+        }
+
+    # off_topic birinchi: stream paytida ball cap darhol hisoblanadi
     system = (
         "You are a STRICT IELTS Writing examiner.\n"
-        "Return ONLY JSON keys:\n"
-        "score_20_75 (20..75), off_topic (true/false), feedback_uz (Uzbek), corrected_best_version (English).\n"
+        "Return ONLY JSON keys, in this order:\n"
+        "off_topic (true/false), score_20_75 (20..75), feedback_uz (Uzbek), "
+        + correction_instruction("the answers") + ".\n"
         "Be strict about task completion and relevance.\n"
     )
 
-    data = groq_chat_json(system, {
-        "prompts": prompts,
-        "answers": [
-            {"task": 1, "min_words": 50, "word_count": wc1, "text": answers[1]},
-            {"task": 2, "min_words": 120, "word_count": wc2, "text": answers[2]},
-            {"task": 3, "min_words": 180, "word_count": wc3, "text": answers[3]},
-        ],
-        "task_coverage": coverage
-    })
+    partial: Dict[str, Any] = {"task_coverage": coverage, "wc1": wc1, "wc2": wc2, "wc3": wc3}
+
+    async def on_field(key: str, value: Any):
+        if key == "off_topic":
+            partial["off_topic"] = bool(value)
+        elif key == "score_20_75":
+            try:
+                score = clamp_20_75(int(value))
+            except (TypeError, ValueError):
+                return
+            if capped or partial.get("off_topic"):
+                score = min(score, 37)
+            partial["score_20_75"] = score
+        elif key == "feedback_uz":
+            partial["feedback_uz"] = (safe_text(value).strip() or "—") + "\n\n" + advice
+        elif key == "corrected_best_version":
+            partial[key] = safe_text(value).strip()
+        elif key == "corrections":
+            partial["corrected_best_version"] = corrected_text({key: value}, full_text)
+        else:
+            return
+        await on_partial(dict(partial))
+
+    # har task budjeti talab qilingan so‘z soniga mutanosib; word_count asl matndan
+    items = []
+    text_tokens = 0
+    for t, m in zip(tasks, mins):
+        text, cut = normalize_answer(answers[t], EVAL_MAX_INPUT_TOKENS * m // sum(mins))
+        text_tokens += estimate_tokens(text)
+        items.append({"task": t, "min_words": m, "word_count": wcs[t], "text": text,
+                      **({"truncated": True} if cut else {})})
+    data = await cached_chat_json(
+        system, {"prompts": [prompts[t - 1] for t in tasks], "answers": items, "task_coverage": coverage},
+        on_field if on_partial else None,
+        WRITING_SCHEMA if EVAL_CORRECTION == "full" else WRITING_EDITS_SCHEMA,
+        output_budget(text_tokens),
+    )
 
     if not data:
-        # fallback
-        score = 20
-        if coverage == 2: score = 32
-        if coverage == 3: score = 45
-        score = clamp_20_75(score)
-        if coverage <= 1:
+        # fallback: har task lokal bahosi, task uzunligi bo‘yicha vaznlangan
+        score = clamp_20_75(round(sum(local_score(f, m) * m for f, m in zip(feats, mins)) / sum(mins)))
+        if capped:
             score = min(score, 37)  # A2 max
-        feedback = "Baholash xizmati ishlamadi. Word count va task bajarilishi bo‘yicha taxminiy natija.\n\n" + advice
+        feedback = ("Baholash xizmati ishlamadi. Lokal tahlil bo‘yicha taxminiy natija.\n"
+                    + features_line(feats) + "\n\n" + advice)
         corrected = full_text if full_text else "—"
         return {
             "score_20_75": score,
             "task_coverage": coverage,
-            "off_topic": True if coverage <= 1 else False,
+            "off_topic": capped,
             "feedback_uz": feedback,
             "corrected_best_version": corrected,
             "wc1": wc1, "wc2": wc2, "wc3": wc3,
@@ -487,11 +3074,11 @@ async def evaluate_writing_strict(prompts: List[Dict[str, str]], full_text: str)
     off_topic = bool(data.get("off_topic", False))
 
     # cap
-    if coverage <= 1 or off_topic:
+    if capped or off_topic:
         score = min(score, 37)
 
     feedback = safe_text(data.get("feedback_uz", "")).strip() or "—"
-    corrected = safe_text(data.get("corrected_best_version", "")).strip() or "—"
+    corrected = corrected_text(data, full_text) or "—"
 
     full_feedback = feedback + "\n\n" + advice
 
@@ -508,10 +3095,10 @@ async def evaluate_writing_strict(prompts: List[Dict[str, str]], full_text: str)
 # ======================
 # DICTIONARY
 # ======================
-def dict_lookup(word: str) -> Tuple[str, str, Optional[str]]:
+async def dict_lookup(word: str) -> Tuple[str, str, Optional[str]]:
     try:
-        r = requests.get(f"https://api.dictionaryapi.dev/api/v2/entries/en/{word}", timeout=15)
-        if r.status_code != 200:
+        r = await http_request("dict", "GET", f"{DICT_API_BASE}/{word}")
+        if r.status != 200:
             return ("—", "—", None)
         data = r.json()[0]
 
@@ -533,15 +3120,14 @@ def dict_lookup(word: str) -> Tuple[str, str, Optional[str]]:
     except Exception:
         return ("—", "—", None)
 
-def translate_uz(word: str) -> str:
+async def translate_uz(word: str) -> str:
     word = word.strip()
     if not word:
         return "—"
     try:
-        url = "https://translate.googleapis.com/translate_a/single"
         params = {"client": "gtx", "sl": "en", "tl": "uz", "dt": "t", "q": word}
-        r = requests.get(url, params=params, timeout=15)
-        if r.status_code == 200:
+        r = await http_request("translate", "GET", TRANSLATE_URL, params=params)
+        if r.status == 200:
             data = r.json()
             translated = "".join([chunk[0] for chunk in data[0] if chunk and chunk[0]])
             translated = (translated or "").strip()
@@ -551,20 +3137,255 @@ def translate_uz(word: str) -> str:
         pass
     return "Tarjima topilmadi."
 
-def download_to_temp(url: str, suffix: str) -> Optional[str]:
+async def download_bytes(url: str) -> Optional[bytes]:
     try:
-        r = requests.get(url, timeout=30)
-        if r.status_code != 200 or not r.content:
+        r = await http_request("media", "GET", url)
+        if r.status != 200 or not r.body:
             return None
-        fd, path = tempfile.mkstemp(suffix=suffix)
-        os.close(fd)
-        with open(path, "wb") as f:
-            f.write(r.content)
-        return path
+        return r.body
     except Exception:
         return None
 
 
+# ======================
+# DICTIONARY CACHE (SQLite, TTL + hajm bo‘yicha tozalash)
+# ======================
+class DictCache:
+    def __init__(self, ttl: float, max_rows: int):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0  # oxirgi tozalashdagi qatorlar soni
+        self._writes = 0
+        CACHES["dictionary"] = self
+
+    @staticmethod
+    def _get(conn, word: str, min_created: float) -> Optional[Dict]:
+        row = conn.execute(
+            "SELECT ipa, definition, audio_url, uz "
+            "FROM dict_cache WHERE word=? AND created_at>=?",
+            (word, min_created),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE dict_cache SET used_at=? WHERE word=?", (time.time(), word))
+        return dict(zip(("ipa", "definition", "audio_url", "uz"), row))
+
+    @staticmethod
+    def _put(conn, word: str, entry: Dict):
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO dict_cache "
+            "(word, ipa, definition, audio_url, uz, created_at, used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (word, entry.get("ipa"), entry.get("definition"), entry.get("audio_url"), entry.get("uz"), now, now),
+        )
+
+    @staticmethod
+    def _evict(conn, min_created: float, max_rows: int) -> Tuple[int, int]:
+        n = conn.execute("DELETE FROM dict_cache WHERE created_at<?", (min_created,)).rowcount
+        size = conn.execute("SELECT COUNT(*) FROM dict_cache").fetchone()[0]
+        if size > max_rows:
+            n += conn.execute(
+                "DELETE FROM dict_cache WHERE word IN "
+                "(SELECT word FROM dict_cache ORDER BY used_at LIMIT ?)",
+                (size - max_rows,),
+            ).rowcount
+            size = max_rows
+        return n, size
+
+    async def get(self, word: str) -> Optional[Dict]:
+        try:
+            entry = await db_run(self._get, word, time.time() - self.ttl)
+        except Exception as e:
+            print("DICT CACHE ERROR:", repr(e))
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def put(self, word: str, entry: Dict):
+        try:
+            await db_run(self._put, word, entry)
+            self._writes += 1
+            if self._writes % 100 == 1:
+                n, self.size = await db_run(self._evict, time.time() - self.ttl, self.max_rows)
+                self.evictions += n
+        except Exception as e:
+            print("DICT CACHE ERROR:", repr(e))
+
+    def stats(self) -> Dict[str, int]:
+        total = self.hits + self.misses
+        return {
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate_pct": round(100 * self.hits / total) if total else 0,
+            "evictions": self.evictions,
+        }
+
+
+dict_cache = DictCache(DICT_CACHE_TTL, DICT_CACHE_MAX)
+
+
+# ======================
+# MEDIA REGISTRY (manba URL -> Telegram file_id)
+# ======================
+class MediaRegistry:
+    # Bir marta yuklangan audio keyin faqat file_id bilan yuboriladi.
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        CACHES["media"] = self
+
+    @staticmethod
+    def key(url: str, kind: str) -> str:
+        # voice va audio alohida: ba'zi userlarga voice yuborib bo‘lmaydi (maxfiylik sozlamasi)
+        return hashlib.sha256(f"{kind}:{url}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _get(conn, voice_hash: str, audio_hash: str) -> Dict[str, str]:
+        return {kind: file_id for kind, file_id in conn.execute(
+            "SELECT kind, file_id FROM media_files WHERE url_hash IN (?, ?)", (voice_hash, audio_hash)
+        )}
+
+    @staticmethod
+    def _put(conn, url_hash: str, url: str, file_id: str, kind: str):
+        conn.execute(
+            "INSERT OR REPLACE INTO media_files (url_hash, url, file_id, kind, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (url_hash, url, file_id, kind, time.time()),
+        )
+
+    @staticmethod
+    def _drop(conn, url_hash: str):
+        conn.execute("DELETE FROM media_files WHERE url_hash=?", (url_hash,))
+
+    @staticmethod
+    def voice_forbidden(e: Exception) -> bool:
+        return "VOICE_MESSAGES_FORBIDDEN" in str(e)
+
+    async def prepare(self, url: str) -> Optional[Tuple[str, Any]]:
+        # ("file_id", {kind: file_id}) yoki ("bytes", mp3) — yuborishdan oldin tayyorlab qo‘yadi
+        try:
+            known = await db_run(self._get, self.key(url, "voice"), self.key(url, "audio"))
+        except Exception as e:
+            print("MEDIA REGISTRY ERROR:", repr(e))
+            known = None
+        if known:
+            return ("file_id", known)
+        data = await download_bytes(url)
+        return ("bytes", data) if data else None
+
+    async def send(self, message: Message, url: str, caption: str,
+                   prepared: Optional[Tuple[str, Any]] = None) -> bool:
+        if prepared is None:
+            prepared = await self.prepare(url)
+        if prepared is None:
+            return False
+
+        voice_ok = True
+        if prepared[0] == "file_id":
+            for kind in ("voice", "audio"):
+                file_id = prepared[1].get(kind)
+                if file_id is None or (kind == "voice" and not voice_ok):
+                    continue
+                try:
+                    if kind == "voice":
+                        await message.answer_voice(file_id, caption=caption)
+                    else:
+                        await message.answer_audio(file_id, caption=caption)
+                    self.hits += 1
+                    return True
+                except Exception as e:
+                    print("MEDIA FILE_ID FAILED:", repr(e))
+                    if kind == "voice" and self.voice_forbidden(e):
+                        voice_ok = False  # file_id to‘g‘ri, faqat shu userga voice mumkin emas
+                        continue
+                    # file_id eskirgan bo‘lishi mumkin: o‘chirib, qayta yuklaymiz
+                    try:
+                        await db_run(self._drop, self.key(url, kind))
+                    except Exception as de:
+                        print("MEDIA REGISTRY ERROR:", repr(de))
+            data = await download_bytes(url)
+            if not data:
+                return False
+            prepared = ("bytes", data)
+
+        self.misses += 1
+        upload = BufferedInputFile(prepared[1], filename="pronunciation.mp3")
+        sent = None
+        if voice_ok:
+            try:
+                sent = await message.answer_voice(upload, caption=caption)
+                file_id, kind = sent.voice.file_id, "voice"
+            except Exception as e:
+                print("MEDIA VOICE UPLOAD FAILED:", repr(e))
+        if sent is None:
+            sent = await message.answer_audio(upload, caption=caption)
+            file_id, kind = sent.audio.file_id, "audio"
+        self.uploads += 1
+        try:
+            await db_run(self._put, self.key(url, kind), url, file_id, kind)
+        except Exception as e:
+            print("MEDIA REGISTRY ERROR:", repr(e))
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate_pct": round(100 * self.hits / total) if total else 0,
+            "uploads": self.uploads,
+        }
+
+
+media_registry = MediaRegistry()
+
+
+# ======================
+# DICTIONARY FAN-OUT (definition + tarjima parallel, audio URL kelishi bilan)
+# ======================
+async def dict_fanout(word: str, deadline: float) -> Tuple[Dict, Optional[asyncio.Task]]:
+    loop = asyncio.get_running_loop()
+    lookup_task = asyncio.create_task(dict_lookup(word))
+    uz_task = asyncio.create_task(translate_uz(word))
+    audio_task: Optional[asyncio.Task] = None
+    entry = {"ipa": "—", "definition": "—", "audio_url": None, "uz": "—"}
+
+    pending = {lookup_task, uz_task}
+    while pending:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            if t is lookup_task:
+                ipa, definition, audio_url = t.result()
+                if audio_url and audio_url.startswith("//"):
+                    audio_url = "https:" + audio_url
+                entry.update(ipa=ipa, definition=definition, audio_url=audio_url)
+                if audio_url:
+                    audio_task = asyncio.create_task(media_registry.prepare(audio_url))
+            else:
+                entry["uz"] = t.result()
+
+    # muddat tugadi: qolganini bekor qilamiz, qisman natija qaytadi
+    for t in pending:
+        t.cancel()
+
+    # topilmagan/vaqtincha xato yoki to‘liq bo‘lmagan natijalar keshlanmaydi
+    if not pending and entry["definition"] != "—" and entry["uz"] != "Tarjima topilmadi.":
+        await dict_cache.put(word, entry)
+    return entry, audio_task
+
+
 # ======================
 # /start + check_sub + admin
 # ======================
@@ -577,45 +3398,671 @@ async def start(message: Message):
 
 @dp.callback_query(F.data == "check_sub")
 async def check_sub(call: CallbackQuery):
-    if await is_subscribed(bot, call.from_user.id):
+    if await is_subscribed(bot, call.from_user.id, force=True):
         await call.message.answer("✅ Obuna tasdiqlandi! Endi bot ishlaydi.", reply_markup=main_menu())
     else:
         await call.message.answer("❌ Hali obuna emassiz.", reply_markup=sub_keyboard())
     await call.answer()
 
 
+def admin_summary() -> List[str]:
+    lines = ["👑 Admin panel", ""]
+    lines.append(f"👥 Userlar: {len(analytics.sorted_uids)} | DAU: {analytics.dau()} | WAU: {analytics.wau()}")
+    lines.append("📈 Jami: " + " | ".join(
+        f"{title}: {analytics.totals.get(section, 0)}" for section, title in ADMIN_COLUMNS))
+    for title, started, done in FUNNELS:
+        a = analytics.totals.get(started, 0)
+        b = analytics.totals.get(done, 0)
+        pct = f" ({round(100 * b / a)}%)" if a else ""
+        lines.append(f"🔻 {title}: {a} boshlandi → {b} tugadi{pct}")
+    top = analytics.top_users()[:5]
+    if top:
+        lines.append("🏆 Top: " + ", ".join(f"{uid} ({n})" for uid, n in top))
+    return lines
+
+def admin_page(page: int) -> Tuple[str, InlineKeyboardMarkup]:
+    uids = analytics.sorted_uids
+    pages = max(1, (len(uids) + ADMIN_PAGE_SIZE - 1) // ADMIN_PAGE_SIZE)
+    page = max(0, min(page, pages - 1))
+    lines = admin_summary()
+    lines += ["", f"Sahifa {page + 1}/{pages}",
+              "ID | " + " | ".join(title for _, title in ADMIN_COLUMNS), "---|---|---|---"]
+    for uid in uids[page * ADMIN_PAGE_SIZE:(page + 1) * ADMIN_PAGE_SIZE]:
+        u = str(uid)
+        lines.append(f"{u} | " + " | ".join(
+            str(int(stats.get(section, {}).get(u, 0))) for section, _ in ADMIN_COLUMNS))
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"adm:p:{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"adm:p:{page + 1}"))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(text="📄 CSV", callback_data="adm:csv")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+def admin_csv(uids: List[int], snapshot: Dict[str, Dict[str, int]]) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["user_id"] + [title.lower() for _, title in ADMIN_COLUMNS])
+    for uid in uids:
+        u = str(uid)
+        w.writerow([u] + [int(snapshot.get(section, {}).get(u, 0)) for section, _ in ADMIN_COLUMNS])
+    return buf.getvalue().encode("utf-8")
+
+
 @dp.message(Command("admin"))
 async def admin_panel(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("❌ Siz admin emassiz.")
         return
 
-    exams = stats.get("exams_completed", {})
-    looks = stats.get("dict_lookups", {})
-    writes = stats.get("writings_completed", {})
-    user_ids = set(exams.keys()) | set(looks.keys()) | set(writes.keys())
-
-    if not user_ids:
+    await refresh_stats()
+    if not analytics.sorted_uids:
         await message.answer("📭 Hozircha statistika yo‘q.")
         return
 
-    lines = ["👑 Admin panel", "", "ID | Speaking | Dictionary | Writing", "---|---|---|---"]
-    for uid in sorted(user_ids, key=lambda x: int(x)):
-        lines.append(f"{uid} | {int(exams.get(uid, 0))} | {int(looks.get(uid, 0))} | {int(writes.get(uid, 0))}")
+    text, kb = admin_page(0)
+    await message.answer(text, reply_markup=kb)
+
+
+@dp.callback_query(F.data.startswith("adm:"))
+async def admin_callback(call: CallbackQuery):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer("❌ Siz admin emassiz.")
+        return
+
+    if call.data == "adm:csv":
+        await call.answer("📄 Tayyorlanmoqda...")
+        await refresh_stats()
+        uids = list(analytics.sorted_uids)
+        snapshot = {section: dict(stats.get(section, {})) for section, _ in ADMIN_COLUMNS}
+        data = await asyncio.to_thread(admin_csv, uids, snapshot)
+        await call.message.answer_document(
+            BufferedInputFile(data, filename=f"stats_{Analytics.day()}.csv"),
+            caption=f"👥 {len(uids)} user",
+        )
+        return
+
+    page = int(call.data.rsplit(":", 1)[1])
+    await refresh_stats()
+    text, kb = admin_page(page)
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await call.answer()
+
+
+@dp.message(Command("cache"))
+async def admin_cache(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Siz admin emassiz.")
+        return
+
+    lines = ["🗄 Cache", ""]
+    for name, cache in CACHES.items():
+        st = cache.stats()
+        lines.append(f"{name}: " + " ".join(f"{k}={v}" for k, v in st.items()))
     await message.answer("\n".join(lines))
 
 
+@dp.message(Command("models"))
+async def admin_models(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Siz admin emassiz.")
+        return
+
+    lines = ["🤖 Modellar (tartib bo‘yicha)", ""]
+    for m in model_router.snapshot():
+        status = f"🔴 ochiq ({m['open_for_s']}s)" if m["open"] else "🟢"
+        latency = f"{m['latency_ms']}ms" if m["latency_ms"] is not None else "—"
+        lines.append(
+            f"{status} {m['model']}: {latency} err={m['error_rate']} "
+            f"calls={m['calls']} fail={m['failures']} last={m['last_error'] or '—'}"
+        )
+    lines.append(f"\nHedge: {'on' if ROUTER_HEDGE else 'off'}")
+    lines.append("JSON: " + " ".join(f"{k}={v}" for k, v in eval_json_stats.items()))
+    await message.answer("\n".join(lines))
+
+
+@dp.message(Command("load"))
+async def admin_load(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Siz admin emassiz.")
+        return
+
+    st = heavy_gate.stats()
+    counts = await db_run(_job_counts)
+    await message.answer(
+        "🚦 Yuklama\n\n"
+        f"Og‘ir ishlar: {st['active']}/{st['limit']} faol, {st['waiting']} navbatda "
+        f"({st['users_waiting']} user), batch navbatda: {st['low_waiting']}\n"
+        f"Bajarilgan: {st['served']} | Rad etilgan: {st['shed']}\n"
+        f"Rate limit: {rate_limiter.dropped} xabar tashlandi\n"
+        f"Transcode: {transcoder.pending}/{transcoder.max_queue} navbatda\n"
+        f"VAD: {vad_seconds.values.get(('removed',), 0):.0f}s / {vad_seconds.values.get(('input',), 0):.0f}s "
+        f"jimlik kesildi, {vad_notes.values.get(('no_speech',), 0):g} ta bo‘sh voice rad etildi\n"
+        "Baholash navbati: " + " ".join(f"{k}={v}" for k, v in counts.items()) + "\n"
+        "Hodisalar jurnali: " + " ".join(f"{k}={v}" for k, v in event_log.stats().items())
+    )
+
+
+@dp.message(Command("tokens"))
+async def admin_tokens(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Siz admin emassiz.")
+        return
+
+    await token_ledger.flush()
+    day = Analytics.day()
+    by_model, by_user = await db_run(_token_report, day)
+    lines = [f"🔢 Tokenlar ({day})", ""]
+    for model, pt, ct, calls in by_model:
+        quota = f" / {TOKEN_QUOTA_MODEL_DAILY}" if TOKEN_QUOTA_MODEL_DAILY > 0 else ""
+        lines.append(f"{model}: in={pt} out={ct} (jami {pt + ct}{quota}), {calls} chaqiruv")
+    if by_user:
+        lines.append("")
+        quota = f" / {TOKEN_QUOTA_USER_DAILY}" if TOKEN_QUOTA_USER_DAILY > 0 else ""
+        lines.append("Top userlar: " + ", ".join(f"{uid}: {t}{quota}" for uid, t in by_user))
+    if len(lines) == 2:
+        lines.append("📭 Bugun hali sarf yo‘q.")
+    lines.append("")
+    lines.append(f"Correction rejimi: {EVAL_CORRECTION}, input budjeti: {EVAL_MAX_INPUT_TOKENS}")
+    await message.answer("\n".join(lines))
+
+
+REPORT_TITLES = {"exam": "🎤 Speaking", "writing": "✍️ Writing", "lookup": "📚 Dictionary"}
+
+def format_report(day: str, rollup: Dict[str, Dict]) -> str:
+    lines = [f"📊 Hisobot: {day}"]
+    if not rollup:
+        lines.append("\n📭 Bu kunda hodisa yo‘q.")
+    for kind, r in sorted(rollup.items()):
+        lines.append(f"\n{REPORT_TITLES.get(kind, kind)}: {r['count']} ta, {r['users']} user")
+        if "score_avg" in r:
+            lines.append(f"Ball: o‘rtacha {r['score_avg']}, median {r['score_p50']}")
+        if r.get("cefr"):
+            lines.append("CEFR: " + ", ".join(f"{k}={v}" for k, v in sorted(r["cefr"].items())))
+        if r.get("model"):
+            lines.append("Model: " + ", ".join(f"{k}={v}" for k, v in r["model"].items()))
+        for name, lat in r.get("latency", {}).items():
+            lines.append(f"{name}: p50={lat['p50']}s p95={lat['p95']}s max={lat['max']}s")
+    return "\n".join(lines)
+
+@dp.message(Command("report"))
+async def admin_report(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Siz admin emassiz.")
+        return
+
+    # /report -> bugun, /report 1 -> kecha, /report 2026-01-31
+    arg = (message.text or "").split(maxsplit=1)[1:]
+    arg = arg[0].strip() if arg else "0"
+    if arg.isdigit():
+        day = Analytics.day(time.time() - int(arg) * 86400)
+    elif re.fullmatch(r"\d{4}-\d{2}-\d{2}", arg):
+        day = arg
+    else:
+        await message.answer("Masalan: /report, /report 1 (kecha) yoki /report 2026-01-31")
+        return
+
+    await event_log.flush()
+    rollup = await asyncio.to_thread(event_log.day_report, day)
+    await message.answer(format_report(day, rollup))
+
+
 # ======================
 # BACK
 # ======================
 @dp.message(F.text == "⬅️ Orqaga")
 async def back_to_menu(message: Message, state: FSMContext):
+    drop_speaking_session(message)
+    batch_sessions.pop(message.from_user.id, None)
     await state.clear()
     if not await require_sub(message):
         return
     await message.answer("🏠 Asosiy menyu:", reply_markup=main_menu())
 
 
+# ======================
+# NATIJA (bitta xabar, maydonlar kelishi bilan tahrirlanadi)
+# ======================
+TG_TEXT_LIMIT = 4096
+
+class ProgressMessage:
+    def __init__(self, chat_id: int, message_id: int, text: str = ""):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.last_edit = 0.0
+        self._pending: Optional[str] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # tahrirlar ketma-ket: kechikkan eski matn yakuniy matndan keyin tushmaydi
+        self._lock = asyncio.Lock()
+
+    async def update(self, text: str, force: bool = False):
+        # Telegram edit limitlari uchun PROGRESS_EDIT_INTERVAL dan tez tahrirlanmaydi;
+        # oraliqda kelgan oxirgi matn keyinroq yuboriladi
+        self._pending = text[:TG_TEXT_LIMIT]
+        wait = PROGRESS_EDIT_INTERVAL - (time.monotonic() - self.last_edit)
+        if force or wait <= 0:
+            if self._flush_task is not None:
+                self._flush_task.cancel()
+                self._flush_task = None
+            await self._edit()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed(wait))
+
+    async def _delayed(self, wait: float):
+        await asyncio.sleep(wait)
+        self._flush_task = None
+        await self._edit()
+
+    async def _edit(self):
+        async with self._lock:
+            text, self._pending = self._pending, None
+            if text is None or text == self.text:
+                return
+            try:
+                await bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id)
+                self.text = text
+                self.last_edit = time.monotonic()
+            except TelegramAPIError as e:
+                # RetryAfter/tarmoq xatosi ham: job to‘xtamaydi, natija baribir yuboriladi
+                print("PROGRESS EDIT ERROR:", repr(e))
+
+def score_block(res: Dict, title: str) -> List[str]:
+    if "score_20_75" not in res:
+        return [f"📊 Natija ({title}):", "⏳ Ball hisoblanmoqda..."]
+    score = clamp_20_75(int(res.get("score_20_75", 20)))
+    cefr = cefr_from_score_20_75(score)
+    return [
+        f"📊 Natija ({title}):",
+        f"🏷 CEFR: {cefr}",
+        f"🎯 IELTS (taxminiy): {ielts_from_cefr(cefr)}",
+        f"⭐ Umumiy ball: {score}/75",
+    ]
+
+def speaking_result_text(res: Dict) -> str:
+    lines = score_block(res, "Speaking")
+    lines.append("")
+    lines.append(f"🧠 Izoh (UZ): {res['feedback_uz'] or '—'}" if "feedback_uz" in res else "🧠 Izoh: ⏳")
+    return "\n".join(lines)
+
+def writing_result_text(res: Dict) -> str:
+    lines = score_block(res, "Writing")
+    lines.append("")
+    lines.append(f"🧾 Task coverage: {int(res.get('task_coverage', 0) or 0)}/3")
+    lines.append(
+        f"🔢 Word count: 1) {int(res.get('wc1', 0) or 0)} | "
+        f"2) {int(res.get('wc2', 0) or 0)} | 3) {int(res.get('wc3', 0) or 0)}"
+    )
+    lines.append("")
+    if "feedback_uz" in res:
+        lines.append(f"🧠 Izoh (UZ):\n{safe_text(res['feedback_uz']).strip() or '—'}")
+    else:
+        lines.append("🧠 Izoh: ⏳")
+    return "\n".join(lines)
+
+
+# ======================
+# EVAL JOBS (SQLite navbat + workerlar)
+# ======================
+WORKER_ID = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+_jobs_wakeup: Optional[asyncio.Event] = None
+_jobs_purged_at = 0.0
+_jobs_expired_at = 0.0
+
+def _job_insert(conn, kind: str, dedupe_key: str, payload: str, chat_id: int, user_id: int) -> Tuple[int, bool]:
+    # (id, yangi) — xuddi shu topshiriq navbatda/ishlanayotgan bo‘lsa o‘sha qaytadi.
+    # BEGIN IMMEDIATE: boshqa jarayon SELECT va INSERT orasiga kira olmaydi
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT id FROM eval_jobs WHERE dedupe_key=? AND status IN ('pending', 'running')", (dedupe_key,)
+        ).fetchone()
+        if row:
+            conn.execute("COMMIT")
+            return row[0], False
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM eval_jobs WHERE status='pending' AND kind!='batch_item'").fetchone()[0]
+        if pending >= JOB_QUEUE_MAX:
+            raise Overloaded()
+        now = time.time()
+        cur = conn.execute(
+            "INSERT INTO eval_jobs (kind, dedupe_key, payload, chat_id, user_id, next_run_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (kind, dedupe_key, payload, chat_id, user_id, now, now, now),
+        )
+        conn.execute("COMMIT")
+        return cur.lastrowid, True
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _job_claim(conn, worker: str, allow_batch: bool = True) -> Optional[Tuple]:
+    # pending yoki lease i tugagan running (yiqilgan worker) ish olinadi; batch ishlari oxirida.
+    # urinishlari tugagan yiqilgan ishlarni _job_expire yopadi
+    now = time.time()
+    return conn.execute(
+        "UPDATE eval_jobs SET status='running', locked_by=?, locked_until=?, attempts=attempts+1, updated_at=? "
+        "WHERE id=(SELECT id FROM eval_jobs WHERE "
+        "((status='pending' AND next_run_at<=?) OR (status='running' AND locked_until<? AND attempts<?)) "
+        "AND (? OR kind!='batch_item') "
+        "ORDER BY kind='batch_item', id LIMIT 1) "
+        "RETURNING id, kind, payload, chat_id, user_id, attempts",
+        (worker, now + JOB_LEASE, now, now, now, JOB_MAX_ATTEMPTS, allow_batch),
+    ).fetchone()
+
+def _job_expire(conn) -> List[Tuple]:
+    # har urinishda worker yiqilgan (lease tugagan) ishlar: qayta olinmaydi, failed bo‘ladi
+    now = time.time()
+    return conn.execute(
+        "UPDATE eval_jobs SET status='failed', error='lease expired', locked_by=NULL, locked_until=NULL, "
+        "updated_at=? WHERE status='running' AND locked_until<? AND attempts>=? "
+        "RETURNING id, kind, payload, chat_id, user_id",
+        (now, now, JOB_MAX_ATTEMPTS),
+    ).fetchall()
+
+def _job_extend(conn, job_id: int, worker: str):
+    conn.execute(
+        "UPDATE eval_jobs SET locked_until=? WHERE id=? AND locked_by=?",
+        (time.time() + JOB_LEASE, job_id, worker),
+    )
+
+def _job_finish(conn, job_id: int, status: str, error: str = "", retry_in: float = 0.0):
+    now = time.time()
+    conn.execute(
+        "UPDATE eval_jobs SET status=?, error=?, next_run_at=?, locked_by=NULL, locked_until=NULL, updated_at=? "
+        "WHERE id=?",
+        (status, error[:500], now + retry_in, now, job_id),
+    )
+
+def _job_purge(conn, before: float) -> int:
+    old = [(r[0],) for r in conn.execute(
+        "SELECT id FROM batches WHERE status IN ('sent', 'cancelled', 'failed') AND updated_at<?", (before,))]
+    conn.executemany("DELETE FROM batch_results WHERE batch_id=?", old)
+    conn.executemany("DELETE FROM batches WHERE id=?", old)
+    return conn.execute(
+        "DELETE FROM eval_jobs WHERE status IN ('done', 'failed') AND updated_at<?", (before,)
+    ).rowcount
+
+def _job_counts(conn) -> Dict[str, int]:
+    return dict(conn.execute("SELECT status, COUNT(*) FROM eval_jobs GROUP BY status").fetchall())
+
+async def enqueue_eval(kind: str, payload: Dict, chat_id: int, user_id: int) -> Tuple[int, bool]:
+    payload = {**payload, "enqueued_at": time.time()}
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    dedupe_src = json.dumps(
+        {"kind": kind, "chat": chat_id, "input": _normalize_for_key(
+            {k: v for k, v in payload.items() if k not in ("progress_message_id", "enqueued_at")})},
+        ensure_ascii=False, sort_keys=True,
+    )
+    dedupe_key = hashlib.sha256(dedupe_src.encode("utf-8")).hexdigest()
+    job_id, created = await db_run(_job_insert, kind, dedupe_key, body, chat_id, user_id)
+    if created and _jobs_wakeup is not None:
+        _jobs_wakeup.set()
+    return job_id, created
+
+def log_eval_event(kind: str, user_id: int, payload: Dict, res: Dict, t0: float):
+    score = res.get("score_20_75")
+    event_log.append(
+        kind, user_id,
+        score=score,
+        cefr=cefr_from_score_20_75(score) if isinstance(score, int) else None,
+        queue_s=round(t0 - payload["enqueued_at"], 3) if payload.get("enqueued_at") else None,
+        eval_s=round(time.time() - t0, 3),
+        model=eval_model.get(),
+    )
+
+async def run_speaking_job(payload: Dict, chat_id: int, user_id: int):
+    progress = ProgressMessage(chat_id, payload["progress_message_id"])
+    t0 = time.time()
+    eval_model.set("cache")
+    eval_user.set(user_id)
+    async with heavy_gate.slot(user_id, progress_notifier(progress)):
+        with stage_seconds.time("speaking.evaluate"):
+            res = await evaluate_speaking_strict(
+                payload["questions"][:3], payload["answers"][:3],
+                lambda part: progress.update(speaking_result_text(part)),
+            )
+    log_eval_event("exam", user_id, payload, res, t0)
+    with stage_seconds.time("speaking.send"):
+        await progress.update(speaking_result_text(res), force=True)
+        await bot.send_message(
+            chat_id,
+            f"✅ To‘g‘rilangan eng yaxshi variant:\n{res.get('corrected_best_version','—')}",
+            reply_markup=main_menu()
+        )
+    inc_stat("exams_completed", user_id, 1)
+
+async def run_writing_job(payload: Dict, chat_id: int, user_id: int):
+    progress = ProgressMessage(chat_id, payload["progress_message_id"])
+    t0 = time.time()
+    eval_model.set("cache")
+    eval_user.set(user_id)
+    async with heavy_gate.slot(user_id, progress_notifier(progress)):
+        with stage_seconds.time("writing.evaluate"):
+            res = await evaluate_writing_strict(
+                payload["prompts"], payload["full_text"],
+                lambda part: progress.update(writing_result_text(part)),
+            )
+    log_eval_event("writing", user_id, payload, res, t0)
+    corrected = safe_text(res.get("corrected_best_version", "")).strip() or "—"
+    with stage_seconds.time("writing.send"):
+        await progress.update(writing_result_text(res), force=True)
+        await bot.send_message(
+            chat_id,
+            f"✅ To‘g‘rilangan eng yaxshi variant:\n{corrected}",
+            reply_markup=main_menu()
+        )
+    inc_stat("writings_completed", user_id, 1)
+
+JOB_RUNNERS: Dict[str, Callable[[Dict, int, int], Awaitable[None]]] = {
+    "speaking": run_speaking_job,
+    "writing": run_writing_job,
+}
+# oxirgi urinish ham yiqilganda (standart: foydalanuvchiga xato xabari)
+JOB_FAILERS: Dict[str, Callable[[Dict, int, int, str], Awaitable[None]]] = {}
+
+async def notify_job_failed(payload: Dict, chat_id: int, user_id: int, error: str):
+    await bot.send_message(
+        chat_id, "❌ Baholashda xatolik bo‘ldi. Iltimos, qaytadan urinib ko‘ring.",
+        reply_markup=main_menu()
+    )
+
+# bitta jarayonda bir vaqtda ishlayotgan batch ishlari (oddiy ishlarga worker qolsin)
+_batch_running = 0
+
+async def _keep_lease(job_id: int, worker: str):
+    # locked_by = claim qilgan worker ("<WORKER_ID>:<n>"), aks holda lease uzaymaydi
+    while True:
+        await asyncio.sleep(JOB_LEASE / 3)
+        await db_run(_job_extend, job_id, worker)
+
+async def purge_old_jobs():
+    # bo‘sh turgan worker soatiga bir marta eski ishlarni tozalaydi
+    global _jobs_purged_at
+    now = time.time()
+    if JOB_RETENTION <= 0 or now - _jobs_purged_at < JOB_PURGE_INTERVAL:
+        return
+    _jobs_purged_at = now
+    try:
+        n = await db_run(_job_purge, now - JOB_RETENTION)
+        if n:
+            print(f"JOBS: {n} ta eski ish o‘chirildi")
+    except Exception as e:
+        print("JOB PURGE ERROR:", repr(e))
+
+async def run_job_failer(job_id: int, kind: str, payload: str, chat_id: int, user_id: int, error: str):
+    try:
+        await JOB_FAILERS.get(kind, notify_job_failed)(json.loads(payload), chat_id, user_id, error)
+    except Exception as fe:
+        print(f"JOB {job_id} ({kind}) FAIL HOOK ERROR:", repr(fe))
+
+async def expire_stale_jobs():
+    # lease tekshiruvi tez-tez kerak emas: JOB_LEASE ning to‘rtdan biri
+    global _jobs_expired_at
+    now = time.time()
+    if now - _jobs_expired_at < JOB_LEASE / 4:
+        return
+    _jobs_expired_at = now
+    try:
+        expired = await db_run(_job_expire)
+    except Exception as e:
+        print("JOB EXPIRE ERROR:", repr(e))
+        return
+    for job_id, kind, payload, chat_id, user_id in expired:
+        print(f"JOB {job_id} ({kind}) ERROR: lease expired after {JOB_MAX_ATTEMPTS} attempts")
+        await run_job_failer(job_id, kind, payload, chat_id, user_id, "lease expired")
+
+async def eval_worker(n: int):
+    global _batch_running
+    worker = f"{WORKER_ID}:{n}"
+    batch_limit = max(1, min(BATCH_CONCURRENCY, EVAL_WORKERS - 1))
+    while True:
+        await expire_stale_jobs()
+        # batch uchun joy oldindan band qilinadi: bir vaqtda claim qilgan workerlar limitdan oshmaydi
+        allow_batch = _batch_running < batch_limit
+        _batch_running += allow_batch
+        try:
+            job = await db_run(_job_claim, worker, allow_batch)
+        except Exception as e:
+            print("JOB CLAIM ERROR:", repr(e))
+            job = None
+        is_batch = job is not None and job[1] == "batch_item"
+        if allow_batch and not is_batch:
+            _batch_running -= 1
+        if job is None:
+            await purge_old_jobs()
+            try:
+                await asyncio.wait_for(_jobs_wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _jobs_wakeup.clear()
+            continue
+
+        job_id, kind, payload, chat_id, user_id, attempts = job
+        lease = asyncio.create_task(_keep_lease(job_id, worker))
+        try:
+            await JOB_RUNNERS[kind](json.loads(payload), chat_id, user_id)
+        except asyncio.CancelledError:
+            # to‘xtatilyapti: ish pending ga qaytadi, keyingi ishga tushishda davom etadi
+            await asyncio.shield(db_run(_job_finish, job_id, "pending", "shutdown"))
+            raise
+        except Exception as e:
+            print(f"JOB {job_id} ({kind}) ERROR:", repr(e))
+            if attempts < JOB_MAX_ATTEMPTS:
+                await db_run(_job_finish, job_id, "pending", repr(e), 5.0 * 2 ** attempts)
+            else:
+                await db_run(_job_finish, job_id, "failed", repr(e))
+                await run_job_failer(job_id, kind, payload, chat_id, user_id, repr(e))
+        else:
+            await db_run(_job_finish, job_id, "done")
+        finally:
+            lease.cancel()
+            if is_batch:
+                _batch_running -= 1
+
+def start_eval_workers() -> List[asyncio.Task]:
+    global _jobs_wakeup
+    _jobs_wakeup = asyncio.Event()
+    return [asyncio.create_task(eval_worker(i)) for i in range(max(1, EVAL_WORKERS))]
+
+
+# ======================
+# SPEAKING: fon transkripsiya
+# ======================
+class SpeakingSession:
+    # Bitta foydalanuvchining ketayotgan imtihoni: savol indeksi -> STT task.
+    # Tasklar shu jarayonda yashaydi; FSM da faqat tayyor matnlar saqlanadi.
+    def __init__(self):
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.vad: Dict[int, Dict[str, Any]] = {}  # savol indeksi -> VAD hisoboti
+        self.lock = asyncio.Lock()
+        self.touched = time.monotonic()
+
+    def cancel(self):
+        for t in self.tasks.values():
+            t.cancel()
+        self.tasks.clear()
+
+
+speaking_sessions: Dict[Tuple[int, int], SpeakingSession] = {}
+
+def speaking_key(message: Message) -> Tuple[int, int]:
+    return (message.chat.id, message.from_user.id)
+
+def drop_speaking_session(message: Message):
+    sess = speaking_sessions.pop(speaking_key(message), None)
+    if sess:
+        sess.cancel()
+
+def sweep_speaking_sessions(ttl: float = FSM_TTL) -> int:
+    # tashlab ketilgan imtihonlar: FSM yozuvi o‘chgach sessiya ham (tasklari bilan) o‘chadi
+    cutoff = time.monotonic() - ttl
+    stale = [k for k, sess in speaking_sessions.items() if sess.touched < cutoff and not sess.lock.locked()]
+    for k in stale:
+        speaking_sessions.pop(k).cancel()
+    return len(stale)
+
+async def transcribe_answer(user_id: int, file_id: str, report: Optional[Dict[str, Any]] = None,
+                            notify: Optional[Callable[[int], Awaitable[Any]]] = None) -> str:
+    report = {} if report is None else report
+    async with heavy_gate.slot(user_id, notify):
+        with stage_seconds.time("stt.download"):
+            file = await bot.get_file(file_id)
+            ogg = await bot.download_file(file.file_path)
+        try:
+            return await transcribe_voice(ogg.getvalue(), report)
+        finally:
+            if report:
+                event_log.append("stt", user_id, audio_s=report["audio_s"], speech_s=report["speech_s"],
+                                 kept_s=report["kept_s"], truncated=report["truncated"])
+
+def vad_note(reports: Dict[int, Dict[str, Any]]) -> str:
+    # "✂️ ..." qatori: qancha jimlik olib tashlangani va kesilgan javoblar
+    total = sum(r.get("audio_s", 0) for r in reports.values())
+    kept = sum(r.get("kept_s", 0) for r in reports.values())
+    if total <= 0:
+        return ""
+    note = f"\n\n✂️ Jimlik olib tashlandi: {total - kept:.1f}s / {total:.1f}s"
+    cut = [str(i + 1) for i, r in sorted(reports.items()) if r.get("truncated")]
+    if cut:
+        note += f"\n⚠️ {', '.join(cut)}-javob {SPEAKING_MAX_SECONDS:g}s dan keyin kesildi."
+    return note
+
+def next_unanswered(answers: List[str], sess: SpeakingSession) -> Optional[int]:
+    for i in range(3):
+        if not answers[i] and i not in sess.tasks:
+            return i
+    return None
+
+async def collect_transcripts(answers: List[str], sess: SpeakingSession) -> Tuple[List[int], Optional[Exception]]:
+    # Hamma tasklarni kutadi; muvaffaqiyatsiz indekslar va birinchi xato qaytadi.
+    failed: List[int] = []
+    first_err: Optional[Exception] = None
+    for i in range(3):
+        if answers[i]:
+            continue
+        task = sess.tasks.pop(i, None)
+        text = ""
+        if task is not None:
+            try:
+                text = await task
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"SPEAKING STT ({i+1}) ERROR:", repr(e))
+                first_err = first_err or e
+        if text:
+            answers[i] = text
+        else:
+            failed.append(i)
+    return failed, first_err
+
+
 # ======================
 # SPEAKING (FULL)
 # ======================
@@ -627,8 +4074,14 @@ async def speaking_start(message: Message, state: FSMContext):
         await message.answer("❌ GROQ_API_KEY yo‘q. Render/PC env ga qo‘ying.")
         return
 
+    drop_speaking_session(message)
+    left = await quota_left(message.from_user.id)
+    if left is not None and left <= 0:
+        await message.answer(QUOTA_TEXT, reply_markup=main_menu())
+        return
+    inc_stat("speaking_started", message.from_user.id, 1)
     questions = random.sample(SPEAKING_QUESTION_BANK, k=3)
-    await state.update_data(questions=questions, q_index=0, answers=[])
+    await state.update_data(questions=questions, q_index=0, answers=["", "", ""])
     await state.set_state(SpeakingStates.answering)
 
     await message.answer(
@@ -644,6 +4097,7 @@ async def speaking_voice(message: Message, state: FSMContext):
         return
 
     if message.text and message.text.strip().lower() == "⬅️ orqaga":
+        drop_speaking_session(message)
         await state.clear()
         await message.answer("🏠 Asosiy menyu:", reply_markup=main_menu())
         return
@@ -651,76 +4105,83 @@ async def speaking_voice(message: Message, state: FSMContext):
     if not message.voice:
         await message.answer("Iltimos, faqat VOICE yuboring. 🎤")
         return
+    if message.voice.duration and message.voice.duration > SPEAKING_MAX_VOICE_SECONDS:
+        # yuklab olishdan oldin: uzun fayl tarmoq va ffmpeg ga umuman chiqmaydi
+        vad_notes.inc("too_long")
+        await message.answer(
+            f"❌ Javob juda uzun ({message.voice.duration}s). "
+            f"{SPEAKING_MAX_VOICE_SECONDS}s dan qisqaroq voice yuboring."
+        )
+        return
 
-    data = await state.get_data()
-    questions = data.get("questions") or random.sample(SPEAKING_QUESTION_BANK, k=3)
-    q_index = int(data.get("q_index", 0))
-    answers: List[str] = data.get("answers", [])
-
-    ogg_fd, ogg_path = tempfile.mkstemp(suffix=".ogg")
-    wav_fd, wav_path = tempfile.mkstemp(suffix=".wav")
-    os.close(ogg_fd)
-    os.close(wav_fd)
-
-    try:
-        file = await bot.get_file(message.voice.file_id)
-        await bot.download_file(file.file_path, destination=ogg_path)
-
-        try:
-            await convert_ogg_to_wav(ogg_path, wav_path)
-        except Exception:
-            await message.answer(
-                "❌ Voice ishlamadi: ffmpeg yo‘q bo‘lishi mumkin.\n"
-                "✅ PC’da: ffmpeg o‘rnating.\n"
-                "✅ Render’da: ffmpeg qo‘shish kerak."
-            )
-            return
-
-        await message.answer("🎧 Ovoz matnga aylantirilmoqda...")
-        transcript = groq_stt_whisper(wav_path)
-
-        if not transcript:
-            await message.answer("❌ Ovoz tushunilmadi. Sekinroq va aniqroq yuboring.")
+    key = speaking_key(message)
+    sess = speaking_sessions.setdefault(key, SpeakingSession())
+    sess.touched = time.monotonic()
+
+    async with sess.lock:
+        data = await state.get_data()
+        questions = data.get("questions") or random.sample(SPEAKING_QUESTION_BANK, k=3)
+        answers: List[str] = (list(data.get("answers") or []) + ["", "", ""])[:3]
+        q_index = int(data.get("q_index", 0))
+        if answers[q_index] or q_index in sess.tasks:
+            q_index = next_unanswered(answers, sess)
+            if q_index is None:
+                return
+
+        # STT fonda ketadi, keyingi savol darhol yuboriladi
+        sess.vad[q_index] = {}
+        sess.tasks[q_index] = asyncio.create_task(
+            transcribe_answer(message.from_user.id, message.voice.file_id, sess.vad[q_index],
+                              queue_notifier(message)))
+
+        nxt = next_unanswered(answers, sess)
+        if nxt is not None:
+            await state.update_data(questions=questions, answers=answers, q_index=nxt)
+            await message.answer(f"✅ Qabul qilindi.\n\n{nxt+1}) {questions[nxt]} (Answer by voice)")
             return
 
-        answers.append(transcript)
-        await state.update_data(answers=answers)
-        await message.answer(f"📝 Tushungan matn:\n{transcript}")
-
-        q_index += 1
-        await state.update_data(q_index=q_index)
-
-        if q_index < 3:
-            await message.answer(f"{q_index+1}) {questions[q_index]} (Answer by voice)")
+        await message.answer("🎧 Javoblar matnga aylantirilmoqda...")
+        with stage_seconds.time("speaking.stt_wait"):
+            failed, err = await collect_transcripts(answers, sess)
+        await state.update_data(questions=questions, answers=answers)
+
+        if failed:
+            i = failed[0]
+            await state.update_data(q_index=i)
+            if isinstance(err, (TranscodeBusy, Overloaded)):
+                reason = "⏳ Hozir juda ko‘p javob tekshirilmoqda."
+            elif isinstance(err, NoSpeech):
+                reason = "🔇 Voice da nutq eshitilmadi. Mikrofonni tekshirib, baland ovozda qayta yozing."
+            elif isinstance(err, TranscodeError):
+                reason = "❌ Voice ishlamadi: ffmpeg yo‘q bo‘lishi mumkin."
+            else:
+                reason = "❌ Ovoz tushunilmadi. Sekinroq va aniqroq yuboring."
+            await message.answer(f"{reason}\n\n{i+1}) {questions[i]} — shu savolga qayta javob bering (voice).")
             return
 
-        await message.answer("✅ Hamma javoblar olindi. Imtihondek baholanmoqda...")
-        res = await evaluate_speaking_strict(questions[:3], answers[:3])
-
-        score = clamp_20_75(int(res.get("score_20_75", 20)))
-        cefr = cefr_from_score_20_75(score)
-        ielts = ielts_from_cefr(cefr)
-
-        await message.answer(
-            "📊 Natija (Speaking):\n"
-            f"🏷 CEFR: {cefr}\n"
-            f"🎯 IELTS (taxminiy): {ielts}\n"
-            f"⭐ Umumiy ball: {score}/75\n\n"
-            f"🧠 Izoh (UZ): {res.get('feedback_uz','—')}\n\n"
-            f"✅ To‘g‘rilangan eng yaxshi variant:\n{res.get('corrected_best_version','—')}",
-            reply_markup=main_menu()
-        )
+        speaking_sessions.pop(key, None)
+        trim_note = vad_note(sess.vad)
 
-        inc_stat("exams_completed", message.from_user.id, 1)
-        await state.clear()
+    transcripts = "\n".join(f"{i+1}) {a}" for i, a in enumerate(answers))
+    await message.answer(f"📝 Tushungan matn:\n{transcripts}{trim_note}")
+    progress = await message.answer("✅ Hamma javoblar olindi. Imtihondek baholanmoqda...")
+    try:
+        with stage_seconds.time("speaking.enqueue"):
+            _, created = await enqueue_eval("speaking", {
+                "questions": questions[:3],
+                "answers": answers[:3],
+                "progress_message_id": progress.message_id,
+            }, message.chat.id, message.from_user.id)
+    except Overloaded:
+        # javoblar FSM da saqlangan: oxirgi voice qayta yuborilsa baholash qayta boshlanadi
+        await state.update_data(q_index=2, answers=answers[:2] + [""])
+        await progress.edit_text(OVERLOADED_TEXT + "\n\n3-savolga javobni qayta yuboring (voice).")
+        return
+    if not created:
+        await progress.edit_text("⏳ Bu javoblar allaqachon baholanmoqda.")
 
-    finally:
-        for p in (ogg_path, wav_path):
-            try:
-                if os.path.exists(p):
-                    os.remove(p)
-            except Exception:
-                pass
+    # natijani worker yuboradi
+    await state.clear()
 
 
 # ======================
@@ -757,36 +4218,48 @@ async def dictionary_lookup_handler(message: Message, state: FSMContext):
         await message.answer("So‘zni to‘g‘ri yozing. Masalan: hi")
         return
 
-    ipa, definition, audio_url = dict_lookup(word)
-    uz = translate_uz(word)
-
-    temp_audio = None
-    if audio_url:
-        if audio_url.startswith("//"):
-            audio_url = "https:" + audio_url
-        temp_audio = download_to_temp(audio_url, ".mp3")
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    deadline = t0 + DICT_DEADLINE
+    audio_task: Optional[asyncio.Task] = None
 
-    if temp_audio:
+    with stage_seconds.time("dict.cache"):
+        entry = await dict_cache.get(word)
+    cached = entry is not None
+    if entry is None:
         try:
-            await message.answer_voice(FSInputFile(temp_audio), caption=f"🔊 {word} (pronunciation)")
-        except Exception:
-            await message.answer_audio(FSInputFile(temp_audio), caption=f"🔊 {word} (pronunciation)")
+            async with heavy_gate.slot(message.from_user.id, queue_notifier(message)):
+                with stage_seconds.time("dict.fanout"):
+                    entry, audio_task = await dict_fanout(word, deadline)
+        except Overloaded:
+            await message.answer(OVERLOADED_TEXT)
+            return
+    elif entry.get("audio_url"):
+        audio_task = asyncio.create_task(media_registry.prepare(entry["audio_url"]))
 
-    await message.answer(
-        f"✅ {word}\n"
-        f"📌 English definition: {definition}\n"
-        f"🇺🇿 Tarjima (UZ): {uz}\n"
-        f"🔤 IPA: {ipa}\n\n"
-        "Yana so‘z yozing:"
-    )
+    # matn birinchi, audio tayyor bo‘lganda
+    with stage_seconds.time("dict.reply"):
+        await message.answer(
+            f"✅ {word}\n"
+            f"📌 English definition: {entry.get('definition') or '—'}\n"
+            f"🇺🇿 Tarjima (UZ): {entry.get('uz') or '—'}\n"
+            f"🔤 IPA: {entry.get('ipa') or '—'}\n\n"
+            "Yana so‘z yozing:"
+        )
 
-    inc_stat("dict_lookups", message.from_user.id, 1)
+    if audio_task is not None:
+        with stage_seconds.time("dict.audio"):
+            try:
+                prepared = await asyncio.wait_for(audio_task, max(0.1, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                prepared = None
+            if prepared is not None:
+                await media_registry.send(message, entry["audio_url"], f"🔊 {word} (pronunciation)", prepared)
 
-    if temp_audio:
-        try:
-            os.remove(temp_audio)
-        except Exception:
-            pass
+    stage_seconds.observe(loop.time() - t0, "dict.total")
+    inc_stat("dict_lookups", message.from_user.id, 1)
+    event_log.append("lookup", message.from_user.id, word=word, cached=cached,
+                     found=entry.get("definition") not in (None, "", "—"), total_s=round(loop.time() - t0, 3))
 
 
 # ======================
@@ -797,15 +4270,16 @@ async def writing_start(message: Message, state: FSMContext):
     if not await require_sub(message, state):
         return
 
-    p1 = random.choice(WRITING_PROMPTS["friend_50"])
-    p2 = random.choice(WRITING_PROMPTS["manager_120"])
-    p3 = random.choice(WRITING_PROMPTS["essay_200"])
-
+    left = await quota_left(message.from_user.id)
+    if left is not None and left <= 0:
+        await message.answer(QUOTA_TEXT, reply_markup=main_menu())
+        return
+    inc_stat("writing_started", message.from_user.id, 1)
     prompts = [
-        {"task": 1, "type": "friend_message", "min_words": 50, "prompt": p1},
-        {"task": 2, "type": "manager_email", "min_words": 120, "prompt": p2},
-        {"task": 3, "type": "essay", "min_words": 180, "prompt": p3},
+        {**tpl, "prompt": random.choice(WRITING_PROMPTS[bank])}
+        for bank, tpl in WRITING_TASKS
     ]
+    p1, p2, p3 = (p["prompt"] for p in prompts)
 
     await state.update_data(writing_prompts=prompts)
     await state.set_state(WritingStates.writing_text)
@@ -844,36 +4318,475 @@ async def writing_submit(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    await message.answer("🧾 Writing baholanmoqda (halol, imtihondek)...")
-    res = await evaluate_writing_strict(prompts, full_text)
+    progress = await message.answer("🧾 Writing baholanmoqda (halol, imtihondek)...")
+    try:
+        _, created = await enqueue_eval("writing", {
+            "prompts": prompts,
+            "full_text": full_text,
+            "progress_message_id": progress.message_id,
+        }, message.chat.id, message.from_user.id)
+    except Overloaded:
+        await progress.edit_text(OVERLOADED_TEXT + "\nMatnni keyinroq qayta yuboring.")
+        return
+    if not created:
+        await progress.edit_text("⏳ Bu matn allaqachon baholanmoqda.")
 
-    score = clamp_20_75(int(res.get("score_20_75", 20)))
-    cefr = cefr_from_score_20_75(score)
-    ielts = ielts_from_cefr(cefr)
+    # natijani worker yuboradi
+    await state.clear()
 
-    coverage = int(res.get("task_coverage", 0) or 0)
-    wc1 = int(res.get("wc1", 0) or 0)
-    wc2 = int(res.get("wc2", 0) or 0)
-    wc3 = int(res.get("wc3", 0) or 0)
 
-    feedback = safe_text(res.get("feedback_uz", "")).strip() or "—"
-    corrected = safe_text(res.get("corrected_best_version", "")).strip() or "—"
+# ======================
+# BATCH WRITING (o‘qituvchilar uchun)
+# ======================
+BATCH_HELP = (
+    "📚 Batch writing\n"
+    "Insholarni yuboring:\n"
+    "• fayl: CSV (id, text yoki task1/task2/task3 ustunlari; ixtiyoriy task, prompt1..prompt3), "
+    "JSON/JSONL ({\"id\", \"text\", \"task\"}) yoki ZIP (har .txt — bitta ish)\n"
+    "• yoki har bir inshoni alohida xabar qilib (1) ... 2) ... 3) ... formatida)\n"
+    "1) 2) 3) belgisiz insho bitta task deb baholanadi: /batch 3 yoki task ustuni bilan tanlang.\n"
+    "Topshiriq matni: /prompt 3 <matn> (berilmasa tasodifiy mavzu olinadi)\n\n"
+    "Tugatgach /done, bekor qilish: /cancel"
+)
+
+def is_teacher(user_id: int) -> bool:
+    return user_id in ADMIN_IDS or user_id in TEACHER_IDS
+
+class BatchSession:
+    # Yig‘ilayotgan batch (o‘qituvchi bo‘yicha). /done dan keyin ishlar eval_jobs ga o‘tadi.
+    def __init__(self, prompts: List[Dict], task: Optional[int] = None):
+        self.prompts = prompts                # tasodifiy standart mavzular
+        self.custom: Dict[int, str] = {}      # /prompt N bilan berilganlari
+        self.task = task                      # belgisiz insholar uchun task
+        self.items: List[Dict] = []           # {"id", "text", "tasks", "prompts"}
+
+    def add(self, item: Dict) -> Optional[str]:
+        # None = qo‘shildi, aks holda sabab: empty | no_task | limit
+        if not item["text"].strip():
+            return "empty"
+        if not item["tasks"]:
+            return "no_task"
+        if len(self.items) >= BATCH_MAX_ITEMS:
+            return "limit"
+        item["id"] = item["id"] or f"#{len(self.items) + 1}"
+        self.items.append(item)
+        return None
+
+    def item_prompts(self, item: Dict) -> List[Dict]:
+        # ustundagi prompt -> /prompt -> tasodifiy
+        return [
+            {**tpl, "prompt": item["prompts"].get(str(tpl["task"])) or self.custom.get(tpl["task"]) or tpl["prompt"]}
+            for tpl in self.prompts
+        ]
+
+batch_sessions: Dict[int, BatchSession] = {}
+
+def parse_task(value) -> Optional[int]:
+    # "3", 3, "task3", "Task 3" -> 3
+    m = re.fullmatch(r"(?:task)?\s*([123])", safe_text(value).strip().lower())
+    return int(m.group(1)) if m else None
+
+def batch_item(item_id: str, text: str, task: Optional[int], prompts: Optional[Dict[str, str]] = None) -> Dict:
+    # 1) 2) 3) belgili matn -> uchala task; belgisiz insho -> tanlangan bitta task (bo‘lmasa tasks=[])
+    text = text.strip()
+    if any(split_answers(text).values()):
+        tasks = [1, 2, 3]
+    elif task:
+        text, tasks = f"{task}) {text}", [task]
+    else:
+        tasks = []
+    return {"id": item_id, "text": text, "tasks": tasks, "prompts": prompts or {}}
+
+def _join_tasks(row: Dict) -> str:
+    # task1/task2/task3 ustunlari -> "1) ...\n2) ...\n3) ..."
+    parts = [safe_text(row.get(f"task{i}")).strip() for i in (1, 2, 3)]
+    if any(parts):
+        return "\n".join(f"{i}) {p}" for i, p in enumerate(parts, 1))
+    return safe_text(row.get("text")).strip()
+
+def _row_id(row: Dict, n: int) -> str:
+    for key in ("id", "name", "student"):
+        if row.get(key):
+            return safe_text(row[key]).strip()[:64]
+    return f"#{n}"
+
+def _row_item(row, n: int, task: Optional[int]) -> Dict:
+    if isinstance(row, str):
+        row = {"text": row}
+    if not isinstance(row, dict):
+        raise ValueError(f"{n}-qator obyekt emas")
+    row = {safe_text(k).strip().lower(): v for k, v in row.items()}
+    row_task = parse_task(row.get("task")) or task
+    prompts = {str(i): safe_text(row.get(f"prompt{i}")).strip() for i in (1, 2, 3) if row.get(f"prompt{i}")}
+    if row.get("prompt") and row_task:
+        prompts.setdefault(str(row_task), safe_text(row["prompt"]).strip())
+    return batch_item(_row_id(row, n), _join_tasks(row), row_task, prompts)
+
+def parse_batch_file(name: str, data: bytes, task: Optional[int] = None) -> List[Dict]:
+    # thread da ishlaydi; noto‘g‘ri format -> ValueError
+    name = name.lower()
+    items: List[Dict] = []
+    if name.endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            infos = [i for i in zf.infolist() if not i.is_dir() and i.filename.lower().endswith(".txt")]
+            if sum(i.file_size for i in infos) > BATCH_MAX_BYTES:
+                raise ValueError("ZIP ichidagi fayllar juda katta")
+            for info in sorted(infos, key=lambda i: i.filename)[:BATCH_MAX_ITEMS]:
+                text = zf.read(info).decode("utf-8-sig", "replace")
+                items.append(batch_item(os.path.splitext(os.path.basename(info.filename))[0], text, task))
+        return items
+
+    text = data.decode("utf-8-sig", "replace")
+    if name.endswith(".csv"):
+        for n, row in enumerate(csv.DictReader(io.StringIO(text)), 1):
+            items.append(_row_item(row, n, task))
+    elif name.endswith(".json"):
+        try:
+            rows = json.loads(text)
+        except ValueError:
+            raise ValueError("JSON emas")
+        if not isinstance(rows, list):
+            raise ValueError("JSON massiv ([...]) bo‘lishi kerak")
+        items = [_row_item(row, n, task) for n, row in enumerate(rows, 1)]
+    elif name.endswith(".jsonl"):
+        for n, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ValueError(f"{n}-qator JSON emas")
+            items.append(_row_item(row, n, task))
+    elif name.endswith(".txt"):
+        items.append(batch_item(os.path.splitext(name)[0], text, task))
+    else:
+        raise ValueError("faqat CSV, JSON, JSONL, ZIP yoki TXT")
+    return items
+
+def batch_results_csv(rows: List[Tuple[str, Optional[Dict]]]) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["id", "score_20_75", "cefr", "ielts", "task_coverage", "wc1", "wc2", "wc3",
+                "off_topic", "feedback_uz", "corrected_best_version"])
+    for item_id, res in rows:
+        if res is None:
+            w.writerow([item_id, "", "", "", "", "", "", "", "", "ERROR", ""])
+            continue
+        score = clamp_20_75(int(res.get("score_20_75", 20)))
+        cefr = cefr_from_score_20_75(score)
+        # umumiy maslahat har qatorda takrorlanmaydi
+        feedback = safe_text(res.get("feedback_uz")).split("\n\n📌")[0].strip()
+        w.writerow([item_id, score, cefr, ielts_from_cefr(cefr), res.get("task_coverage", 0),
+                    res.get("wc1", 0), res.get("wc2", 0), res.get("wc3", 0),
+                    int(bool(res.get("off_topic"))), feedback, safe_text(res.get("corrected_best_version"))])
+    return buf.getvalue().encode("utf-8-sig")  # Excel uchun BOM
+
+def batch_progress_text(done: int, failed: int, total: int) -> str:
+    running = total - done - failed
+    return (f"📚 Batch: {done + failed}/{total} baholandi"
+            + (f" | ❌ {failed} xato" if failed else "")
+            + (f"\n⏳ Qolgan: {running}" if running else "\n✅ Tayyor"))
+
+def _batch_create(conn, chat_id: int, user_id: int, progress_message_id: int, payloads: List[Dict]) -> int:
+    # batch + hamma ishlari bitta tranzaksiyada: yarim navbatga qo‘yilgan batch qolmaydi
+    conn.execute("BEGIN")
+    try:
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM eval_jobs WHERE status='pending' AND kind='batch_item'").fetchone()[0]
+        if pending + len(payloads) > BATCH_QUEUE_MAX:
+            raise Overloaded()
+        now = time.time()
+        batch_id = conn.execute(
+            "INSERT INTO batches (chat_id, user_id, total, progress_message_id, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (chat_id, user_id, len(payloads), progress_message_id, now, now),
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO eval_jobs (kind, dedupe_key, payload, chat_id, user_id, next_run_at, created_at, updated_at) "
+            "VALUES ('batch_item', ?, ?, ?, ?, ?, ?, ?)",
+            [(f"batch:{batch_id}:{i}", json.dumps({**p, "batch": batch_id, "idx": i}, ensure_ascii=False),
+              chat_id, user_id, now, now, now) for i, p in enumerate(payloads)],
+        )
+        conn.execute("COMMIT")
+        return batch_id
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _batch_status(conn, batch_id: int) -> Optional[str]:
+    row = conn.execute("SELECT status FROM batches WHERE id=?", (batch_id,)).fetchone()
+    return row[0] if row else None
+
+def _batch_active(conn, user_id: int) -> Optional[int]:
+    row = conn.execute(
+        "SELECT id FROM batches WHERE user_id=? AND status IN ('running', 'finishing')", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def _batch_put(conn, batch_id: int, idx: int, item_id: str, result: Optional[str]) -> Tuple[int, int, int, bool]:
+    # (done, failed, total, shu ish oxirgisimi). Faqat ERROR qatori ustiga yoziladi:
+    # kechikkan xato tayyor natijani o‘chirmaydi.
+    # oxirgi natijani yozgan jarayon batch ni 'finishing' ga o‘tkazadi — CSV bir marta yuboriladi.
+    # 'finishing' da yiqilgan jarayon (lease o‘tgan) o‘rniga qayta urinish yakunlaydi.
+    conn.execute(
+        "INSERT INTO batch_results (batch_id, idx, item_id, result) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(batch_id, idx) DO UPDATE SET result=excluded.result WHERE batch_results.result IS NULL",
+        (batch_id, idx, item_id, result),
+    )
+    done, failed = conn.execute(
+        "SELECT COUNT(result), COUNT(*) - COUNT(result) FROM batch_results WHERE batch_id=?", (batch_id,)
+    ).fetchone()
+    total = conn.execute("SELECT total FROM batches WHERE id=?", (batch_id,)).fetchone()[0]
+    now = time.time()
+    last = done + failed >= total and conn.execute(
+        "UPDATE batches SET status='finishing', updated_at=? WHERE id=? "
+        "AND (status='running' OR (status='finishing' AND updated_at<?))",
+        (now, batch_id, now - JOB_LEASE),
+    ).rowcount == 1
+    return done, failed, total, last
+
+def _batch_results(conn, batch_id: int) -> List[Tuple[str, Optional[str]]]:
+    return conn.execute(
+        "SELECT item_id, result FROM batch_results WHERE batch_id=? ORDER BY idx", (batch_id,)).fetchall()
+
+def _batch_set_status(conn, batch_id: int, status: str):
+    conn.execute("UPDATE batches SET status=?, updated_at=? WHERE id=?", (status, time.time(), batch_id))
+
+def _batch_cancel(conn, user_id: int) -> Optional[Tuple[int, int, int]]:
+    # (chat_id, progress_message_id, batch_id); navbatdagi ishlari o‘chiriladi
+    row = conn.execute(
+        "SELECT id, chat_id, progress_message_id FROM batches WHERE user_id=? AND status='running'", (user_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    batch_id, chat_id, message_id = row
+    now = time.time()
+    conn.execute("UPDATE batches SET status='cancelled', updated_at=? WHERE id=?", (now, batch_id))
+    conn.execute(
+        "UPDATE eval_jobs SET status='failed', error='cancelled', updated_at=? "
+        "WHERE kind='batch_item' AND status='pending' AND dedupe_key LIKE ?",
+        (now, f"batch:{batch_id}:%"),
+    )
+    return chat_id, message_id, batch_id
+
+# shu jarayondagi progress xabarlari (edit lar throttling i batch bo‘yicha umumiy).
+# Batch ni boshqa jarayon yakunlasa bu yerda yozuv TTL bilan o‘chadi.
+_batch_progress = TTLCache("batch_progress", 256)
+
+def batch_progress_message(batch_id: int, chat_id: int, message_id: int) -> ProgressMessage:
+    found, progress = _batch_progress.get(batch_id)
+    if not found:
+        progress = ProgressMessage(chat_id, message_id)
+    _batch_progress.set(batch_id, progress, BATCH_PROGRESS_TTL)
+    return progress
+
+async def batch_item_done(payload: Dict, chat_id: int, user_id: int, res: Optional[Dict], final: bool = False):
+    # final: oxirgi urinish (fail hook) — CSV yuborilmasa ham batch yakunlanadi
+    batch_id = payload["batch"]
+    result = json.dumps(res, ensure_ascii=False) if res is not None else None
+    done, failed, total, last = await db_run(_batch_put, batch_id, payload["idx"], payload["id"], result)
+    progress = batch_progress_message(batch_id, chat_id, payload["progress_message_id"])
+    if done + failed >= total:
+        _batch_progress.invalidate(batch_id)
+    if not last:
+        await progress.update(batch_progress_text(done, failed, total))
+        return
+
+    await progress.update(batch_progress_text(done, failed, total), force=True)
+    try:
+        rows = await db_run(_batch_results, batch_id)
+        data = await asyncio.to_thread(
+            batch_results_csv, [(item_id, json.loads(r) if r else None) for item_id, r in rows])
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(data, filename=f"batch_{Analytics.day()}_{total}.csv"),
+            caption=f"✅ {done} ta baholandi" + (f", ❌ {failed} ta xato" if failed else ""),
+            reply_markup=main_menu(),
+        )
+    except Exception as e:
+        if not final:
+            # yuborilmadi: ish qayta urinadi va CSV ni o‘zi yuboradi
+            await asyncio.shield(db_run(_batch_set_status, batch_id, "running"))
+            raise
+        print("BATCH SEND ERROR:", repr(e))
+        await db_run(_batch_set_status, batch_id, "failed")
+        await progress.update(batch_progress_text(done, failed, total) + "\n❌ CSV yuborilmadi", force=True)
+        return
+    except BaseException:
+        await asyncio.shield(db_run(_batch_set_status, batch_id, "running"))
+        raise
+    await db_run(_batch_set_status, batch_id, "sent")
+    inc_stat("batch_writings", user_id, done)
+    event_log.append("batch", user_id, items=total, failed=failed,
+                     total_s=round(time.time() - payload["enqueued_at"], 3))
+
+async def run_batch_item(payload: Dict, chat_id: int, user_id: int):
+    if await db_run(_batch_status, payload["batch"]) not in ("running", "finishing"):
+        return  # bekor qilingan yoki allaqachon yuborilgan
+    t0 = time.time()
+    eval_model.set("cache")
+    eval_user.set(user_id)
+    # past prioritet: oddiy userlar navbati oldinda
+    async with heavy_gate.slot(user_id, low=True):
+        with stage_seconds.time("batch.evaluate"):
+            res = await evaluate_writing_strict(payload["prompts"], payload["full_text"],
+                                                tasks=tuple(payload["tasks"]))
+    if len(payload["tasks"]) == 1:
+        # bitta task: "3) " belgisini batch_item o‘zi qo‘shgan, CSV da kerak emas
+        res["corrected_best_version"] = re.sub(r"^\s*[123]\)\s*", "", safe_text(res.get("corrected_best_version")))
+    log_eval_event("batch_item", user_id, payload, res, t0)
+    await batch_item_done(payload, chat_id, user_id, res)
+
+async def fail_batch_item(payload: Dict, chat_id: int, user_id: int, error: str):
+    # oxirgi urinish ham yiqildi: CSV da ERROR qatori, batch to‘xtab qolmaydi
+    await batch_item_done(payload, chat_id, user_id, None, final=True)
+
+JOB_RUNNERS["batch_item"] = run_batch_item
+JOB_FAILERS["batch_item"] = fail_batch_item
+
+
+@dp.message(Command("batch"))
+async def batch_start(message: Message, state: FSMContext):
+    if not is_teacher(message.from_user.id):
+        await message.answer("❌ Bu buyruq faqat o‘qituvchilar uchun.")
+        return
 
+    if await db_run(_batch_active, message.from_user.id) is not None:
+        await message.answer("⏳ Oldingi batch hali baholanmoqda. Bekor qilish: /cancel")
+        return
+
+    # /batch -> ishlar 1) 2) 3) formatida; /batch 3 -> belgisiz insholar 3-task
+    arg = (message.text or "").split(maxsplit=1)[1:]
+    task = parse_task(arg[0]) if arg else None
+    if arg and task is None:
+        await message.answer("Masalan: /batch yoki /batch 3 (hamma insholar 3-task uchun)")
+        return
+
+    drop_speaking_session(message)
+    prompts = [
+        {**tpl, "prompt": random.choice(WRITING_PROMPTS[bank])}
+        for bank, tpl in WRITING_TASKS
+    ]
+    batch_sessions[message.from_user.id] = BatchSession(prompts, task)
+    await state.set_state(BatchStates.collecting)
     await message.answer(
-        "📊 Natija (Writing):\n"
-        f"🏷 CEFR: {cefr}\n"
-        f"🎯 IELTS (taxminiy): {ielts}\n"
-        f"⭐ Umumiy ball: {score}/75\n\n"
-        f"🧾 Task coverage: {coverage}/3\n"
-        f"🔢 Word count: 1) {wc1} | 2) {wc2} | 3) {wc3}\n\n"
-        f"🧠 Izoh (UZ):\n{feedback}\n\n"
-        f"✅ To‘g‘rilangan eng yaxshi variant:\n{corrected}",
-        reply_markup=main_menu()
+        BATCH_HELP
+        + (f"\n\nBelgisiz insholar: {task}-task." if task else "")
+        + "\n\nTopshiriq matni berilmasa shu mavzular olinadi:\n"
+        + "\n".join(f"{p['task']}) {p['prompt']}" for p in prompts),
+        reply_markup=back_menu()
     )
 
-    inc_stat("writings_completed", message.from_user.id, 1)
+@dp.message(Command("cancel"))
+async def batch_cancel(message: Message, state: FSMContext):
+    sess = batch_sessions.pop(message.from_user.id, None)
+    cancelled = await db_run(_batch_cancel, message.from_user.id)
+    if sess is None and cancelled is None:
+        await message.answer("Bekor qilinadigan batch yo‘q.", reply_markup=main_menu())
+        return
+    if cancelled is not None:
+        chat_id, message_id, batch_id = cancelled
+        _batch_progress.invalidate(batch_id)
+        await ProgressMessage(chat_id, message_id).update("📚 Batch\n🛑 Bekor qilindi", force=True)
+    if sess is not None:
+        await state.clear()
+    await message.answer("🛑 Batch bekor qilindi.", reply_markup=main_menu())
+
+@dp.message(BatchStates.collecting, Command("prompt"))
+async def batch_prompt(message: Message):
+    sess = batch_sessions.get(message.from_user.id)
+    if sess is None:
+        return
+    # /prompt 3 Some people think ...
+    parts = (message.text or "").split(maxsplit=2)
+    task = parse_task(parts[1]) if len(parts) > 1 else None
+    if task is None or len(parts) < 3 or not parts[2].strip():
+        await message.answer("Masalan: /prompt 3 Some people think that ... Discuss both views.")
+        return
+    sess.custom[task] = parts[2].strip()
+    await message.answer(f"✅ {task}-task topshirig‘i saqlandi.")
+
+@dp.message(BatchStates.collecting, Command("done"))
+async def batch_done(message: Message, state: FSMContext):
+    sess = batch_sessions.get(message.from_user.id)
+    if sess is None or not sess.items:
+        await message.answer("Hali hech narsa yuborilmadi.\n\n" + BATCH_HELP)
+        return
+
+    # taxminiy sarf: so‘rov + javob budjeti
+    need = sum(
+        estimate_tokens(it["text"]) + 600 + output_budget(min(estimate_tokens(it["text"]), EVAL_MAX_INPUT_TOKENS))
+        for it in sess.items
+    )
+    left = await quota_left(message.from_user.id)
+    if left is not None and need > left:
+        await message.answer(
+            f"⛔️ Bu batch uchun taxminan {need} token kerak, bugun {max(0, left)} token qolgan.\n"
+            "Ishlar sonini kamaytiring yoki ertaga yuboring. Bekor qilish: /cancel"
+        )
+        return
+
+    msg = await message.answer(f"📚 Batch: 0/{len(sess.items)} baholandi\n⏳ Navbatga qo‘yildi...")
+    payloads = [
+        {"id": it["id"], "prompts": sess.item_prompts(it), "full_text": it["text"], "tasks": it["tasks"],
+         "progress_message_id": msg.message_id, "enqueued_at": time.time()}
+        for it in sess.items
+    ]
+    try:
+        await db_run(_batch_create, message.chat.id, message.from_user.id, msg.message_id, payloads)
+    except Overloaded:
+        await msg.edit_text(OVERLOADED_TEXT + "\nBatch ni keyinroq /done bilan qayta yuboring.")
+        return
+    if _jobs_wakeup is not None:
+        _jobs_wakeup.set()
+    batch_sessions.pop(message.from_user.id, None)
     await state.clear()
 
+BATCH_SKIP_TEXT = {
+    "empty": "bo‘sh",
+    "no_task": "1) 2) 3) belgisi yo‘q — /batch 3 bilan task tanlang yoki task ustuni qo‘shing",
+    "limit": f"limit {BATCH_MAX_ITEMS}",
+}
+
+@dp.message(BatchStates.collecting, F.document)
+async def batch_document(message: Message):
+    sess = batch_sessions.get(message.from_user.id)
+    if sess is None:
+        return
+    doc = message.document
+    if (doc.file_size or 0) > BATCH_MAX_BYTES:
+        await message.answer(f"❌ Fayl juda katta (max {BATCH_MAX_BYTES // (1024 * 1024)} MB).")
+        return
+    try:
+        buf = await bot.download(doc)
+        items = await asyncio.to_thread(parse_batch_file, doc.file_name or "file.txt", buf.getvalue(), sess.task)
+    except (ValueError, zipfile.BadZipFile, csv.Error) as e:
+        await message.answer(f"❌ Faylni o‘qib bo‘lmadi: {e}")
+        return
+
+    skipped: Dict[str, int] = {}
+    for item in items:
+        reason = sess.add(item)
+        if reason:
+            skipped[reason] = skipped.get(reason, 0) + 1
+    added = len(items) - sum(skipped.values())
+    await message.answer(
+        f"📥 {added} ta ish qo‘shildi (jami {len(sess.items)})"
+        + "".join(f"\n⚠️ {n} tasi o‘tkazib yuborildi: {BATCH_SKIP_TEXT[r]}" for r, n in skipped.items())
+        + "\nYana yuboring yoki /done"
+    )
+
+@dp.message(BatchStates.collecting, F.text)
+async def batch_text(message: Message):
+    sess = batch_sessions.get(message.from_user.id)
+    if sess is None:
+        return
+    # har xabar — bitta ish; tez-tez javob bermaslik uchun faqat har 10-sida xabar
+    reason = sess.add(batch_item(f"msg{len(sess.items) + 1}", message.text, sess.task))
+    if reason:
+        await message.answer(f"❌ Qo‘shilmadi: {BATCH_SKIP_TEXT[reason]}.")
+    elif len(sess.items) % 10 == 1:
+        await message.answer(f"📥 Qabul qilinmoqda: {len(sess.items)} ta. Tugatgach /done")
+
 
 # ======================
 # VOICE BLOCK (outside speaking)
@@ -899,6 +4812,59 @@ async def fallback(message: Message):
     await message.answer("Menyudan tanlang 👇", reply_markup=main_menu())
 
 
+# ======================
+# WEB (health + webhook, Render + UptimeRobot)
+# ======================
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="OK")
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="healthy")
+
+async def metrics(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401, text="unauthorized")
+    return web.Response(body=render_metrics().encode("utf-8"),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def build_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/", home)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    if WEBHOOK_URL:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            handle_in_background=True,
+            secret_token=WEBHOOK_SECRET or None,
+        ).register(app, path=WEBHOOK_PATH)
+    return app
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows
+    await stop.wait()
+
+async def run_webhook():
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    await dp.emit_startup(bot=bot)
+    try:
+        await wait_for_stop_signal()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
 # ======================
 # RUN
 # ======================
@@ -908,8 +4874,34 @@ async def main():
         return
 
     load_stats()
-    Thread(target=run_web, daemon=True).start()
-    await dp.start_polling(bot)
+    token_ledger.load()
+    runner = web.AppRunner(build_web_app())
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    flusher = asyncio.create_task(stats_flusher())
+    event_writer = asyncio.create_task(event_log.run())
+    workers = start_eval_workers() if ROLE in ("all", "worker") else []
+    try:
+        if ROLE == "worker":
+            await wait_for_stop_signal()
+        elif WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        flusher.cancel()
+        event_writer.cancel()
+        flush_stats_sync()
+        event_log.close_sync()
+        await dp.storage.close()
+        await bot.session.close()
+        await runner.cleanup()
+        await close_http()
+        close_db()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# main.py import paytida env o‘qiydi: testlar repo dagi DB/jurnallarga tegmasin
+_tmp = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.setdefault("DATA_DB", os.path.join(_tmp, "bot_data.db"))
+os.environ.setdefault("EVENTS_DIR", os.path.join(_tmp, "events"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
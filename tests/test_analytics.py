@@ -0,0 +1,24 @@
+import asyncio
+
+import main
+
+
+def test_admin_refresh_sees_completions_written_by_another_process():
+    main.inc_stat("exams_completed", 111)
+    asyncio.run(main.flush_stats())
+    # worker jarayoni shu DB ga bevosita yozadi — bu jarayon xotirasi bilmaydi
+    day = main.Analytics.day()
+    main._db_call(main._stats_write,
+                  [("exams_completed", "222", 2), ("writings_completed", "111", 1)],
+                  [(day, "222")])
+    assert 222 not in main.analytics.sorted_uids
+
+    main.inc_stat("dict_lookups", 333)  # hali flush qilinmagan
+    asyncio.run(main.refresh_stats())
+
+    assert main.analytics.sorted_uids[-3:] == [111, 222, 333]
+    assert main.stats["exams_completed"]["222"] == 2
+    assert main.stats["dict_lookups"]["333"] == 1
+    assert main.analytics.totals["exams_completed"] >= 3
+    assert {"111", "222", "333"} <= main.analytics.active_days[day]
+    assert main.admin_csv(main.analytics.sorted_uids, main.stats).decode().count("\n222,2,0,0") == 1
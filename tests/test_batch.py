@@ -0,0 +1,145 @@
+import asyncio
+import io
+import json
+import sqlite3
+import zipfile
+
+import pytest
+
+import main
+from main import BatchSession, parse_batch_file, split_answers, word_count
+
+ESSAY = ("Some people believe that technology makes our lives easier. "
+         "In my opinion, it brings both benefits and problems for students.")
+
+
+def make_zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, text in files.items():
+            zf.writestr(name, text)
+    return buf.getvalue()
+
+
+def session(task=None):
+    return BatchSession([{"task": i, "prompt": f"default {i}"} for i in (1, 2, 3)], task)
+
+
+def test_zip_of_plain_essays_maps_to_chosen_task():
+    data = make_zip({"ali.txt": ESSAY, "vali.txt": ESSAY + " Finally, it saves time."})
+    items = parse_batch_file("class.zip", data, task=3)
+    assert [it["id"] for it in items] == ["ali", "vali"]
+    for it in items:
+        assert it["tasks"] == [3]
+        assert word_count(split_answers(it["text"])[3]) > 0
+
+
+def test_plain_essay_without_task_is_rejected():
+    items = parse_batch_file("class.zip", make_zip({"ali.txt": ESSAY}))
+    assert items[0]["tasks"] == []
+    sess = session()
+    assert sess.add(items[0]) == "no_task"
+    assert sess.items == []
+
+
+def test_marked_text_keeps_all_tasks():
+    items = parse_batch_file("a.txt", b"1) Hi Tom\n2) Dear manager\n3) Essay", task=3)
+    assert items[0]["tasks"] == [1, 2, 3]
+    assert split_answers(items[0]["text"])[2] == "Dear manager"
+
+
+def test_csv_task_and_prompt_columns():
+    data = ("id,task,prompt,text\n"
+            f"s1,task3,Is technology good?,{ESSAY}\n"
+            f"s2,,,{ESSAY}\n").encode()
+    items = parse_batch_file("x.csv", data)
+    assert items[0]["tasks"] == [3]
+    assert items[0]["prompts"] == {"3": "Is technology good?"}
+    assert items[1]["tasks"] == []
+
+    sess = session()
+    sess.custom[2] = "Custom email"
+    assert sess.add(items[0]) is None
+    prompts = [p["prompt"] for p in sess.item_prompts(sess.items[0])]
+    assert prompts == ["default 1", "Custom email", "Is technology good?"]
+
+
+def test_json_array_and_bad_rows():
+    rows = [{"id": "a", "text": ESSAY, "task": 3}, ESSAY]
+    items = parse_batch_file("x.json", json.dumps(rows).encode(), task=2)
+    assert [it["tasks"] for it in items] == [[3], [2]]
+
+    with pytest.raises(ValueError):
+        parse_batch_file("x.json", b'{"id": "a"}')
+    with pytest.raises(ValueError):
+        parse_batch_file("x.jsonl", b'{"id": "a", "text": "x"}\n42\n')
+    with pytest.raises(ValueError):
+        parse_batch_file("x.json", b"[[1, 2]]")
+
+
+def test_batch_finishes_once():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.executescript(main.DB_SCHEMA)
+    payloads = [{"id": f"s{i}", "full_text": "x", "tasks": [3], "prompts": []} for i in range(2)]
+    batch_id = main._batch_create(conn, 10, 20, 30, payloads)
+    assert conn.execute("SELECT COUNT(*) FROM eval_jobs WHERE kind='batch_item'").fetchone()[0] == 2
+
+    assert main._batch_put(conn, batch_id, 0, "s0", "{}") == (1, 0, 2, False)
+    assert main._batch_put(conn, batch_id, 1, "s1", None) == (1, 1, 2, True)
+    # qayta urinish (masalan yuborish xatosidan keyin) ikkinchi marta yakunlamaydi
+    assert main._batch_put(conn, batch_id, 1, "s1", "{}")[3] is False
+    assert main._batch_status(conn, batch_id) == "finishing"
+
+
+def test_cancel_drops_pending_items():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.executescript(main.DB_SCHEMA)
+    payloads = [{"id": f"s{i}", "full_text": "x", "tasks": [3], "prompts": []} for i in range(3)]
+    batch_id = main._batch_create(conn, 10, 20, 30, payloads)
+    assert main._batch_active(conn, 20) == batch_id
+    assert main._batch_cancel(conn, 20) == (10, 30, batch_id)
+    assert main._batch_active(conn, 20) is None
+    assert main._job_counts(conn) == {"failed": 3}
+
+
+def test_late_failure_keeps_stored_result():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.executescript(main.DB_SCHEMA)
+    payloads = [{"id": f"s{i}", "full_text": "x", "tasks": [3], "prompts": []} for i in range(2)]
+    batch_id = main._batch_create(conn, 10, 20, 30, payloads)
+
+    assert main._batch_put(conn, batch_id, 0, "s0", '{"score_20_75": 50}')[:2] == (1, 0)
+    assert main._batch_put(conn, batch_id, 0, "s0", None)[:2] == (1, 0)
+    # ERROR qatori esa keyingi muvaffaqiyatli urinish bilan almashadi
+    main._batch_put(conn, batch_id, 1, "s1", None)
+    assert main._batch_put(conn, batch_id, 1, "s1", "{}")[:2] == (2, 0)
+    assert [r for _, r in main._batch_results(conn, batch_id)] == ['{"score_20_75": 50}', "{}"]
+
+
+def test_final_failure_settles_batch_even_if_csv_not_sent(monkeypatch):
+    sent = []
+
+    async def send_document(*args, **kwargs):
+        raise RuntimeError("telegram down")
+
+    async def edit_message_text(**kwargs):
+        sent.append(kwargs["text"])
+
+    monkeypatch.setattr(main.bot, "send_document", send_document)
+    monkeypatch.setattr(main.bot, "edit_message_text", edit_message_text)
+    payloads = [{"id": "s0", "full_text": "x", "tasks": [3], "prompts": [], "progress_message_id": 30,
+                 "enqueued_at": 0.0}]
+    batch_id = main._db_call(main._batch_create, 10, 20, 30, payloads)
+    item = {**payloads[0], "batch": batch_id, "idx": 0}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main.batch_item_done(item, 10, 20, {"score_20_75": 50}))
+    assert main._db_call(main._batch_status, batch_id) == "running"
+
+    asyncio.run(main.fail_batch_item(item, 10, 20, "RuntimeError"))
+    assert main._db_call(main._batch_status, batch_id) == "failed"
+    assert main._db_call(main._batch_active, 20) is None
+    assert main._batch_progress.get(batch_id) == (False, None)
+    assert "CSV yuborilmadi" in sent[-1]
+    # saqlangan natija ERROR bilan almashmagan
+    assert main._db_call(main._batch_results, batch_id)[0][1] is not None
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import main
+
+REPLY = {"per_question": [{"relevance_to_question": 4}], "score_20_75": 52,
+         "feedback_uz": "Yaxshi.", "corrections": []}
+
+
+def run_speaking(monkeypatch, answer, on_partial=None):
+    payloads = []
+
+    async def fake_request(upstream, method, url, **kwargs):
+        payloads.append(kwargs["json"])
+        body = {"choices": [{"message": {"content": json.dumps(REPLY)}}], "usage": {}}
+        return main.HttpResult(200, json.dumps(body).encode(), {})
+
+    monkeypatch.setattr(main, "http_request", fake_request)
+    monkeypatch.setattr(main, "model_router", main.ModelRouter(main.GROQ_CHAT_MODELS))
+    monkeypatch.setattr(main, "EVAL_JSON_MODE", True)
+    monkeypatch.setattr(main, "EVAL_CACHE_PERSIST", False)
+    monkeypatch.setattr(main, "PRESCORE_SKIP", False)
+    res = asyncio.run(main.evaluate_speaking_strict(["Describe your home town."], [answer], on_partial))
+    return res, payloads
+
+
+def test_json_mode_is_sent_without_partial_callback(monkeypatch):
+    res, payloads = run_speaking(monkeypatch, "My home town is small but very green and quiet.")
+    assert res["score_20_75"] == 52
+    assert payloads and all(p.get("response_format") == {"type": "json_object"} for p in payloads)
+    assert not any(p.get("stream") for p in payloads)
+
+
+def test_live_partial_callback_still_streams(monkeypatch):
+    async def on_partial(partial):
+        pass
+
+    def fail_stream(*args, **kwargs):
+        raise AssertionError("stream")
+
+    monkeypatch.setattr(main, "http_stream", fail_stream)
+    monkeypatch.setattr(main, "EVAL_STREAM", True)
+    # stream yo‘li tanlanadi (fake_request chaqirilmaydi), model xatosi -> lokal fallback
+    res, payloads = run_speaking(monkeypatch, "My home town is old and has a big river nearby.", on_partial)
+    assert payloads == []
+    assert "score_20_75" in res
@@ -0,0 +1,26 @@
+import json
+
+import main
+from main import pack_fsm_data, unpack_fsm_data
+
+
+def bank_prompts():
+    return [{**tpl, "prompt": main.WRITING_PROMPTS[bank][0]} for bank, tpl in main.WRITING_TASKS]
+
+
+def test_bank_questions_and_prompts_round_trip_as_indexes():
+    data = {"questions": main.SPEAKING_QUESTION_BANK[:3], "writing_prompts": bank_prompts(),
+            "answers": ["a", "", ""], "q_index": 1}
+    raw = pack_fsm_data(data)
+    stored = json.loads(raw)
+    assert set(stored["questions"]) == {"qi"} and set(stored["writing_prompts"]) == {"wi"}
+    assert len(raw) < len(json.dumps(data))
+    assert unpack_fsm_data(raw) == data
+
+
+def test_custom_values_are_stored_verbatim_and_stale_indexes_dropped():
+    custom = {"questions": ["Not from the bank?"], "writing_prompts": [{"task": 1, "prompt": "mine"}]}
+    assert unpack_fsm_data(pack_fsm_data(custom)) == custom
+    stale = json.dumps({"questions": {"qi": [10 ** 6]}, "writing_prompts": {"wi": "x"}, "q_index": 2})
+    assert unpack_fsm_data(stale) == {"q_index": 2}
+    assert unpack_fsm_data(None) == {}
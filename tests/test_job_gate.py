@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import main
+from main import JobGate
+
+
+def test_queued_job_reports_position_on_progress_message(monkeypatch):
+    edits = []
+
+    async def edit_message_text(**kwargs):
+        edits.append(kwargs["text"])
+
+    monkeypatch.setattr(main.bot, "edit_message_text", edit_message_text)
+
+    async def scenario():
+        gate = JobGate(1, 10)
+        release = asyncio.Event()
+
+        async def holder():
+            async with gate.slot(1):
+                await release.wait()
+
+        async def queued():
+            progress = main.ProgressMessage(5, 6)
+            async with gate.slot(2, main.progress_notifier(progress)):
+                pass
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(queued())
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, second)
+
+    asyncio.run(scenario())
+    assert edits == [main.QUEUE_TEXT.format(pos=1)]
+
+
+def test_round_robin_between_users_and_shedding():
+    async def scenario():
+        gate = JobGate(1, 3)
+        order = []
+        release = asyncio.Event()
+
+        async def job(user, tag):
+            async with gate.slot(user):
+                order.append(tag)
+                await release.wait()
+
+        first = asyncio.create_task(job(0, "x"))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(job(u, t)) for u, t in ((1, "a1"), (1, "a2"), (2, "b1"))]
+        await asyncio.sleep(0)
+        with pytest.raises(main.Overloaded):
+            async with gate.slot(3):
+                pass
+        assert gate.stats()["shed"] == 1 and gate.waiting == 3
+        release.set()
+        await asyncio.gather(first, *tasks)
+        assert order == ["x", "a1", "b1", "a2"]
+        assert gate.active == 0 and gate.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_low_priority_keeps_reserve_for_users():
+    async def scenario():
+        gate = JobGate(2, 10, reserve=1)
+        release = asyncio.Event()
+        started = []
+
+        async def job(user, low, tag):
+            async with gate.slot(user, low=low):
+                started.append(tag)
+                await release.wait()
+
+        tasks = [asyncio.create_task(job(9, True, "batch1")), asyncio.create_task(job(9, True, "batch2"))]
+        await asyncio.sleep(0)
+        assert started == ["batch1"]  # ikkinchi slot oddiy userlar uchun
+        tasks.append(asyncio.create_task(job(1, False, "user")))
+        await asyncio.sleep(0)
+        assert started == ["batch1", "user"]
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started[-1] == "batch2" and gate.active == 0
+
+    asyncio.run(scenario())
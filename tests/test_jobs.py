@@ -0,0 +1,58 @@
+import sqlite3
+import threading
+
+import main
+
+
+def fresh_conn(path=":memory:"):
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.executescript(main.DB_SCHEMA)
+    return conn
+
+
+def test_concurrent_insert_dedupes_without_integrity_error(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    fresh_conn(path).close()
+    results, errors = [], []
+
+    def insert():
+        conn = sqlite3.connect(path, isolation_level=None, timeout=10)
+        try:
+            for _ in range(20):
+                results.append(main._job_insert(conn, "writing", "same-key", "{}", 1, 1))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=insert) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len({job_id for job_id, _ in results}) == 1
+    assert sum(created for _, created in results) == 1
+
+
+def test_expired_lease_is_failed_after_max_attempts():
+    conn = fresh_conn()
+    job_id, _ = main._job_insert(conn, "writing", "k", "{}", 1, 1)
+    for attempt in range(1, main.JOB_MAX_ATTEMPTS + 1):
+        # worker yiqildi: lease o‘tib ketgan
+        assert main._job_claim(conn, "w")[5] == attempt
+        conn.execute("UPDATE eval_jobs SET locked_until=0 WHERE id=?", (job_id,))
+
+    assert main._job_claim(conn, "w") is None
+    assert [r[0] for r in main._job_expire(conn)] == [job_id]
+    assert main._job_counts(conn) == {"failed": 1}
+    assert main._job_expire(conn) == []
+
+
+def test_lease_is_extended_by_claiming_worker():
+    conn = fresh_conn()
+    job_id, _ = main._job_insert(conn, "writing", "k2", "{}", 1, 1)
+    main._job_claim(conn, "host:1:0")
+    conn.execute("UPDATE eval_jobs SET locked_until=0 WHERE id=?", (job_id,))
+    main._job_extend(conn, job_id, "host:1:0")
+    assert main._job_claim(conn, "host:2:0") is None
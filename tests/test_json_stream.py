@@ -0,0 +1,25 @@
+import json
+
+from main import JsonFieldStream
+
+DOC = {"per_question": [{"q": "a, b", "r": 4}], "score_20_75": 52, "off_topic": False,
+       "feedback_uz": "Yaxshi \"javob\", lekin {qisqa}.", "extra": None}
+
+
+def test_fields_arrive_in_order_across_any_chunking():
+    raw = json.dumps(DOC, ensure_ascii=False)
+    for size in (1, 3, 7, len(raw)):
+        parser = JsonFieldStream()
+        got = []
+        for i in range(0, len(raw), size):
+            got += parser.feed(raw[i:i + size])
+        assert got == list(DOC.items())
+        assert parser.fields == DOC
+
+
+def test_field_is_not_emitted_until_complete():
+    parser = JsonFieldStream()
+    assert parser.feed('```json\n{"score_20_75": 5') == []
+    assert parser.feed('0, "feedback_uz": "ok') == [("score_20_75", 50)]
+    assert parser.feed('"}\ntrailing {"x": 1}') == [("feedback_uz", "ok")]
+    assert parser.fields == {"score_20_75": 50, "feedback_uz": "ok"}
@@ -0,0 +1,82 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+URL = "https://example.com/word.mp3"
+
+
+class FakeMessage:
+    def __init__(self, voice_forbidden=False, stale=()):
+        self.voice_forbidden = voice_forbidden
+        self.stale = set(stale)
+        self.sent = []
+
+    async def answer_voice(self, media, caption=None):
+        if self.voice_forbidden:
+            raise RuntimeError("Telegram server says - Bad Request: VOICE_MESSAGES_FORBIDDEN")
+        if media in self.stale:
+            raise RuntimeError("wrong file identifier")
+        self.sent.append(("voice", media))
+        return SimpleNamespace(voice=SimpleNamespace(file_id="voice-id"))
+
+    async def answer_audio(self, media, caption=None):
+        if media in self.stale:
+            raise RuntimeError("wrong file identifier")
+        self.sent.append(("audio", media))
+        return SimpleNamespace(audio=SimpleNamespace(file_id="audio-id"))
+
+
+def send(registry, message, url=URL):
+    return asyncio.run(registry.send(message, url, "word"))
+
+
+def test_kinds_are_cached_separately(monkeypatch):
+    async def download(url):
+        return b"mp3"
+
+    monkeypatch.setattr(main, "download_bytes", download)
+    monkeypatch.setitem(main.CACHES, "media", main.media_registry)  # test registri globalni almashtirmasin
+    registry = main.MediaRegistry()
+    url = URL + "?kinds"
+
+    restricted = FakeMessage(voice_forbidden=True)
+    assert send(registry, restricted, url)
+    assert restricted.sent[0][0] == "audio"
+
+    # voice mumkin bo‘lgan user: audio file_id bilan (qayta yuklamasdan)
+    ok = FakeMessage()
+    assert send(registry, ok, url)
+    assert ok.sent == [("audio", "audio-id")]
+
+    # voice yuklanganidan keyin voice file_id cheklangan userda o‘chirilmaydi
+    main._db_call(registry._put, registry.key(url, "voice"), url, "voice-id", "voice")
+    again = FakeMessage(voice_forbidden=True)
+    assert send(registry, again, url)
+    assert again.sent == [("audio", "audio-id")]
+    assert main._db_call(registry._get, registry.key(url, "voice"), registry.key(url, "audio")) == {
+        "voice": "voice-id", "audio": "audio-id"}
+
+
+def test_stale_file_id_reuploads_even_if_drop_fails(monkeypatch):
+    async def download(url):
+        return b"mp3"
+
+    real_db_run = main.db_run
+
+    async def db_run(fn, *args):
+        if fn is main.MediaRegistry._drop:
+            raise RuntimeError("database is locked")
+        return await real_db_run(fn, *args)
+
+    monkeypatch.setattr(main, "download_bytes", download)
+    monkeypatch.setattr(main, "db_run", db_run)
+    monkeypatch.setitem(main.CACHES, "media", main.media_registry)  # test registri globalni almashtirmasin
+    registry = main.MediaRegistry()
+    url = URL + "?stale"
+    main._db_call(registry._put, registry.key(url, "voice"), url, "old-id", "voice")
+
+    message = FakeMessage(stale={"old-id"})
+    assert send(registry, message, url)
+    assert message.sent[0][0] == "voice" and message.sent[0][1] != "old-id"
+    assert registry.uploads == 1
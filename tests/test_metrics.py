@@ -0,0 +1,53 @@
+import main
+from main import Counter, Histogram
+
+
+def _drop(metric):
+    # test metrikalari global ro‘yxatda qolmasin
+    main.METRICS.remove(metric)
+
+
+def test_counter_render_mixes_status_codes_and_error_labels():
+    c = Counter("t_requests_total", "test", ("upstream", "status"))
+    try:
+        c.inc("groq", 200)
+        c.inc("groq", "timeout")
+        c.inc("groq", 429, amount=2)
+        c.inc("groq", 200)
+        lines = c.render()
+    finally:
+        _drop(c)
+    assert lines[:2] == ["# HELP t_requests_total test", "# TYPE t_requests_total counter"]
+    assert 't_requests_total{upstream="groq",status="200"} 2' in lines
+    assert 't_requests_total{upstream="groq",status="429"} 2' in lines
+    assert 't_requests_total{upstream="groq",status="timeout"} 1' in lines
+
+
+def test_histogram_render_is_cumulative():
+    h = Histogram("t_seconds", "test", ("model",), buckets=(0.1, 1))
+    try:
+        h.observe(0.05, "a")
+        h.observe(0.5, "a")
+        h.observe(5, "a")
+        h.observe(0.5, 7)
+        lines = h.render()
+    finally:
+        _drop(h)
+    assert 't_seconds_bucket{model="a",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{model="a",le="1"} 2' in lines
+    assert 't_seconds_bucket{model="a",le="+Inf"} 3' in lines
+    assert 't_seconds_count{model="a"} 3' in lines
+    assert 't_seconds_sum{model="a"} 5.550000' in lines
+    assert 't_seconds_count{model="7"} 1' in lines
+
+
+def test_render_metrics_after_upstream_errors():
+    main.upstream_requests.inc("groq", 200)
+    main.upstream_requests.inc("groq", "error")
+    main.llm_requests.inc("m", 429)
+    main.llm_requests.inc("m", "no_json")
+    main.stage_seconds.observe(0.2, "stt.vad")
+    text = main.render_metrics()
+    assert 'bot_upstream_requests_total{upstream="groq",status="error"}' in text
+    assert 'bot_llm_requests_total{model="m",status="429"}' in text
+    assert text.endswith("\n")
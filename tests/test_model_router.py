@@ -0,0 +1,39 @@
+import main
+from main import ModelRouter
+
+
+def test_breaker_opens_after_consecutive_failures_and_closes_on_success():
+    router = ModelRouter(["a", "b", "a", ""])
+    assert router.order() == ["a", "b"]
+    for _ in range(main.ROUTER_BREAKER_FAILS - 1):
+        router.record_failure("a", 0.1, 500)
+    assert not router.models["a"].is_open(main.time.monotonic())
+    router.record_failure("a", 0.1, 500)
+    assert router.order() == ["b", "a"]
+    router.record_success("a", 0.1)
+    assert router.snapshot()[0]["open"] is False
+
+
+def test_rate_limit_and_dead_model_cooldowns():
+    router = ModelRouter(["a", "b", "c"])
+    router.record_failure("a", 0.1, 429, retry_after="12")
+    router.record_failure("b", 0.1, 404, body="The model `b` has been decommissioned")
+    snap = {s["model"]: s for s in router.snapshot()}
+    assert 10 <= snap["a"]["open_for_s"] <= 12
+    assert snap["b"]["open_for_s"] > main.ROUTER_BREAKER_COOLDOWN
+    # birinchi yopilgan breaker birinchi qaytadi
+    assert router.order() == ["c", "a", "b"]
+
+
+def test_breaker_cooldown_doubles_per_trip():
+    router = ModelRouter(["a"])
+    h = router.models["a"]
+    for _ in range(main.ROUTER_BREAKER_FAILS):
+        router.record_failure("a", 0.1, "EXC")
+    assert h.trips == 1
+    first = h.open_until - main.time.monotonic()
+    assert first <= main.ROUTER_BREAKER_COOLDOWN
+    # ochiq turganda yana yiqilsa: cooldown ikki barobar
+    router.record_failure("a", 0.1, "EXC")
+    assert h.trips == 2
+    assert h.open_until - main.time.monotonic() > first * 1.5
@@ -0,0 +1,31 @@
+import main
+from main import analyze_text, prescore_reason
+
+QUESTIONS = ["Where do you live?", "Do you like sport?", "What is your favourite food?"]
+
+
+def speaking_reason(answers):
+    feats = [analyze_text(a, q) for q, a in zip(QUESTIONS, answers)]
+    return prescore_reason(feats, main.SPEAKING_MIN_WORDS * len(feats), check_topic=False,
+                           min_total=main.SPEAKING_FLOOR_WORDS * len(feats))
+
+
+def test_short_valid_speaking_answers_reach_the_model():
+    # A1/A2 darajadagi qisqa, lekin to‘g‘ri javoblar
+    assert speaking_reason(["I live in Tashkent.", "Yes, I like football.", "My favourite food is plov."]) is None
+
+
+def test_speaking_floor_still_skips_one_word_answers():
+    assert speaking_reason(["Tashkent.", "Yes.", "Plov."]) == "too_short"
+    assert speaking_reason(["", "", ""]) == "empty"
+
+
+def test_writing_reasons():
+    prompt = "Some people think that technology makes life easier. Discuss both views."
+    assert prescore_reason([analyze_text("", prompt)], 180) == "empty"
+    assert prescore_reason([analyze_text("Мен технологияни яхши кўраман.", prompt)], 180) == "non_english"
+    assert prescore_reason([analyze_text("Technology is good.", prompt)], 180) == "too_short"
+    off = " ".join(["My cat likes fish and sleeps all day in the sun."] * 8)
+    assert prescore_reason([analyze_text(off, prompt)], 180) == "off_topic"
+    on = " ".join(["Technology makes life easier for many people, but some views differ."] * 8)
+    assert prescore_reason([analyze_text(on, prompt)], 180) is None
@@ -0,0 +1,23 @@
+import asyncio
+import time
+
+import main
+
+
+def test_sweep_drops_only_abandoned_sessions():
+    async def scenario():
+        old, fresh = main.SpeakingSession(), main.SpeakingSession()
+        old.touched = time.monotonic() - 2 * main.FSM_TTL
+        stt = asyncio.create_task(asyncio.sleep(60))
+        old.tasks[0] = stt
+        main.speaking_sessions[(1, 1)] = old
+        main.speaking_sessions[(2, 2)] = fresh
+        try:
+            assert main.sweep_speaking_sessions() == 1
+            await asyncio.sleep(0)
+            assert (1, 1) not in main.speaking_sessions and (2, 2) in main.speaking_sessions
+            assert stt.cancelled()
+        finally:
+            main.speaking_sessions.clear()
+
+    asyncio.run(scenario())
@@ -0,0 +1,72 @@
+import main
+from main import apply_edits, normalize_answer
+
+
+def test_edit_does_not_match_inside_words():
+    text = "I think it is good."
+    out, n = apply_edits(text, [{"from": "it is good", "to": "it's good"}, {"from": "thin", "to": "thick"}])
+    assert out == "I think it's good."
+    assert n == 1
+
+
+def test_short_edit_is_skipped():
+    text = "Yesterday i think i went home."
+    out, n = apply_edits(text, [{"from": "i", "to": "I"}])
+    assert out == text
+    assert n == 0
+
+
+def test_ambiguous_edit_is_skipped():
+    text = "Today he go to school. Then he go home."
+    out, n = apply_edits(text, [{"from": "he go", "to": "he goes"}])
+    assert out == text
+    assert n == 0
+    out, n = apply_edits(text, [{"from": "Then he go", "to": "Then he goes"}])
+    assert out == "Today he go to school. Then he goes home."
+
+
+def test_edits_never_search_backwards():
+    text = "She have a cat. We was happy."
+    edits = [{"from": "We was", "to": "We were"}, {"from": "She have", "to": "She has"}]
+    out, n = apply_edits(text, edits)
+    assert out == "She have a cat. We were happy."
+    assert n == 1
+
+
+def test_edit_spans_collapsed_whitespace_and_repeats():
+    raw = "It was   sooooo\n\ngood!!!!!! really"
+    norm, _ = normalize_answer(raw, 1000)
+    assert norm == "It was sooo\ngood!!! really"
+    out, n = apply_edits(raw, [{"from": "was sooo good", "to": "was so good"}])
+    assert out == "It was so good!!!!!! really"
+    assert n == 1
+
+
+def test_normalize_keeps_numbers():
+    text, cut = normalize_answer("It costs 10000 dollars.", 1000)
+    assert text == "It costs 10000 dollars."
+    assert not cut
+
+
+def test_normalize_without_punctuation_cuts_at_word_boundary():
+    text = " ".join(["word"] * 400)  # STT: nuqtasiz uzun matn
+    out, cut = normalize_answer(text, 50)
+    assert cut
+    assert out.endswith(" […]")
+    body = out[:-len(" […]")]
+    assert body and set(body.split()) == {"word"}
+    assert main.estimate_tokens(body) <= 50
+
+
+def test_token_report_orders_models_by_total():
+    import sqlite3
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(main.DB_SCHEMA)
+    main._token_write(conn, [
+        ("2026-01-01", 1, "small", 10, 5, 1),
+        ("2026-01-01", 1, "big", 900, 300, 2),
+        ("2026-01-01", 2, "mid", 100, 50, 1),
+    ])
+    by_model, by_user = main._token_report(conn, "2026-01-01")
+    assert [row[0] for row in by_model] == ["big", "mid", "small"]
+    assert by_user[0] == (1, 1215)
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+import main
+from main import TTLCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(main, "CACHES", {})
+    return TTLCache("test", 2)
+
+
+def test_lru_eviction_and_expiry(cache, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache.set("a", 1, 10)
+    cache.set("b", 2, 10)
+    assert cache.get("a") == (True, 1)  # a endi eng yangi
+    cache.set("c", 3, 10)
+    assert cache.get("b") == (False, None) and cache.evictions == 1
+    cache.set("skip", 4, 0)
+    assert cache.get("skip") == (False, None)
+    now[0] += 11
+    assert cache.get("a") == (False, None)
+
+
+def test_concurrent_loads_are_coalesced_and_errors_not_cached(cache):
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "v"
+
+    async def failing():
+        raise RuntimeError("upstream")
+
+    async def scenario():
+        got = await asyncio.gather(*(cache.get_or_load("k", load, lambda v: 60) for _ in range(5)))
+        assert got == ["v"] * 5
+        assert await cache.get_or_load("k", load, lambda v: 60) == "v"
+        with pytest.raises(RuntimeError):
+            await cache.get_or_load("bad", failing, lambda v: 60)
+        assert cache.get("bad") == (False, None)
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
+    assert (cache.misses, cache.coalesced, cache.hits) == (2, 4, 1)
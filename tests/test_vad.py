@@ -0,0 +1,59 @@
+import math
+import random
+import struct
+
+import main
+from main import trim_silence
+
+RATE = main.VAD_RATE
+
+
+def tone(sec, amp, depth=0.45):
+    # 4 Hz amplituda modulyatsiyasi (bo‘g‘inlar) bilan 220 Hz
+    return b"".join(
+        struct.pack("<h", int(amp * (1 - depth + depth * math.sin(2 * math.pi * 4 * i / RATE))
+                              * math.sin(2 * math.pi * 220 * i / RATE)))
+        for i in range(int(sec * RATE))
+    )
+
+
+def noise(sec, amp=30):
+    rnd = random.Random(7)
+    return b"".join(struct.pack("<h", int(rnd.gauss(0, amp))) for _ in range(int(sec * RATE)))
+
+
+def test_leading_trailing_silence_and_long_pause_removed():
+    pcm = noise(3) + tone(2, 8000) + noise(4) + tone(1, 6000) + noise(2)
+    out, info = trim_silence(pcm)
+    assert info["trimmed"]
+    assert info["audio_s"] == 12.0
+    assert 3.0 <= info["kept_s"] <= 4.5
+    assert len(out) == round(info["kept_s"] * RATE) * 2
+
+
+def test_quiet_note_has_no_speech():
+    out, info = trim_silence(noise(5))
+    assert out == b""
+    assert info["kept_s"] == 0.0
+
+
+def test_low_dynamics_is_uploaded_untrimmed():
+    # pauzasiz, ~3 dB modulyatsiyali nutq: jimlik yo‘q, rad etilmaydi
+    out, info = trim_silence(tone(6, 8000, depth=0.15))
+    assert out
+    assert not info["trimmed"]
+    assert info["kept_s"] >= 5.9
+
+
+def test_loud_steady_noise_is_not_rejected():
+    out, info = trim_silence(noise(6, 600))
+    assert out
+    assert info["kept_s"] >= 5.9
+
+
+def test_max_duration_is_enforced(monkeypatch):
+    monkeypatch.setattr(main, "SPEAKING_MAX_SECONDS", 1.5)
+    out, info = trim_silence(noise(1) + tone(4, 8000) + noise(1))
+    assert info["truncated"]
+    assert info["kept_s"] == 1.5
+    assert len(out) == int(1.5 * RATE) * 2